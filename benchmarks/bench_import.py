@@ -0,0 +1,93 @@
+""" Benchmark of the start-up cost of the package: the wall time of importing
+`bfore` (and of building and evaluating a small likelihood) in a fresh
+interpreter, and the heavy dependencies loaded by it. The likelihood core
+should only load numpy, so that short-lived worker processes start quickly.
+
+Usage (from the repository root):
+    PYTHONPATH=. python benchmarks/bench_import.py [--repeat 10] [--max-time 0.5]
+        [--json results.json]
+
+The script exits with status 1 if any of the heavy dependencies is loaded,
+or if the median import time is larger than --max-time seconds.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+HEAVY = ['healpy', 'scipy', 'emcee', 'numdifftools', 'matplotlib', 'astropy']
+
+IMPORT = "import bfore"
+
+LIKELIHOOD = """
+import numpy as np
+import bfore
+nus = [30., 90., 150., 220., 350.]
+inst = bfore.InstrumentModel([{'nu': np.array([n])} for n in nus])
+sky = bfore.SkyModel(['syncpl', 'dustmbb', 'cmb'])
+rng = np.random.RandomState(1)
+config = {'data': rng.randn(2, 12, len(nus)), 'noisevar': np.ones([2, 12, len(nus)]),
+          'var_pars': ['beta_s', 'beta_d', 'T_d'],
+          'fixed_pars': {'nu_ref_s': 23., 'nu_ref_d': 353.},
+          'var_prior_mean': [-3., 1.6, 20.], 'var_prior_width': [1., 1., 1.],
+          'var_prior_type': ['gauss', 'gauss', 'gauss']}
+ml = bfore.MapLike(config, sky, inst)
+ml.marginal_spectral_likelihood(np.array([-3., 1.6, 20.]))
+"""
+
+REPORT = """
+import sys, time, json
+t0 = time.perf_counter()
+exec(compile(%r, '<bench>', 'exec'))
+t = time.perf_counter() - t0
+print(json.dumps({'time': t, 'heavy': sorted(set(m.split('.')[0] for m in sys.modules) & set(%r))}))
+"""
+
+
+def run(code, repeat):
+    """ Runs `code` `repeat` times, each in a new interpreter, and returns the
+    wall times and the heavy modules loaded.
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    times = []
+    heavy = set()
+    for i in range(repeat) :
+        out = subprocess.check_output([sys.executable, '-c', REPORT % (code, HEAVY)], env=env)
+        res = json.loads(out.decode().strip().split('\n')[-1])
+        times.append(res['time'])
+        heavy.update(res['heavy'])
+    return {'time_min': min(times), 'time_median': float(np.median(times)),
+            'heavy': sorted(heavy)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-time', type=float, default=None,
+                        help="maximum median import time, in seconds")
+    parser.add_argument('--json', help="file to write the results to")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print("%-12s %10s %10s  %s" % ("case", "min[s]", "median[s]", "heavy modules"))
+    for name, code in [('import', IMPORT), ('likelihood', LIKELIHOOD)] :
+        res = run(code, args.repeat)
+        results[name] = res
+        print("%-12s %10.4g %10.4g  %s" % (name, res['time_min'], res['time_median'],
+                                           ", ".join(res['heavy']) or "-"))
+    if args.json :
+        with open(args.json, 'w') as f :
+            json.dump(results, f, indent=1)
+    failed = any([len(res['heavy']) > 0 for res in results.values()])
+    if args.max_time is not None :
+        failed |= results['import']['time_median'] > args.max_time
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
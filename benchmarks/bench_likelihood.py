@@ -0,0 +1,203 @@
+""" Benchmark suite for the likelihood hot path. Times the SED evaluation
+(`SkyModel.fnu`, `InstrumentModel.convolve_sed`, `MapLike.f_matrix`), the
+amplitude step (`get_amplitude_covariance`, `get_amplitude_mean`), the
+marginal likelihood and chi2, and short runs of the samplers, and records
+the wall time and peak memory of each.
+
+The sweep varies one quantity at a time around a baseline configuration
+(nside=64, 12 channels, 10 bandpass bins per channel, 3 components, noise
+varying from pixel to pixel): the resolution, the number of channels, the
+bandpass resolution and the number of components.
+
+Usage (from the repository root):
+    PYTHONPATH=. python benchmarks/bench_likelihood.py [--nside 8 32 128 512]
+        [--json results.json] [--compare baseline.json] [--quick]
+
+With --compare, the timings are compared with those of a previous run and
+the script exits with status 1 if any of them is slower than --threshold
+times the baseline.
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from bfore import MapLike, SkyModel, InstrumentModel
+from bfore.sampling import run_minimize, run_fisher, run_emcee
+
+BASELINE = {'nside': 64, 'n_freq': 12, 'n_bins': 10, 'n_comp': 3}
+COMPONENTS = ['syncpl', 'dustmbb', 'cmb']
+VAR_PARS = {'syncpl': ['beta_s'], 'dustmbb': ['beta_d', 'T_d'], 'cmb': []}
+TRUE_PARS = {'beta_s': -3., 'beta_d': 1.6, 'T_d': 20.,
+             'nu_ref_s': 23., 'nu_ref_d': 353.}
+
+
+def setup(nside, n_freq, n_bins, n_comp, uniform_noise=False, n_pol=2, seed=1234):
+    """ Builds a MapLike with random amplitudes and noise.
+    """
+    rng = np.random.RandomState(seed)
+    nus = np.geomspace(20., 400., n_freq)
+    if n_bins == 1 :
+        bps = [{'nu': np.array([n])} for n in nus]
+    else :
+        bps = [{'nu': np.linspace(0.85 * n, 1.15 * n, n_bins + 1), 'bps': np.ones(n_bins)}
+               for n in nus]
+    sky = SkyModel(COMPONENTS[:n_comp])
+    inst = InstrumentModel(bps)
+    var_pars = sum([VAR_PARS[c] for c in COMPONENTS[:n_comp]], [])
+    fixed_pars = {'nu_ref_s': TRUE_PARS['nu_ref_s'], 'nu_ref_d': TRUE_PARS['nu_ref_d']}
+    f_true = np.array([inst.convolve_sed(c, args=tuple(TRUE_PARS[p] for p in c.get_parameters()))
+                       for c in sky.components])
+    npix = 12 * nside ** 2
+    amps = rng.randn(n_pol, npix, n_comp)
+    if uniform_noise :
+        noisevar = np.ones([n_pol, npix, n_freq])
+    else :
+        noisevar = 0.5 + rng.rand(n_pol, npix, n_freq)
+    data = np.dot(amps, f_true) + np.sqrt(noisevar) * rng.randn(n_pol, npix, n_freq)
+    config = {'data': data, 'noisevar': noisevar, 'var_pars': var_pars, 'fixed_pars': fixed_pars,
+              'var_prior_mean': [TRUE_PARS[p] for p in var_pars],
+              'var_prior_width': [1. for p in var_pars],
+              'var_prior_type': ['gauss' for p in var_pars],
+              # time the SED computation, not the cache
+              'sed_cache_size': 0}
+    ml = MapLike(config, sky, inst)
+    params = np.array([TRUE_PARS[p] for p in var_pars]) + 0.01
+    return ml, params
+
+
+def measure(func, repeat, min_time=0.2):
+    """ Returns the minimum and median wall time per call over `repeat`
+    measurements, and the peak memory (in MB) allocated during one call. Fast
+    functions are called several times in each measurement, so that it takes
+    at least `min_time` seconds.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    t = timer.timeit(number)
+    if t < min_time :
+        number = int(min_time / max(t, 1E-7)) + 1
+    times = [t / number for t in timer.repeat(number=number, repeat=repeat)]
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'time_min': min(times), 'time_median': float(np.median(times)),
+            'peak_mb': peak / 2.**20}
+
+
+def benchmarks(ml, params, samplers=True):
+    """ Returns a dictionary of functions to time for a given likelihood.
+    """
+    f_matrix = ml.f_matrix(params)
+    par_dict = dict(ml.fixed_pars)
+    par_dict.update(zip(ml.var_pars, params))
+    pos0 = ml.var_prior_mean
+    ndim = len(pos0)
+    funcs = {
+        'fnu': lambda: ml.sky.fnu(ml.inst.nu_packed, par_dict),
+        'convolve_sed': lambda: [ml.inst.convolve_sed(c, args=tuple(par_dict[p] for p in c.get_parameters()))
+                                 for c in ml.sky.components],
+        'f_matrix': lambda: ml.f_matrix(params),
+        'get_amplitude_covariance': lambda: ml.get_amplitude_covariance(params, f_matrix=f_matrix),
+        'get_amplitude_mean': lambda: ml.get_amplitude_mean(params, f_matrix=f_matrix),
+        'marginal_spectral_likelihood': lambda: ml.marginal_spectral_likelihood(params),
+        'chi2': lambda: ml.chi2(params),
+    }
+    if samplers :
+        func = ml.marginal_spectral_likelihood
+        funcs.update({
+            'run_minimize': lambda: run_minimize(func, pos0, options={'maxfev': 200}),
+            'run_fisher': lambda: run_fisher(func, pos0),
+            'run_emcee': lambda: run_emcee(func, pos0, nwalkers=2 * ndim + 2, nsamps=20, nburn=0),
+        })
+    return funcs
+
+
+def cases(nsides, quick=False):
+    """ One-at-a-time sweep around the baseline configuration.
+    """
+    sweeps = [('nside', nsides), ('n_freq', [6, 12, 24]),
+              ('n_bins', [1, 10, 50]), ('n_comp', [1, 2, 3])]
+    out = [dict(BASELINE)]
+    if quick :
+        return out
+    for key, values in sweeps :
+        for v in values :
+            case = dict(BASELINE)
+            case[key] = v
+            if case not in out :
+                out.append(case)
+    return out
+
+
+def compare(results, baseline_file, threshold):
+    """ Prints the ratio of each timing to the one in `baseline_file` and
+    returns the number of regressions.
+    """
+    with open(baseline_file) as f :
+        baseline = json.load(f)['results']
+    key = lambda r: tuple(sorted(r['case'].items())) + (r['function'],)
+    base = {key(r): r for r in baseline}
+    n_slow = 0
+    print("\n%-40s %-28s %8s" % ("case", "function", "ratio"))
+    for r in results :
+        if key(r) not in base :
+            continue
+        ratio = r['time_min'] / base[key(r)]['time_min']
+        flag = ""
+        if ratio > threshold :
+            flag = " SLOWER"
+            n_slow += 1
+        print("%-40s %-28s %8.2f%s" % (str(sorted(r['case'].values())), r['function'], ratio, flag))
+    return n_slow
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nside', type=int, nargs='+', default=[8, 32, 128, 512])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--uniform-noise', action='store_true',
+                        help="use the same noise in all pixels (compressed likelihood)")
+    parser.add_argument('--sampler-max-nside', type=int, default=64,
+                        help="only run the samplers up to this resolution")
+    parser.add_argument('--quick', action='store_true', help="only run the baseline case")
+    parser.add_argument('--json', help="file to write the results to")
+    parser.add_argument('--compare', help="results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.3)
+    args = parser.parse_args(argv)
+
+    results = []
+    print("%6s %6s %6s %6s %-28s %10s %10s %10s" %
+          ("nside", "n_freq", "n_bins", "n_comp", "function", "min[s]", "median[s]", "peak[MB]"))
+    for case in cases(args.nside, quick=args.quick) :
+        ml, params = setup(uniform_noise=args.uniform_noise, **case)
+        funcs = benchmarks(ml, params, samplers=case['nside'] <= args.sampler_max_nside)
+        for name, func in funcs.items() :
+            # one long sampler run is enough
+            repeat = 1 if name.startswith('run_') else args.repeat
+            res = measure(func, repeat)
+            res.update({'case': case, 'function': name})
+            results.append(res)
+            print("%6d %6d %6d %6d %-28s %10.4g %10.4g %10.2f" %
+                  (case['nside'], case['n_freq'], case['n_bins'], case['n_comp'], name,
+                   res['time_min'], res['time_median'], res['peak_mb']))
+        del ml
+
+    if args.json :
+        meta = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                'numpy': np.__version__, 'machine': platform.machine(),
+                'processor': platform.processor(), 'uniform_noise': args.uniform_noise}
+        with open(args.json, 'w') as f :
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if args.compare :
+        return int(compare(results, args.compare, args.threshold) > 0)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
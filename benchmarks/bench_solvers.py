@@ -0,0 +1,50 @@
+""" Benchmark of the amplitude step of the marginal likelihood: generic
+`np.linalg.solve` + three-operand `einsum` against the `BlockFactor` solver
+layer, at several resolutions.
+
+Usage (from the repository root):
+    PYTHONPATH=. python benchmarks/bench_solvers.py [nside ...]
+"""
+from __future__ import print_function
+import sys
+import timeit
+import numpy as np
+from bfore.solvers import BlockFactor
+
+
+def setup(nside, n_comp=3, n_freq=12, n_pol=2, seed=1234):
+    rng = np.random.RandomState(seed)
+    npix = n_pol * 12 * nside ** 2
+    f_matrix = rng.rand(n_comp, n_freq) + 0.1
+    noiseivar = rng.rand(npix, n_freq) + 0.5
+    dataivar = rng.randn(npix, n_freq)
+    nt_inv = np.einsum("ik,pk,jk->pij", f_matrix, noiseivar, f_matrix)
+    return f_matrix, dataivar, nt_inv
+
+
+def generic(f_matrix, dataivar, nt_inv):
+    y = np.sum(f_matrix[None, :, :] * dataivar[:, None, :], axis=2)
+    amp_mean = np.linalg.solve(nt_inv, y[:, :, None])[:, :, 0]
+    return 0.5 * np.einsum("ij,ijk,ik->", amp_mean, nt_inv, amp_mean)
+
+
+def factored(f_matrix, dataivar, nt_inv):
+    y = np.dot(dataivar, f_matrix.T)
+    amp_mean = BlockFactor(nt_inv).solve(y)
+    return 0.5 * np.sum(y * amp_mean)
+
+
+def main(nsides, n_comps=(3, 5), repeat=3):
+    print("%6s %6s %12s %12s %8s" % ("nside", "n_comp", "generic[s]", "factored[s]", "speedup"))
+    for n_comp in n_comps :
+        for nside in nsides :
+            args = setup(nside, n_comp=n_comp)
+            assert np.isclose(generic(*args), factored(*args), rtol=1E-8)
+            t_gen = min(timeit.repeat(lambda: generic(*args), number=1, repeat=repeat))
+            t_fac = min(timeit.repeat(lambda: factored(*args), number=1, repeat=repeat))
+            print("%6d %6d %12.4f %12.4f %8.2f" % (nside, n_comp, t_gen, t_fac, t_gen / t_fac))
+
+
+if __name__ == '__main__':
+    nsides = [int(n) for n in sys.argv[1:]] or [64, 128, 256, 512]
+    main(nsides)
@@ -1,5 +1,19 @@
 from .maplike import MapLike
 from .skymodel import SkyModel
 from .instrumentmodel import InstrumentModel
-from .sampling import run_emcee
 from .components import *
+
+# The likelihood only needs numpy. The samplers, and the packages they depend
+# on (scipy, emcee, numdifftools), are imported when first used.
+_lazy_attributes = {'run_emcee': 'sampling'}
+_lazy_modules = ['sampling']
+
+
+def __getattr__(name):
+    import importlib
+    if name in _lazy_modules :
+        return importlib.import_module('.' + name, __name__)
+    if name in _lazy_attributes :
+        module = importlib.import_module('.' + _lazy_attributes[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,217 @@
+from __future__ import print_function
+import numpy as np
+
+
+class RunningMoments(object):
+    """
+    Running mean and variance of a stream of arrays, updated one batch at a
+    time (Chan et al. pairwise update), so that memory does not grow with the
+    number of samples. Accumulators filled independently (e.g. by different
+    processes) can be merged.
+    """
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, x):
+        """ Adds a batch of samples with shape (N_samples,) + shape.
+        """
+        x = np.asarray(x, dtype=float)
+        if len(x) == 0 :
+            return self
+        batch = RunningMoments(self.mean.shape)
+        batch.n = len(x)
+        batch.mean = np.mean(x, axis=0)
+        batch.m2 = np.sum((x - batch.mean) ** 2, axis=0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        """ Adds the samples accumulated by another `RunningMoments`.
+        """
+        if other.n == 0 :
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        """ Sample variance (with N-1 normalization).
+        """
+        return self.m2 / max(self.n - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class Reservoir(object):
+    """
+    Uniform random subsample of fixed size of a stream of arrays (reservoir
+    sampling), used to estimate quantiles with a memory cost of `size`
+    samples regardless of the length of the stream.
+    """
+    def __init__(self, size, shape):
+        self.size = size
+        self.n = 0
+        self.samples = np.zeros((size,) + tuple(shape))
+
+    @property
+    def n_stored(self):
+        return min(self.n, self.size)
+
+    def update(self, x, rng):
+        """ Adds a batch of samples with shape (N_samples,) + shape. Each
+        sample seen so far has the same probability of being stored.
+        """
+        for xi in x :
+            if self.n < self.size :
+                self.samples[self.n] = xi
+            else :
+                j = rng.integers(self.n + 1)
+                if j < self.size :
+                    self.samples[j] = xi
+            self.n += 1
+        return self
+
+    def merge(self, other, rng):
+        """ Combines with the reservoir of a disjoint stream, so that the
+        result is a uniform subsample of both streams.
+        """
+        if other.n == 0 :
+            return self
+        if self.n == 0 :
+            self.n = other.n
+            self.samples[...] = other.samples
+            return self
+        n_keep = min(self.size, self.n + other.n)
+        # number of samples coming from this stream
+        n_self = rng.hypergeometric(self.n, other.n, n_keep)
+        ids_self = rng.choice(self.n_stored, n_self, replace=False)
+        ids_other = rng.choice(other.n_stored, n_keep - n_self, replace=False)
+        self.samples[:n_keep] = np.concatenate([self.samples[ids_self],
+                                                other.samples[ids_other]])
+        self.n += other.n
+        return self
+
+    def quantiles(self, q):
+        """ Returns the quantiles `q` (in [0, 1]) of the stored samples, with
+        shape (N_q,) + shape.
+        """
+        return np.quantile(self.samples[:self.n_stored], q, axis=0)
+
+
+class AmplitudeAccumulator(object):
+    """
+    Running statistics of amplitude maps: mean and variance and, if
+    `reservoir_size` > 0, a reservoir of samples used to compute quantiles.
+    """
+    def __init__(self, shape, reservoir_size=0):
+        self.moments = RunningMoments(shape)
+        self.reservoir = Reservoir(reservoir_size, shape) if reservoir_size > 0 else None
+
+    def update(self, x, rng):
+        self.moments.update(x)
+        if self.reservoir is not None :
+            self.reservoir.update(x, rng)
+        return self
+
+    def merge(self, other, rng):
+        self.moments.merge(other.moments)
+        if self.reservoir is not None :
+            self.reservoir.merge(other.reservoir, rng)
+        return self
+
+    def results(self, quantiles=None):
+        """ Returns a dictionary with the number of samples ('n'), their mean
+        ('mean'), variance ('var'), standard deviation ('std') and, if
+        `quantiles` is not None, their quantiles ('quantiles').
+        """
+        out = {'n': self.moments.n, 'mean': self.moments.mean,
+               'var': self.moments.var, 'std': self.moments.std}
+        if quantiles is not None :
+            out['quantiles'] = self.reservoir.quantiles(quantiles)
+        return out
+
+
+def _amplitude_batch(task):
+    """ Draws amplitudes for a batch of chain samples (see `amplitude_maps`)
+    and returns their accumulated statistics.
+    """
+    maplike, params, n_draws, reservoir_size, seed_seq = task
+    rng = np.random.default_rng(seed_seq)
+    acc = AmplitudeAccumulator((maplike.npix, maplike.sky.ncomps), reservoir_size)
+    for p in params :
+        acc.update(maplike.sample_amplitudes(p, n_draws=n_draws, rng=rng), rng)
+    return acc
+
+
+def amplitude_maps(maplike, chains, n_draws=1, batch_size=100, quantiles=None,
+                   reservoir_size=100, pool=None, seed=None):
+    """ Computes the posterior mean, variance and (optionally) quantiles of the
+    component amplitudes, marginalized over the spectral parameters. For each
+    sample of the chain, amplitudes are drawn from their Gaussian distribution
+    conditional on the spectral parameters (see `MapLike.sample_amplitudes`).
+
+    The chain is processed in batches, and only running statistics are kept,
+    so memory scales as N_pix * N_comp (times `reservoir_size` if quantiles
+    are requested) for chains of any length.
+
+    Parameters
+    ----------
+    maplike: MapLike
+        Likelihood the chain was sampled from.
+    chains: array_like(float)
+        Samples of the spectral parameters, with shape (N_samples, N_var)
+        (e.g. the 'chains' output of `run_emcee`).
+    n_draws: int
+        Number of amplitude draws per sample (optional, default=1). If 0, the
+        conditional mean amplitudes of each sample are used instead, and the
+        variance only includes the uncertainty of the spectral parameters.
+    batch_size: int
+        Number of samples processed in each task (optional, default=100).
+    quantiles: array_like(float)
+        Quantiles (in [0, 1]) to compute (optional, default=None).
+    reservoir_size: int
+        Number of amplitude draws stored to estimate the quantiles (optional,
+        default=100). Only used if `quantiles` is not None.
+    pool: object
+        Pool of processes with a `map` method (e.g. `multiprocessing.Pool` or a
+        `schwimmbad` pool, see `bfore.parallel.get_pool`) used to distribute
+        the batches (optional, default=None, batches are processed serially).
+        Sharing the data of `maplike` (see `MapLike.share_memory`) avoids
+        sending a copy of it with each batch.
+    seed: int
+        Seed of the random draws (optional, default=None). For a given seed the
+        results do not depend on `pool`.
+
+    Returns
+    -------
+    dict
+        Dictionary with arrays of shape (N_pix, N_comp) 'mean', 'var' and 'std',
+        the number of draws 'n', and, if `quantiles` is not None, 'quantiles'
+        with shape (N_q, N_pix, N_comp).
+    """
+    chains = np.atleast_2d(chains)
+    if quantiles is None :
+        reservoir_size = 0
+    batches = [chains[i:i + batch_size] for i in range(0, len(chains), batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches) + 1)
+    rng = np.random.default_rng(seeds[-1])
+    tasks = [(maplike, b, n_draws, reservoir_size, s) for b, s in zip(batches, seeds)]
+    acc = AmplitudeAccumulator((maplike.npix, maplike.sky.ncomps), reservoir_size)
+    if pool is None :
+        for task in tasks :
+            acc.merge(_amplitude_batch(task), rng)
+    else :
+        # one round of tasks per worker, so that only a few accumulators are
+        # held in memory at once
+        n_round = getattr(pool, 'size', None) or getattr(pool, '_processes', None) or 8
+        for i in range(0, len(tasks), n_round) :
+            for out in pool.map(_amplitude_batch, tasks[i:i + n_round]) :
+                acc.merge(out, rng)
+    return acc.results(quantiles)
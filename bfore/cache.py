@@ -0,0 +1,256 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+try :
+    import fcntl
+except ImportError :
+    # no locking (e.g. on Windows)
+    fcntl = None
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used cache with hit/miss counters.
+    """
+    def __init__(self, maxsize=128):
+        """
+        Initializes an empty cache.
+
+        Parameters
+        ----------
+        maxsize: int
+            Maximum number of entries. The least recently used entry is
+            discarded when a new one is added to a full cache.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the value stored for `key`, or None if not present.
+        """
+        try :
+            value = self.entries[key]
+        except KeyError :
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Stores `value` under `key`, evicting the oldest entry if needed.
+        """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize :
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """ Removes all entries and resets the counters.
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ Returns a dictionary with the number of hits, misses and entries.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'maxsize': self.maxsize}
+
+
+class DiskCache(object):
+    """
+    Persistent cache of arrays in a directory, shared by all the processes
+    (and jobs) running on the same file system.
+
+    Each entry is a sub-directory, named after the key, with one .npy file
+    per array, which is returned memory-mapped. Keys should be content hashes
+    of all the inputs the arrays depend on (see `content_hash`), so that
+    entries are invalidated automatically when any of them change.
+
+    Entries are written to a temporary directory and renamed, so readers only
+    see complete entries, and concurrent writers of the same entry keep the
+    first one written. Writes and evictions are serialized with a lock file.
+    When the total size exceeds `maxbytes`, the least recently used entries
+    are removed.
+    """
+    def __init__(self, directory, maxbytes=2**30):
+        """
+        Opens (or creates) a cache.
+
+        Parameters
+        ----------
+        directory: str
+            Directory of the cache.
+        maxbytes: int
+            Maximum size of the cache in bytes (optional, default=2**30,
+            i.e. 1 GB).
+        """
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory) :
+            os.makedirs(directory, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def _entries(self):
+        return [d for d in os.listdir(self.directory)
+                if not d.startswith('.') and os.path.isdir(self._entry_dir(d))]
+
+    def _lock(self):
+        return _FileLock(os.path.join(self.directory, '.lock'))
+
+    def get(self, key):
+        """ Returns the arrays stored under `key` (a dictionary of read-only
+        memory maps), or None if not present.
+        """
+        entry = self._entry_dir(key)
+        try :
+            names = [f for f in os.listdir(entry) if f.endswith('.npy')]
+            arrays = {f[:-4]: np.load(os.path.join(entry, f), mmap_mode='r') for f in names}
+            # mark as recently used
+            os.utime(entry)
+        except (OSError, ValueError) :
+            # missing, or evicted while being read
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        """ Stores a dictionary of arrays under `key`, evicting the least
+        recently used entries if the cache grows too large. If the entry
+        already exists it is left untouched.
+        """
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry) :
+            return
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=self.directory)
+        try :
+            for name, arr in arrays.items() :
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(arr))
+            with self._lock() :
+                if not os.path.isdir(entry) :
+                    os.rename(tmp, entry)
+                self._evict()
+        finally :
+            if os.path.isdir(tmp) :
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    def _evict(self):
+        # called with the lock held
+        entries = []
+        for key in self._entries() :
+            entry = self._entry_dir(key)
+            try :
+                nbytes = sum([os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), nbytes, key))
+            except OSError :
+                pass
+        total = sum([e[1] for e in entries])
+        for mtime, nbytes, key in sorted(entries) :
+            if total <= self.maxbytes :
+                break
+            self._remove(key)
+            total -= nbytes
+
+    def _remove(self, key):
+        # renamed first, so that readers never see partial entries
+        tmp = tempfile.mkdtemp(prefix='.del_', dir=self.directory)
+        try :
+            os.rename(self._entry_dir(key), os.path.join(tmp, key))
+        except OSError :
+            pass
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def nbytes(self):
+        """ Returns the total size of the entries in bytes.
+        """
+        total = 0
+        for key in self._entries() :
+            entry = self._entry_dir(key)
+            total += sum([os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)])
+        return total
+
+    def clear(self):
+        """ Removes all entries and resets the counters.
+        """
+        with self._lock() :
+            for key in self._entries() :
+                self._remove(key)
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """ Returns a dictionary with the number of hits, misses and entries,
+        and the size of the cache in bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries()),
+                'nbytes': self.nbytes(), 'maxbytes': self.maxbytes}
+
+
+class _FileLock(object):
+    """ Exclusive lock on a file, held within a `with` block.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.fname, 'a')
+        if fcntl is not None :
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None :
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def content_hash(*objects):
+    """ Returns a hexadecimal SHA-256 digest of the contents of `objects`,
+    which may be (nested) lists, tuples and dictionaries of arrays, strings,
+    numbers and None. Arrays are hashed by dtype, shape and values, so equal
+    inputs give the same key in any process.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, objects)
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, dict) :
+        h.update(b'dict')
+        for k in sorted(obj, key=repr) :
+            _update_hash(h, k)
+            _update_hash(h, obj[k])
+    elif isinstance(obj, (list, tuple)) :
+        h.update(('%s%d' % (type(obj).__name__, len(obj))).encode())
+        for o in obj :
+            _update_hash(h, o)
+    elif isinstance(obj, np.ndarray) :
+        arr = np.ascontiguousarray(obj)
+        h.update(('array%s%s' % (arr.dtype.str, arr.shape)).encode())
+        h.update(arr.tobytes())
+    elif isinstance(obj, bytes) :
+        h.update(b'bytes%d' % len(obj))
+        h.update(obj)
+    elif isinstance(obj, str) :
+        h.update(b'str')
+        _update_hash(h, obj.encode())
+    elif isinstance(obj, np.generic) :
+        _update_hash(h, obj.item())
+    elif obj is None or isinstance(obj, (bool, int, float)) :
+        h.update(('%s:%r;' % (type(obj).__name__, obj)).encode())
+    else :
+        raise TypeError("Cannot hash object of type %s" % type(obj).__name__)
@@ -0,0 +1,156 @@
+from __future__ import print_function
+import os
+import glob
+import pickle
+import numpy as np
+
+
+class ChainBackend(object):
+    """
+    On-disk storage for the chains of an ensemble sampler. The chain and the
+    log-probabilities are written in chunks of steps to .npy files, together
+    with the state of the sampler after the last chunk, so that a run can be
+    resumed after being interrupted. Each file is written to a temporary
+    name and then renamed, so a run killed while writing leaves the previous
+    checkpoint intact.
+
+    The directory contains:
+    - chain_NNNNN.npy: array with shape (N_steps, N_walkers, N_par).
+    - lnprob_NNNNN.npy: array with shape (N_steps, N_walkers).
+    - state.pkl: walker positions, log-probabilities and random state after
+      the last saved chunk, and number of steps taken.
+    """
+    def __init__(self, directory, nwalkers, ndim, thin=1, dtype='float64', resume=True):
+        """
+        Opens (or creates) a backend.
+
+        Parameters
+        ----------
+        directory: str
+            Directory for the chain files.
+        nwalkers: int
+            Number of walkers.
+        ndim: int
+            Number of parameters.
+        thin: int
+            Only one in every `thin` steps is stored (optional, default=1).
+        dtype: str
+            Data type used to store the chain (optional, default='float64').
+            'float32' halves the size of the files.
+        resume: bool
+            If True, a chain already in the directory is kept, to be
+            continued. Otherwise it is deleted (optional, default=True).
+
+        Raises
+        ------
+        ValueError
+            If `resume` is True and the directory contains a chain with a
+            different number of walkers, parameters or thinning.
+        """
+        self.directory = directory
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.thin = thin
+        self.dtype = np.dtype(dtype)
+        if not os.path.isdir(directory) :
+            os.makedirs(directory)
+        if not resume :
+            self.clear()
+        state = self.load_state()
+        if state is not None :
+            saved = (state['nwalkers'], state['ndim'], state['thin'])
+            if saved != (nwalkers, ndim, thin) :
+                raise ValueError("Chain in %s has (nwalkers, ndim, thin)=%s, expected %s" %
+                                 (directory, str(saved), str((nwalkers, ndim, thin))))
+
+    @property
+    def _state_file(self):
+        return os.path.join(self.directory, 'state.pkl')
+
+    def _chunk_file(self, name, ichunk):
+        return os.path.join(self.directory, '%s_%05d.npy' % (name, ichunk))
+
+    def load_state(self):
+        """ Returns the state saved with the last chunk (a dictionary with
+        fields 'coords', 'log_prob', 'random_state', 'iteration' and
+        'n_chunks'), or None if there is no saved chain.
+        """
+        if not os.path.isfile(self._state_file) :
+            return None
+        with open(self._state_file, 'rb') as f :
+            return pickle.load(f)
+
+    @property
+    def iteration(self):
+        """ Number of steps taken by the saved chain.
+        """
+        state = self.load_state()
+        return 0 if state is None else state['iteration']
+
+    def save(self, chain, log_prob, coords, last_log_prob, random_state, iteration):
+        """ Appends a chunk of (already thinned) steps and saves the state of
+        the sampler.
+
+        Parameters
+        ----------
+        chain: array_like(float)
+            Array with shape (N_steps, N_walkers, N_par).
+        log_prob: array_like(float)
+            Array with shape (N_steps, N_walkers).
+        coords: array_like(float)
+            Walker positions after the last step taken (N_walkers, N_par).
+        last_log_prob: array_like(float)
+            Log-probabilities at `coords`.
+        random_state: tuple
+            State of the sampler's random number generator.
+        iteration: int
+            Total number of steps taken (including those not stored).
+        """
+        state = self.load_state()
+        n_chunks = 0 if state is None else state['n_chunks']
+        if len(chain) > 0 :
+            _atomic_save(self._chunk_file('chain', n_chunks), np.asarray(chain, dtype=self.dtype))
+            _atomic_save(self._chunk_file('lnprob', n_chunks), np.asarray(log_prob))
+            n_chunks += 1
+        state = {'coords': np.array(coords), 'log_prob': np.array(last_log_prob),
+                 'random_state': random_state, 'iteration': iteration, 'n_chunks': n_chunks,
+                 'nwalkers': self.nwalkers, 'ndim': self.ndim, 'thin': self.thin}
+        tmp = self._state_file + '.tmp'
+        with open(tmp, 'wb') as f :
+            pickle.dump(state, f)
+        os.replace(tmp, self._state_file)
+
+    def _load(self, name):
+        state = self.load_state()
+        n_chunks = 0 if state is None else state['n_chunks']
+        if n_chunks == 0 :
+            shape = (0, self.nwalkers, self.ndim) if name == 'chain' else (0, self.nwalkers)
+            return np.zeros(shape, dtype=self.dtype)
+        # later chunks are leftovers of an interrupted save
+        return np.concatenate([np.load(self._chunk_file(name, i))
+                               for i in range(n_chunks)])
+
+    def get_chain(self):
+        """ Returns the stored chain, with shape (N_steps, N_walkers, N_par).
+        """
+        return self._load('chain')
+
+    def get_log_prob(self):
+        """ Returns the stored log-probabilities, with shape
+        (N_steps, N_walkers).
+        """
+        return self._load('lnprob')
+
+    def clear(self):
+        """ Deletes the stored chain.
+        """
+        for fname in glob.glob(os.path.join(self.directory, '*_[0-9][0-9][0-9][0-9][0-9].npy')) :
+            os.remove(fname)
+        if os.path.isfile(self._state_file) :
+            os.remove(self._state_file)
+
+
+def _atomic_save(fname, arr):
+    tmp = fname[:-4] + '.tmp.npy'
+    np.save(tmp, arr)
+    os.replace(tmp, fname)
@@ -0,0 +1,207 @@
+from __future__ import print_function
+import numpy as np
+
+
+class MapAccumulator(object):
+    """
+    Inputs of a `MapLike` (the data and noise variance of each frequency
+    channel) accumulated in inverse-variance form, one map at a time.
+
+    For each channel and split (e.g. half-missions or detector sets) only the
+    running sums of the inverse noise variance N^-1 and of the
+    inverse-variance-weighted data N^-1 d are kept, so that:
+    - maps of the same channel and split are co-added as they arrive;
+    - accumulators filled independently (e.g. by different processes) can
+      be merged;
+    - a channel or split can be added, replaced or removed without touching
+      the others;
+    - co-adds of any subset of the splits, and null (difference) maps
+      between two subsets, are recombined from the sums without reloading
+      the maps.
+
+    The output of `coadd` and `null` is in the inverse-variance form taken by
+    `MapLike` (see its `noiseivar` and `dataivar` fields), so no further
+    conversion is needed:
+
+        config_dict.update(acc.coadd(channels=channel_names))
+        ml = MapLike(config_dict, sky_model, instrument_model)
+
+    Only uncorrelated noise (see `noisevar` in `MapLike`) is supported.
+    """
+    def __init__(self, shape=None):
+        """
+        Parameters
+        ----------
+        shape: tuple(int)
+            Shape of the map of each channel, (N_pol, N_pix) or (N_pix,)
+            (optional, default=None, i.e. the shape of the first map added).
+        """
+        self.shape = None if shape is None else tuple(shape)
+        # channel -> split -> [N^-1, N^-1 d]
+        self.sums = {}
+
+    @property
+    def channels(self):
+        """ Channels with at least one map, in the order they were added.
+        """
+        return list(self.sums.keys())
+
+    def splits(self, channel=None):
+        """ Returns the splits of a channel, or those of any channel if
+        `channel` is None, in the order they were added.
+        """
+        chans = self.channels if channel is None else [channel]
+        out = []
+        for c in chans :
+            out += [s for s in self.sums[c] if s not in out]
+        return out
+
+    def add(self, channel, data, noisevar, split=0, replace=False):
+        """ Co-adds a map to a channel and split.
+
+        Parameters
+        ----------
+        channel: object
+            Name of the channel (any hashable, e.g. the frequency).
+        data: array_like(float)
+            Map with shape `shape`.
+        noisevar: array_like(float)
+            Noise variance of the map, with shape `shape`. Pixels with
+            infinite variance are not observed.
+        split: object
+            Name of the split (optional, default=0).
+        replace: bool
+            If True, the map replaces the current contents of the channel and
+            split instead of being co-added to them (optional, default=False).
+
+        Returns
+        -------
+        MapAccumulator
+            This object.
+        """
+        data = np.asarray(data, dtype=float)
+        noisevar = np.asarray(noisevar, dtype=float)
+        if data.shape != noisevar.shape :
+            raise ValueError("data and noisevar have different shapes %s and %s" %
+                             (str(data.shape), str(noisevar.shape)))
+        ivar = 1. / noisevar
+        return self._add(channel, split, ivar, np.where(ivar > 0, data * ivar, 0), replace)
+
+    def _add(self, channel, split, ivar, dataivar, replace=False):
+        if self.shape is None :
+            self.shape = ivar.shape
+        elif ivar.shape != self.shape :
+            raise ValueError("Map has shape %s, expected %s" % (str(ivar.shape), str(self.shape)))
+        sums = self.sums.setdefault(channel, {})
+        if replace or (split not in sums) :
+            sums[split] = [np.array(ivar, dtype=float), np.array(dataivar, dtype=float)]
+        else :
+            sums[split][0] += ivar
+            sums[split][1] += dataivar
+        return self
+
+    def remove(self, channel, split=None):
+        """ Removes a split of a channel, or the whole channel if `split` is
+        None.
+        """
+        if split is None :
+            del self.sums[channel]
+        else :
+            del self.sums[channel][split]
+            if len(self.sums[channel]) == 0 :
+                del self.sums[channel]
+        return self
+
+    def merge(self, other):
+        """ Co-adds the maps accumulated by another `MapAccumulator`, channel
+        by channel and split by split.
+        """
+        for channel, sums in other.sums.items() :
+            for split, (ivar, dataivar) in sums.items() :
+                self._add(channel, split, ivar, dataivar)
+        return self
+
+    def ivar(self, channels=None, splits=None):
+        """ Returns the inverse noise variance and inverse-variance-weighted
+        data of the co-add of a set of splits.
+
+        Parameters
+        ----------
+        channels: list
+            Channels to return, in the order of the bandpasses of the
+            instrument model (optional, default=None, i.e. `channels`).
+        splits: list
+            Splits to co-add (optional, default=None, i.e. all of them).
+            Channels without any of these splits are not observed.
+
+        Returns
+        -------
+        tuple(array_like(float))
+            N^-1 and N^-1 d, with shape `shape` + (N_freq,).
+        """
+        if channels is None :
+            channels = self.channels
+        ivar = np.zeros(self.shape + (len(channels),))
+        dataivar = np.zeros(self.shape + (len(channels),))
+        for ic, channel in enumerate(channels) :
+            if channel not in self.sums :
+                raise KeyError("No maps for channel %s" % str(channel))
+            for split, (iv, div) in self.sums[channel].items() :
+                if (splits is None) or (split in splits) :
+                    ivar[..., ic] += iv
+                    dataivar[..., ic] += div
+        return ivar, dataivar
+
+    def coadd(self, channels=None, splits=None):
+        """ Returns the inverse-variance co-add of a set of splits (e.g. all
+        of them, or all but one for a jackknife).
+
+        Parameters
+        ----------
+        channels: list
+            See `ivar`.
+        splits: list
+            See `ivar`.
+
+        Returns
+        -------
+        dict
+            Dictionary with fields 'noiseivar' and 'dataivar' (see `MapLike`),
+            with shape `shape` + (N_freq,). Unobserved pixels have zero
+            inverse variance.
+        """
+        ivar, dataivar = self.ivar(channels, splits)
+        return {'noiseivar': ivar, 'dataivar': dataivar}
+
+    def null(self, splits_a, splits_b, channels=None):
+        """ Returns the null map (d_A - d_B) / 2 of the co-adds d_A and d_B of
+        two disjoint sets of splits, with noise variance (N_A + N_B) / 4. The
+        sky signal cancels, while the noise has the same level as in the
+        co-add of all the splits, if these have the same depth.
+
+        Parameters
+        ----------
+        splits_a: list
+            Splits in the first co-add.
+        splits_b: list
+            Splits in the second co-add.
+        channels: list
+            See `ivar`.
+
+        Returns
+        -------
+        dict
+            Dictionary with fields 'noiseivar' and 'dataivar' (see `coadd`).
+            Pixels not observed in both co-adds are unobserved.
+        """
+        if len(set(splits_a) & set(splits_b)) > 0 :
+            raise ValueError("The two sets of splits must be disjoint")
+        ivar_a, dataivar_a = self.ivar(channels, splits_a)
+        ivar_b, dataivar_b = self.ivar(channels, splits_b)
+        # N^-1 = 4 N_A^-1 N_B^-1 / (N_A^-1 + N_B^-1),
+        # N^-1 d = 2 (N_B^-1 N_A^-1 d_A - N_A^-1 N_B^-1 d_B) / (N_A^-1 + N_B^-1)
+        observed = (ivar_a > 0) & (ivar_b > 0)
+        norm = np.where(observed, ivar_a + ivar_b, 1.)
+        return {'noiseivar': np.where(observed, 4 * ivar_a * ivar_b / norm, 0),
+                'dataivar': np.where(observed, 2 * (ivar_b * dataivar_a -
+                                                    ivar_a * dataivar_b) / norm, 0)}
@@ -8,6 +8,8 @@ class Component(object):
         """
         self.comp_name = comp_name
         self.sed = globals()[comp_name]
+        # derivatives of the SED with respect to its parameters, if available
+        self.sed_derivs = globals().get(comp_name + '_derivs')
         return
 
     def __call__(self, nu, args):
@@ -23,6 +25,28 @@ class Component(object):
         """
         return self.sed(nu, *args)
 
+    def derivatives(self, nu, args):
+        """ Method to compute the derivatives of the SED with respect to each
+        of its parameters.
+
+        Parameters
+        ----------
+        nu: float, or array_like(float)
+            Frequency or list of frequencies, in GHz, at which to evaluate the
+            derivatives.
+        args:  tuple
+            Tuple containing the positional parameters taken by the SED.
+
+        Returns
+        -------
+        array_like(float)
+            Array with shape (N_par, N_freq), with the derivatives ordered as
+            the parameters returned by `get_parameters`.
+        """
+        if self.sed_derivs is None:
+            raise NotImplementedError("No derivatives available for SED " + self.comp_name)
+        return self.sed_derivs(nu, *args)
+
     def get_description(self):
         print("Component SED name: ", self.comp_name)
         print(self.sed.__doc__, "\n --------------- \n")
@@ -52,6 +76,12 @@ def cmb(nu):
     return sed
 
 
+def cmb_derivs(nu):
+    """ Derivatives of the CMB SED (see `cmb`), which has no parameters.
+    """
+    return np.zeros((0,) + np.shape(nu))
+
+
 def syncpl(nu, nu_ref_s, beta_s):
     """ Function to compute synchrotron power law SED.
 
@@ -72,6 +102,16 @@ def syncpl(nu, nu_ref_s, beta_s):
     return sed
 
 
+def syncpl_derivs(nu, nu_ref_s, beta_s):
+    """ Derivatives of the synchrotron power law SED (see `syncpl`) with
+    respect to `nu_ref_s` and `beta_s`.
+    """
+    x = nu / nu_ref_s
+    sed = x ** beta_s
+    return np.array(np.broadcast_arrays(-beta_s * sed / nu_ref_s,
+                                        sed * np.log(x)))
+
+
 def sync_curvedpl(nu, nu_ref_s, beta_s, beta_c):
     """ Function to compute curved synchrotron power law SED.
 
@@ -93,6 +133,16 @@ def sync_curvedpl(nu, nu_ref_s, beta_s, beta_c):
     sed = x ** (beta_s + beta_c * np.log(nu / nu_ref_s))
     return sed
 
+
+def sync_curvedpl_derivs(nu, nu_ref_s, beta_s, beta_c):
+    """ Derivatives of the curved synchrotron power law SED (see
+    `sync_curvedpl`) with respect to `nu_ref_s`, `beta_s` and `beta_c`.
+    """
+    lx = np.log(nu / nu_ref_s)
+    sed = np.exp((beta_s + beta_c * lx) * lx)
+    return np.array(np.broadcast_arrays(-sed * (beta_s + 2 * beta_c * lx) / nu_ref_s,
+                                        sed * lx, sed * lx ** 2))
+
 def dustmbb(nu, nu_ref_d, beta_d, T_d):
     """ Function to compute modified blackbody dust SED.
 
@@ -116,3 +166,20 @@ def dustmbb(nu, nu_ref_d, beta_d, T_d):
     x_from = 0.0479924466 * nu_ref_d / T_d
     sed = (nu / nu_ref_d) ** (1 + beta_d) * (np.exp(x_from) - 1) / (np.exp(x_to) - 1)
     return sed
+
+
+def dustmbb_derivs(nu, nu_ref_d, beta_d, T_d):
+    """ Derivatives of the modified blackbody dust SED (see `dustmbb`) with
+    respect to `nu_ref_d`, `beta_d` and `T_d`.
+    """
+    x_to = 0.0479924466 * nu / T_d
+    x_from = 0.0479924466 * nu_ref_d / T_d
+    ex_to = np.exp(x_to)
+    ex_from = np.exp(x_from)
+    sed = (nu / nu_ref_d) ** (1 + beta_d) * (ex_from - 1) / (ex_to - 1)
+    # x e^x / (e^x - 1) for the two frequencies
+    g_to = x_to * ex_to / (ex_to - 1)
+    g_from = x_from * ex_from / (ex_from - 1)
+    return np.array(np.broadcast_arrays(sed * (g_from - 1 - beta_d) / nu_ref_d,
+                                        sed * np.log(nu / nu_ref_d),
+                                        sed * (g_to - g_from) / T_d))
@@ -4,27 +4,142 @@ class InstrumentModel(object) :
     """
     Instrument model.
     Currently this is mostly a glorified 2D array containing bandpasses for each frequency channel.
+    The bandpasses of all channels are stored in a packed (CSR-like) layout: the frequency nodes
+    and weights of all channels are concatenated into `nu_packed` and `bps_packed`, and the nodes
+    of channel i are those between `chan_offsets[i]` and `chan_offsets[i+1]`.
     """
 
-    def __init__(self,bandpasses) :
+    def __init__(self,bandpasses,shift_step=1E-3) :
         """
         Initializes an instrument model
-        bandpasses (array_like): an array of dictionaries for each frequency channel. Each dictionary should contain 2 fields: 'nu', and 'bps'. 'bps' should be an array with N values containing the spectral transmission in each of N adjacent frquency bins. 'nu' should be an array with N+1 values containing the edges of the frequency bins (in GHz). Note that we assume that the bandpasses are normalized for a constant spectrum in units of antenna temperature K_RJ.
+        bandpasses (array_like): an array of dictionaries for each frequency channel. Each dictionary should contain 2 fields: 'nu', and 'bps'. 'bps' should be an array with N values containing the spectral transmission in each of N adjacent frquency bins. 'nu' should be an array with N+1 values containing the edges of the frequency bins (in GHz). Note that we assume that the bandpasses are normalized for a constant spectrum in units of antenna temperature K_RJ. Channels may have different numbers of bins. A delta bandpass can be passed as a single-bin channel or as a single frequency in 'nu' (with 'bps' ignored). An optional field 'name' sets the name of the channel in its instrument parameters (see `get_parameters`, default is the channel index).
+        shift_step (float) : relative frequency step used to compute the derivatives of the SEDs with respect to frequency at each bandpass node (see `sed_moments`).
         """
         self.n_channels=len(bandpasses)
-        self.nu_arrs=np.array([0.5*(b['nu'][1:]+b['nu'][:-1]) for b in bandpasses])
-        self.bps_arrs=np.array([b['bps']*(b['nu'][1:]-b['nu'][:-1]) for b in bandpasses])
+        self.channel_names=[str(b.get('name',i)) for i,b in enumerate(bandpasses)]
+        nus=[]
+        bpss=[]
+        for b in bandpasses :
+            nu_edges=np.atleast_1d(np.asarray(b['nu'],dtype=float))
+            if len(nu_edges)==1 : #Delta bandpass
+                nu=nu_edges
+                bp=np.ones(1)
+            else :
+                nu=0.5*(nu_edges[1:]+nu_edges[:-1])
+                bp=np.atleast_1d(np.asarray(b['bps'],dtype=float))*(nu_edges[1:]-nu_edges[:-1])
+                #Drop bins that don't contribute
+                nu=nu[bp!=0]
+                bp=bp[bp!=0]
+                if len(nu)==0 :
+                    raise ValueError("Bandpass with zero transmission")
+                if np.all(nu==nu[0]) : #Collapse delta-like bandpasses to a single node
+                    nu=nu[:1]
+                    bp=np.array([np.sum(bp)])
+            #Normalize bandpasses
+            nus.append(nu)
+            bpss.append(bp/np.sum(bp))
+        self.chan_offsets=np.concatenate(([0],np.cumsum([len(nu) for nu in nus])))
+        self.nu_packed=np.concatenate(nus)
+        self.bps_packed=np.concatenate(bpss)
+        #Per-channel views of the packed arrays
+        self.nu_arrs=np.split(self.nu_packed,self.chan_offsets[1:-1])
+        self.bps_arrs=np.split(self.bps_packed,self.chan_offsets[1:-1])
+        #Auxiliary nodes nu-h and nu+h, and weights of the first and second derivatives in frequency
+        n_nodes=len(self.nu_packed)
+        h=shift_step*self.nu_packed
+        self.nu_shift_packed=np.concatenate([self.nu_packed,self.nu_packed-h,self.nu_packed+h])
+        self.bps_d1_packed=self.bps_packed/(2*h)
+        self.bps_d2_packed=self.bps_packed/h**2
+        self._node_slices=[slice(0,n_nodes),slice(n_nodes,2*n_nodes),slice(2*n_nodes,3*n_nodes)]
+        #Instrument parameters
+        self.gain_names=['gain_'+n for n in self.channel_names]
+        self.shift_names=['shift_'+n for n in self.channel_names]
+        self.par_ids={}
+        for i,(g,sh) in enumerate(zip(self.gain_names,self.shift_names)) :
+            self.par_ids[g]=('gain',i)
+            self.par_ids[sh]=('shift',i)
 
-        #Normalize bandpasses
-        for i in np.arange(self.n_channels) :
-            self.bps_arrs[i]/=np.sum(self.bps_arrs[i])
+    def get_parameters(self) :
+        """
+        Returns the names of all instrument parameters: the gain ('gain_<channel>', a factor multiplying the response of the channel, default 1) and bandpass shift ('shift_<channel>', in GHz, default 0) of each channel.
+        """
+        return self.gain_names+self.shift_names
+
+    def inst_vectors(self,instpar) :
+        """
+        Returns the gains and bandpass shifts of all channels (arrays of size N_channels, or None if no parameter of that kind is in `instpar`).
+        instpar (dict) : instrument parameters, keyed by name (see `get_parameters`). Missing channels take the default values.
+        """
+        gains=None
+        shifts=None
+        if instpar is None :
+            return gains,shifts
+        for name,value in instpar.items() :
+            kind,ic=self.par_ids[name]
+            if kind=='gain' :
+                if gains is None :
+                    gains=np.ones(self.n_channels)
+                gains[ic]=value
+            else :
+                if shifts is None :
+                    shifts=np.zeros(self.n_channels)
+                shifts[ic]=value
+        return gains,shifts
 
     def convolve_sed(self,sed,args=None,instpar=None) :
         """
         Convolves a given SED with each of the bandpasses, returning a vector, with one element per bandpass response.
         sed (function) : a function taking two arguments: an array of frequencies (in GHz) and an array of parameters that define the SED.
         args (array_like) : set of parameters to pass to 'sed'
-        instpar (array_like) : array of additional parameters associated with this instrument (e.g. bandpass or gain shifts). None are implemented yet.
+        instpar (dict) : instrument parameters (gains and bandpass shifts, see `get_parameters`).
+        """
+        return self.response(sed,args,*self.inst_vectors(instpar))
+
+    def response(self,sed,args=None,gains=None,shifts=None) :
+        """
+        Same as `convolve_sed`, with the instrument parameters passed as arrays of size N_channels (see `inst_vectors`).
+        """
+        if shifts is None :
+            #The SED is evaluated once over the nodes of all channels, and then summed over each channel
+            #Returns Ncomp x Nfreq array
+            f=self.integrate(sed(self.nu_packed,args))
+        else :
+            f=self.apply_shifts(self.sed_moments(sed(self.nu_shift_packed,args)),shifts)
+        if gains is not None :
+            f=f*gains
+        return f
+
+    def sed_moments(self,sed_shift_packed) :
+        """
+        Computes the integral over each bandpass of an SED and of its first and second derivatives with respect to frequency, which give the response to small bandpass shifts (see `apply_shifts`).
+        sed_shift_packed (array_like) : array with shape (..., 3*N_nodes) containing the SED evaluated at the nodes in `nu_shift_packed`.
+        Returns an array with shape (..., 3, N_channels).
+        """
+        s0,sm,sp=[sed_shift_packed[...,sl] for sl in self._node_slices]
+        out=np.empty(sed_shift_packed.shape[:-1]+(3,self.n_channels))
+        self.integrate(s0,out=out[...,0,:])
+        np.add.reduceat((sp-sm)*self.bps_d1_packed,self.chan_offsets[:-1],axis=-1,out=out[...,1,:])
+        np.add.reduceat((sp+sm-2*s0)*self.bps_d2_packed,self.chan_offsets[:-1],axis=-1,out=out[...,2,:])
+        return out
+
+    def apply_shifts(self,moments,shifts) :
+        """
+        Returns the response of each channel to an SED when all its frequency nodes are shifted by `shifts` (to second order in the shift).
+        moments (array_like) : array with shape (..., 3, N_channels) (see `sed_moments`).
+        shifts (array_like) : shift of each channel in GHz, broadcastable against (..., N_channels).
+        """
+        return moments[...,0,:]+shifts*(moments[...,1,:]+0.5*shifts*moments[...,2,:])
+
+    def integrate(self,sed_packed,out=None,overwrite_input=False) :
+        """
+        Integrates SEDs evaluated at the packed frequency nodes (`nu_packed`) over each bandpass.
+        sed_packed (array_like) : array with shape (..., N_nodes).
+        out (array_like) : array with shape (..., N_channels) where the result is stored (optional).
+        overwrite_input (bool) : if True, `sed_packed` is used as scratch space, and no temporary arrays are allocated.
+        Returns an array with shape (..., N_channels).
         """
-        #Returns Ncomp x Nfreq array
-        return np.transpose(np.array([np.sum(b*sed(n,args),axis=1) for n,b in zip(self.nu_arrs,self.bps_arrs)])) #TODO: check/optimize
+        if overwrite_input :
+            weighted=np.multiply(sed_packed,self.bps_packed,out=sed_packed)
+        else :
+            weighted=sed_packed*self.bps_packed
+        return np.add.reduceat(weighted,self.chan_offsets[:-1],axis=-1,out=out)
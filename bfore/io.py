@@ -0,0 +1,179 @@
+from __future__ import absolute_import, print_function
+import os
+import json
+import numpy as np
+from .maplike import MapLike
+
+
+def read_channel_map(fname, fields=None, nest=False):
+    """ Reads the map of a single frequency channel.
+
+    Parameters
+    ----------
+    fname: str
+        HEALPix FITS file, or .npy file containing an array with shape
+        (N_pix,) or (N_fields, N_pix). .npy files are memory-mapped.
+    fields: list(int)
+        Fields (FITS columns, or rows of the .npy array) to read (optional,
+        default=None, i.e. all the fields of a .npy file, or the first
+        column of a FITS file). E.g. fields=[1,2] selects Q and U from an
+        IQU map.
+    nest: bool
+        If True, FITS maps are returned in NESTED ordering, otherwise in RING
+        ordering (optional, default=False). .npy maps are returned as stored.
+
+    Returns
+    -------
+    array_like(float)
+        Array with shape (N_fields, N_pix).
+    """
+    if fname.endswith('.npy') :
+        m = np.atleast_2d(np.load(fname, mmap_mode='r'))
+        if fields is not None :
+            m = m[list(fields)]
+        return m
+    import healpy as hp
+    if fields is None :
+        fields = [0]
+    return np.atleast_2d(hp.read_map(fname, field=list(fields), dtype=None, nest=nest))
+
+
+def stack_channel_maps(fnames, out_file, fields=None, nest=False, dtype='float64',
+                       chunk_size=2**20):
+    """ Stacks single-channel maps into a memory-mapped .npy file with the
+    (N_pol, N_pix, N_freq) layout used by `MapLike`. Channels are read one at
+    a time and copied in chunks of pixels, so at most one channel is held in
+    memory.
+
+    Parameters
+    ----------
+    fnames: list(str)
+        Files with the maps of each frequency channel (see
+        `read_channel_map`).
+    out_file: str
+        Path of the output .npy file.
+    fields: list(int)
+        Fields to read from each file (see `read_channel_map`).
+    nest: bool
+        Ordering of the FITS maps (see `read_channel_map`).
+    dtype: str
+        Data type of the output array (optional, default='float64').
+    chunk_size: int
+        Number of pixels copied at a time (optional, default=2**20).
+
+    Returns
+    -------
+    numpy.memmap
+        Read-only memory map with shape (N_pol, N_pix, N_freq).
+    """
+    out = None
+    for ic, fname in enumerate(fnames) :
+        m = read_channel_map(fname, fields=fields, nest=nest)
+        if out is None :
+            out = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype,
+                                            shape=m.shape + (len(fnames),))
+        elif m.shape != out.shape[:2] :
+            raise ValueError("Map in %s has shape %s, expected %s" %
+                             (fname, str(m.shape), str(out.shape[:2])))
+        for i0 in range(0, m.shape[1], chunk_size) :
+            out[:, i0:i0 + chunk_size, ic] = m[:, i0:i0 + chunk_size]
+        del m
+    out.flush()
+    del out
+    return np.load(out_file, mmap_mode='r')
+
+
+def load_maplike(config_dict, sky_model, instrument_model, data_files, noisevar_files,
+                 storage_dir, fields=None, dtype='float64', lean=True):
+    """ Builds a `MapLike` from per-channel maps stored on disk, without
+    reading all of them into memory.
+
+    The data and noise variance maps are stacked into memory-mapped files in
+    `storage_dir` (see `stack_channel_maps`), and the arrays derived from them
+    by `MapLike` are also memory-mapped there, so the likelihood reads the
+    maps in chunks of pixels (see `MapLike.pixel_chunks`). Files already
+    stacked in `storage_dir` (e.g. by a previous job) are reused if they were
+    stacked from the same files, fields, ordering and data type, and are
+    newer than the files.
+
+    Unless `config_dict` sets 'compress_noise', pixels are not grouped by
+    noise pattern (see `MapLike.setup_noise_groups`), since that reads the
+    whole noise variance into memory.
+
+    Parameters
+    ----------
+    config_dict: dict
+        Likelihood configuration (see `MapLike`), without 'data' and
+        'noisevar'.
+    sky_model: SkyModel
+        Sky model.
+    instrument_model: InstrumentModel
+        Instrument model, with one bandpass per file.
+    data_files: list(str)
+        Files with the data maps of each channel (HEALPix FITS or .npy).
+    noisevar_files: list(str)
+        Files with the noise variance maps of each channel.
+    storage_dir: str
+        Directory for the memory-mapped files.
+    fields: list(int)
+        Fields to read from each file (see `read_channel_map`), e.g. [1,2]
+        for Q and U. FITS maps are read in the ordering given by the 'nest'
+        field of `config_dict`.
+    dtype: str
+        Data type of the stacked maps and of the arrays derived from them
+        (optional, default='float64').
+    lean: bool
+        See `MapLike` (optional, default=True).
+
+    Returns
+    -------
+    MapLike
+        Likelihood for the maps.
+    """
+    if not os.path.isdir(storage_dir) :
+        os.makedirs(storage_dir)
+    nest = config_dict.get('nest', False)
+    arrays = {}
+    for name, fnames in [('data', data_files), ('noisevar', noisevar_files)] :
+        if len(fnames) != instrument_model.n_channels :
+            raise ValueError("Got %d %s files for %d channels" %
+                             (len(fnames), name, instrument_model.n_channels))
+        fname = os.path.join(storage_dir, name + '_maps.npy')
+        info_file = os.path.join(storage_dir, name + '_maps.json')
+        info = {'files': [os.path.abspath(f) for f in fnames],
+                'fields': None if fields is None else [int(f) for f in fields],
+                'nest': bool(nest), 'dtype': np.dtype(dtype).str}
+        if _is_newer(fname, fnames) and (_read_info(info_file) == info) :
+            arrays[name] = np.load(fname, mmap_mode='r')
+        else :
+            if os.path.isfile(info_file) :
+                os.remove(info_file)
+            arrays[name] = stack_channel_maps(fnames, fname, fields=fields,
+                                              nest=nest, dtype=dtype)
+            with open(info_file + '.tmp', 'w') as f :
+                json.dump(info, f)
+            os.replace(info_file + '.tmp', info_file)
+    config = dict(config_dict)
+    config.update(arrays)
+    config.update({'storage_dir': storage_dir, 'dtype': dtype, 'lean': lean})
+    return MapLike(config, sky_model, instrument_model)
+
+
+def _read_info(fname):
+    """ Returns the description of the inputs of a stacked file, or None if
+    there is none.
+    """
+    if not os.path.isfile(fname) :
+        return None
+    with open(fname) as f :
+        return json.load(f)
+
+
+def _is_newer(fname, sources):
+    """ Checks whether `fname` exists and is newer than all the files in
+    `sources`.
+    """
+    if not os.path.isfile(fname) :
+        return False
+    mtime = os.path.getmtime(fname)
+    return all(os.path.getmtime(s) <= mtime for s in sources)
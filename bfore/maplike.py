@@ -1,10 +1,21 @@
 from __future__ import absolute_import, print_function
+import os
+import tempfile
 import numpy as np
-import healpy as hp
-from copy import deepcopy
+from copy import deepcopy, copy
 from .skymodel import SkyModel
 from .instrumentmodel import InstrumentModel
-from scipy import stats, linalg
+from .solvers import BlockFactor
+from .cache import LRUCache, DiskCache
+from .sedtable import SEDTable
+from .parallel import share_array, release_array
+from .profiling import Stats, timer
+
+# healpy and scipy are only imported by the methods that need them, so that
+# importing the likelihood only requires numpy
+
+#: Value of pixels with no data (same as `healpy.UNSEEN`)
+UNSEEN = -1.6375e+30
 
 class MapLike(object) :
     """
@@ -33,34 +44,191 @@ class MapLike(object) :
             This contains frequencies of the data, the data mean, the data
             variance, and which spectral parameters to sample.
             Fields this dictionary must have are:
-            - data: data 2 or 3-D array [N_pol,N_pix,N_freq]
+            - data: data 2 or 3-D array [N_pol,N_pix,N_freq], or a stack of
+                 N_sim realizations of it [N_sim,N_pol,N_pix,N_freq] (e.g.
+                 simulations) sharing the same noise variance. The F matrix,
+                 amplitude covariances and their factorizations are then
+                 computed once for all realizations, and the likelihood, its
+                 gradient and Fisher matrix, the amplitudes and the chi2 are
+                 returned with a leading N_sim axis (see `realization` for
+                 a likelihood for one of them). Not supported together with
+                 `noisecov`.
             - noisevar: noise variance of the data [N_pol,N_pix,N_freq]
-            - var_pars: which parameters to vary (list(str)).
-            - fixed_pars: which parameters are fixed (dictionary with fixed values)
+            - noisecov: (N_pix,N_freq,2,2) covariance of the Q and U noise in
+                 each pixel and channel, to be used instead of `noisevar` for
+                 (Q,U) data with shape (2,N_pix,N_freq) and correlated Q/U
+                 noise. The amplitudes of Q and U in each pixel are then
+                 solved for jointly (see `get_amplitude_covariance`). If the
+                 off-diagonal terms vanish this is the same as passing the
+                 diagonal as `noisevar`.
+            - noiseivar, dataivar: inverse noise variance N^-1 and inverse-
+                 variance-weighted data N^-1 d, with shape [N_pol,N_pix,N_freq],
+                 to be passed instead of `data` and `noisevar` (e.g. from
+                 `bfore.coadd.MapAccumulator`). Channels and pixels with no
+                 data have zero inverse variance. They are stored as they are
+                 (see `dtype` and `storage_dir`), and the likelihood is built
+                 in `lean` mode. Not supported together with `noisecov` or a
+                 stack of realizations.
+            - var_pars: which parameters to vary (list(str)). These may include
+                 instrument parameters (per-channel gains and bandpass shifts,
+                 see `InstrumentModel.get_parameters`).
+            - fixed_pars: which parameters are fixed (dictionary with fixed values).
+                 Instrument parameters that are neither varied nor fixed take
+                 their default values (unit gain, no shift).
             - var_prior_mean: array with the mean value of the prior for each
                  parameter. This value will also be used to initialize any
                  sampler/minimizer.
             - var_prior_width: array with the width of the prior for each parameter.
             - var_prior_type: array with the prior type for each parameter. Allowed
                  values are 'gauss', 'tophat' or 'none'.
+            Optional fields:
+            - compress_noise: if True, pixels sharing the same noise
+                 pattern are grouped and the marginal likelihood is computed
+                 from per-group sufficient statistics (see `setup_noise_groups`).
+                 By default (None) this is done unless `lean` or `storage_dir`
+                 are set, since finding the groups reads the whole noise
+                 variance into memory.
+            - sed_cache_size: maximum number of bandpass-convolved SEDs cached
+                 for each component (default 128). Set to 0 to disable the
+                 cache (see `f_matrix`). Looking up each component costs
+                 about as much as evaluating a simple SED, so when the
+                 parameters of all components change at every call (e.g. in
+                 emcee) disabling the cache is ~20% faster.
+            - sed_grids: dictionary with a grid of values for some of the
+                 varied parameters. If present, the convolved SEDs of all the
+                 components whose varied parameters have grids are tabulated
+                 and interpolated (see `tabulate_seds`).
+            - sed_table_tol: maximum relative interpolation error of the SED
+                 tables (default 1E-3).
+            - sed_table_cache: directory (or `bfore.cache.DiskCache`) of a
+                 persistent cache of SED tables shared by all processes and
+                 jobs (default None). Tables built with the same bandpasses,
+                 SEDs, fixed parameters and grids are then read from it
+                 instead of being recomputed.
+            - nside: HEALPix resolution of the maps. By default it is derived
+                 from the number of pixels. Required if `pixel_ids` is passed.
+            - pixel_ids: HEALPix index of each pixel in `data`, with shape
+                 (N_pix,), for partial-sky data passed as compact arrays
+                 containing only the observed pixels (default None, i.e. full
+                 maps).
+            - mask: boolean array with shape (N_pix,), False for pixels that
+                 should be ignored (default None). These pixels, and pixels
+                 with finite noise variance in fewer channels than there are
+                 components in any polarization (whose amplitudes are not
+                 constrained), are dropped when the likelihood is built, so
+                 that memory and computing time scale with the number of
+                 observed pixels (see `to_healpix` to recover full maps).
+                 Channels with infinite variance in the remaining pixels get
+                 zero weight.
+            - nest: set to True if the maps are in NESTED ordering (default
+                 False, i.e. RING).
+            - memory_budget: approximate maximum size (in bytes) of the
+                 temporary arrays allocated when evaluating the likelihood
+                 pixel by pixel (default 2**28, i.e. 256 MB). Larger maps are
+                 processed in chunks of pixels (see `pixel_chunks`).
+            - lean: if True, `data` and `noisevar` are dropped after computing
+                 `noiseivar` and `dataivar`, which are all the likelihood
+                 needs (default False). `chi2` then uses the precomputed
+                 per-pixel data norm `datanorm`, and loses precision when the
+                 residuals are much smaller than the signal.
+            - dtype: data type used to store `noiseivar` and `dataivar`
+                 (default 'float64'). With 'float32' their memory footprint
+                 is halved, while all reductions are still accumulated in
+                 float64. The likelihood then agrees with the float64 one to
+                 a relative precision of ~1E-6, and its differences between
+                 nearby parameter values, its gradient and Fisher matrix to
+                 better than 1E-3 (see `tests/test_maplike.py`).
+            - storage_dir: if not None, `noiseivar`, `dataivar` and
+                 `datanorm` are stored as memory-mapped .npy files with unique
+                 names in this directory instead of in memory (default None). Together with
+                 memory-mapped `data` and `noisevar` (see `bfore.io`) and
+                 `lean`, this allows working with maps larger than the
+                 available memory, which are then read in chunks of pixels.
+            - profile: if True, the number of calls and the time spent in
+                 each stage of the likelihood ('f_matrix', 'sed',
+                 'covariance', 'solve', 'quadratic' and 'prior') are recorded
+                 in `stats` (a `bfore.profiling.Stats` object, None if
+                 profiling is off, the default). Calls made by copies of this
+                 object in other processes are not recorded.
         """
         self.sky = sky_model
         self.inst = instrument_model
+        self.compress_noise = None
+        self.sed_cache_size = 128
+        self.sed_grids = None
+        self.sed_table_tol = 1E-3
+        self.sed_table_cache = None
+        self.nside = None
+        self.nest = False
+        self.pixel_ids = None
+        self.pol_ids = None
+        self.mask = None
+        self.shared_backend = None
+        self.memory_budget = 2**28
+        self.lean = False
+        self.dtype = 'float64'
+        self.storage_dir = None
+        self.profile = False
+        self.data = None
+        self.noisevar = None
+        self.noisecov = None
+        self.noiseivar = None
+        self.dataivar = None
+        self.n_sims = None
         self.__dict__.update(config_dict)
+        self.stats = Stats() if self.profile else None
         self.check_parameters()
-        if ((self.inst.n_channels!=self.data.shape[-1]) or
-            (self.inst.n_channels!=self.noisevar.shape[-1])) :
-            raise ValueError("Data does not conform to instrument parameters")
-        if self.data.ndim==3 :
-            shp=self.data.shape
-            self.n_pol=shp[0]
-            self.data=self.data.reshape([shp[0]*shp[1],shp[2]]) #Flatten first two dimensions
-            self.noisevar=self.noisevar.reshape([shp[0]*shp[1],shp[2]])
+        # flat parameter vector -> SEDs at the bandpass nodes
+        self.sed_plan = self.sky.compile(self.var_pars, self.fixed_pars, self.inst.nu_packed)
+        self._sed_buffer = np.empty([self.sky.ncomps, len(self.inst.nu_packed)])
+        self._sed_plan_shift = None
+        # inst_var_ids -> list of (index in var_pars, 'gain' or 'shift', channel)
+        self.inst_var_ids = [(k,) + self.inst.par_ids[p] for k, p in enumerate(self.var_pars)
+                             if p in self.inst.par_ids]
+        self.fixed_inst_pars = {p: v for p, v in self.fixed_pars.items()
+                                if p in self.inst.par_ids}
+        if (self.pixel_ids is not None) and (self.nside is None) :
+            raise ValueError("nside must be passed together with pixel_ids")
+        if self.noiseivar is not None :
+            self._check_ivar()
+            noiseivar = self.noiseivar
+            dataivar = self.dataivar
+            self._store_ivar(lambda rows: (noiseivar[rows], dataivar[rows]), dataivar.shape)
         else :
-            self.n_pol=1
-        self.noiseivar=1./self.noisevar #Inverse variance
-        self.dataivar=self.data*self.noiseivar #Inverse variance-weighted data
-        self.npix=len(self.data)
+            if (self.data is None) or ((self.noisevar is None) and (self.noisecov is None)) :
+                raise ValueError("data and noisevar (or noisecov) must be passed")
+            if self.noisecov is not None :
+                if np.ndim(self.data)==4 :
+                    raise ValueError("noisecov is not supported for a stack of realizations")
+                self._check_noisecov()
+            elif np.ndim(self.data)==np.ndim(self.noisevar)+1 :
+                self._stack_realizations()
+            self._drop_unobserved()
+            if ((self.inst.n_channels!=self.data.shape[self.noisevar.ndim-1]) or
+                (self.inst.n_channels!=self.noisevar.shape[-1])) :
+                raise ValueError("Data does not conform to instrument parameters")
+            if self.noisevar.ndim==3 :
+                shp=self.noisevar.shape
+                self.n_pol=shp[0]
+                #Flatten first two dimensions
+                self.data=self.data.reshape((shp[0]*shp[1],)+self.data.shape[2:])
+                self.noisevar=self.noisevar.reshape([shp[0]*shp[1],shp[2]])
+            else :
+                self.n_pol=1
+            self.npix=len(self.data)
+            if (self.pixel_ids is not None) and (len(self.pixel_ids)!=self.npix) :
+                self.pixel_ids=np.tile(self.pixel_ids,self.n_pol)
+            if self.noisecov is not None :
+                self.noiseivar=self._new_array('noiseivar',self.noisevar.shape,self.dtype) #Inverse variance
+                self.dataivar=self._new_array('dataivar',self.data.shape,self.dtype) #Inverse variance-weighted data
+                self.datanorm=self._new_array('datanorm',(self.npix,),float) #d^T N^-1 d in each pixel
+                self._invert_noisecov()
+            else :
+                self._store_ivar(self._data_ivar,self.data.shape)
+        if self.lean :
+            self.data=None
+            self.noisevar=None
+            self.noisecov=None
         self.var_prior_mean=np.array(self.var_prior_mean)
         self.var_prior_width=np.array(self.var_prior_width)
         self.id_tophat=np.array([t=='tophat' for t in self.var_prior_type])
@@ -72,11 +240,727 @@ class MapLike(object) :
         self.var_prior_iwidthg=1./self.var_prior_widthg
 
         # numer of degrees of freedom
+        self.set_dof()
+
+        # group pixels by noise pattern
+        self.noise_groups = None
+        if self.compress_noise is None :
+            self.compress_noise = not (self.lean or (self.storage_dir is not None))
+        if self.compress_noise :
+            self.setup_noise_groups()
+
+        # one cache of convolved SEDs per component
+        if self.sed_cache_size :
+            self.sed_caches = [LRUCache(self.sed_cache_size) for c in self.sky.components]
+        else :
+            self.sed_caches = None
+
+        # tabulated SEDs
+        self.sed_tables = None
+        if self.sed_grids is not None :
+            self.tabulate_seds(self.sed_grids, tol=self.sed_table_tol,
+                               cache=self.sed_table_cache)
+
+    def set_dof(self):
+        """ Method to compute the number of degrees of freedom of the fit.
+        """
         n_amps = self.npix * self.sky.ncomps
         n_spec = len(self.var_pars)
         n_data = self.npix * self.inst.n_channels
         self.dof = float(n_data - n_amps - n_spec)
 
+    def get_nside(self):
+        """ Returns the HEALPix resolution of the maps.
+        """
+        if self.nside is None :
+            self.nside = _npix2nside(self.npix // self.n_pol)
+        return self.nside
+
+    def _drop_unobserved(self):
+        """ Method to remove the pixels that are masked (see `mask`) or are
+        observed (i.e. have finite noise variance) in fewer channels than
+        there are components in any polarization from the input arrays, and
+        to record the HEALPix indices of the remaining ones in `pixel_ids`.
+        The amplitudes of the dropped pixels could not be constrained.
+        """
+        # read in chunks of pixels, in case the inputs are memory-mapped
+        var = self.noisevar if self.noisevar is not None else self.noiseivar
+        n_pix = var.shape[-2]
+        step = max(1, self.memory_budget * n_pix // (8 * var.size))
+        observed = np.empty(n_pix, dtype=bool)
+        for i0 in range(0, n_pix, step) :
+            if self.noisevar is not None :
+                n_seen = np.sum(~np.isinf(self.noisevar[..., i0:i0 + step, :]), axis=-1)
+            else :
+                n_seen = np.sum(self.noiseivar[..., i0:i0 + step, :] != 0, axis=-1)
+            n_seen = n_seen.reshape([-1, n_seen.shape[-1]])
+            observed[i0:i0 + step] = np.all(n_seen >= self.sky.ncomps, axis=0)
+        if self.mask is not None :
+            observed &= np.asarray(self.mask, dtype=bool)
+        if np.all(observed) :
+            return
+        n_pix = len(observed)
+        if self.pixel_ids is None :
+            if self.nside is None :
+                self.nside = _npix2nside(n_pix)
+            self.pixel_ids = np.arange(n_pix)
+        self.pixel_ids = np.asarray(self.pixel_ids)[observed]
+        for name in ['data', 'noisevar', 'noiseivar', 'dataivar'] :
+            arr = getattr(self, name)
+            if arr is not None :
+                # pixels are the second-to-last axis, or the third-to-last one
+                # for a stack of realizations
+                axis = arr.ndim - (3 if (self.n_sims is not None and name == 'data') else 2)
+                setattr(self, name, self._take_observed(name, arr, observed, axis))
+        if self.noisecov is not None :
+            self.noisecov = self._take_observed('noisecov', self.noisecov, observed, 0)
+        self.mask = None
+
+    def _take_observed(self, name, arr, observed, axis):
+        """ Returns the observed pixels of `arr` along `axis`. Memory-mapped
+        arrays are copied in chunks of pixels into a new array (see
+        `_new_array`), so that they are never read into memory as a whole.
+        """
+        index = (slice(None),) * axis
+        if not isinstance(arr, np.memmap) :
+            return np.asarray(arr)[index + (observed,)]
+        ids = np.where(observed)[0]
+        out = self._new_array(name, arr.shape[:axis] + (len(ids),) + arr.shape[axis + 1:], arr.dtype)
+        step = max(1, self.memory_budget * arr.shape[axis] // max(arr.nbytes, 1))
+        for i0 in range(0, len(ids), step) :
+            out[index + (slice(i0, i0 + step),)] = arr[index + (ids[i0:i0 + step],)]
+        return out
+
+    def _check_ivar(self):
+        """ Method to check inverse-variance inputs (`noiseivar` and
+        `dataivar`, see `__init__`), which are used instead of `data` and
+        `noisevar`, and to flatten them into rows.
+        """
+        if (self.data is not None) or (self.noisevar is not None) or (self.noisecov is not None) :
+            raise ValueError("Pass either noiseivar and dataivar, or data and noisevar/noisecov")
+        if (self.dataivar is None) or (np.shape(self.dataivar) != np.shape(self.noiseivar)) :
+            raise ValueError("noiseivar and dataivar must have the same shape")
+        self._drop_unobserved()
+        if self.inst.n_channels != self.noiseivar.shape[-1] :
+            raise ValueError("Data does not conform to instrument parameters")
+        self.n_pol = self.noiseivar.shape[0] if self.noiseivar.ndim == 3 else 1
+        self.noiseivar = self.noiseivar.reshape([-1, self.noiseivar.shape[-1]])
+        self.dataivar = self.dataivar.reshape([-1, self.dataivar.shape[-1]])
+        self.npix = len(self.noiseivar)
+        if (self.pixel_ids is not None) and (len(self.pixel_ids) != self.npix) :
+            self.pixel_ids = np.tile(self.pixel_ids, self.n_pol)
+        self.lean = True
+
+    def _data_ivar(self, rows):
+        """ Returns the inverse noise variance and the inverse-variance-weighted
+        data of some rows of `noisevar` and `data`.
+        """
+        nivar = 1. / self.noisevar[rows]
+        if self.n_sims is not None :
+            return nivar, self.data[rows] * nivar[:, :, None]
+        return nivar, self.data[rows] * nivar
+
+    def _store_ivar(self, get_rows, shape):
+        """ Method to store `noiseivar`, `dataivar` and, in `lean` mode,
+        `datanorm`, in chunks of rows.
+
+        Parameters
+        ----------
+        get_rows: function
+            Function returning N^-1 and N^-1 d for a slice of rows.
+        shape: tuple
+            Shape of `dataivar`.
+        """
+        self.noiseivar = self._new_array('noiseivar', shape[:2], self.dtype) #Inverse variance
+        self.dataivar = self._new_array('dataivar', shape, self.dtype) #Inverse variance-weighted data
+        self.datanorm = None #d^T N^-1 d in each pixel
+        if self.lean :
+            self.datanorm = self._new_array('datanorm', (self.npix,) + shape[2:], float)
+        self.noiseivar_qu = None #Q-U element of the inverse noise covariance
+        for rows in self.pixel_chunks(8 * 3 * self.inst.n_channels * (self.n_sims or 1)) :
+            nivar, dnivar = get_rows(rows)
+            self.noiseivar[rows] = nivar
+            if self.n_sims is not None :
+                nivar = nivar[:, :, None]
+            # unobserved channels may contain anything
+            self.dataivar[rows] = np.where(nivar > 0, dnivar, 0)
+            if self.lean :
+                # consistent with the stored (possibly rounded) arrays
+                dnivar = np.asarray(self.dataivar[rows], dtype=float)
+                ivar = np.asarray(self.noiseivar[rows], dtype=float)
+                if self.n_sims is not None :
+                    ivar = ivar[:, :, None]
+                self.datanorm[rows] = np.sum(dnivar ** 2 / np.where(ivar > 0, ivar, np.inf), axis=1)
+
+    def _stack_realizations(self):
+        """ Method to store a stack of data realizations with the realization
+        as the last axis, (N_pol,N_pix,N_freq,N_sim), so that the arrays are
+        indexed by row in the same way as for a single data set.
+        """
+        self.n_sims = len(self.data)
+        self.data = np.moveaxis(self.data, 0, -1)
+
+    def realization(self, isim):
+        """ Returns the likelihood of one of the stacked data realizations.
+        The noise arrays (and the per-realization data arrays, as views) are
+        shared with this object.
+
+        Parameters
+        ----------
+        isim: int
+            Index of the realization.
+
+        Returns
+        -------
+        MapLike
+            Likelihood for a single data set.
+        """
+        if self.n_sims is None :
+            raise ValueError("This likelihood does not hold a stack of realizations")
+        ml = copy(self)
+        ml.n_sims = None
+        for name in ['data', 'dataivar', 'datanorm'] :
+            if getattr(self, name) is not None :
+                setattr(ml, name, getattr(self, name)[..., isim])
+        if self.noise_groups is not None :
+            ml.noise_groups = dict(self.noise_groups, ddt=self.noise_groups['ddt'][isim])
+        ml.shared_backend = None
+        if self.sed_caches is not None :
+            ml.sed_caches = [LRUCache(self.sed_cache_size) for c in self.sky.components]
+        return ml
+
+    def _sims_first(self, arr):
+        """ Moves the realization axis of a per-row data array (see
+        `_stack_realizations`) to the front.
+        """
+        if self.n_sims is None :
+            return arr
+        return np.moveaxis(arr, -1, 0)
+
+    def _data_projection(self, f_matrix, rows):
+        """ Returns y = F N^-1 d for some rows of the data arrays, with shape
+        (N_pix,N_comp), or (N_pix,N_comp,N_sim) for a stack of realizations,
+        so that all of them are solved for with the same factorization.
+        """
+        if self.n_sims is None :
+            return np.dot(self.dataivar[rows], f_matrix.T)
+        return np.matmul(f_matrix, self.dataivar[rows])
+
+    def _check_single(self, name):
+        if self.n_sims is not None :
+            raise ValueError("%s is not supported for a stack of realizations "
+                             "(see `realization`)" % name)
+
+    def get_pixel_ids(self):
+        """ Returns the HEALPix pixel index of each row of the (flattened)
+        data arrays.
+
+        Returns
+        -------
+        array_like(int)
+            Array with shape (N_pol*N_pix,).
+        """
+        if self.pixel_ids is None :
+            return np.tile(np.arange(self.npix // self.n_pol), self.n_pol)
+        return self.pixel_ids
+
+    def get_pol_ids(self):
+        """ Returns the polarization channel of each row of the (flattened)
+        data arrays.
+
+        Returns
+        -------
+        array_like(int)
+            Array with shape (N_pol*N_pix,).
+        """
+        if self.pol_ids is None :
+            return np.repeat(np.arange(self.n_pol), self.npix // self.n_pol)
+        return self.pol_ids
+
+    def to_healpix(self, values, fill=UNSEEN):
+        """ Scatters per-row values (e.g. the amplitudes returned by
+        `get_amplitude_mean`) back into full HEALPix maps.
+
+        Parameters
+        ----------
+        values: array_like
+            Array with shape (N_pol*N_pix, ...).
+        fill: float
+            Value given to the pixels with no data (optional, default
+            `UNSEEN`, i.e. `hp.UNSEEN`).
+
+        Returns
+        -------
+        array_like
+            Array with shape (N_pol, 12*nside**2, ...), or (12*nside**2, ...)
+            if N_pol=1.
+        """
+        values = np.asarray(values)
+        if len(values) != self.npix :
+            raise ValueError("Expected %d rows, got %d" % (self.npix, len(values)))
+        npix_full = 12 * self.get_nside() ** 2
+        out = np.full((self.n_pol, npix_full) + values.shape[1:], fill,
+                      dtype=np.result_type(values, fill))
+        out[self.get_pol_ids(), self.get_pixel_ids()] = values
+        if self.n_pol == 1 :
+            return out[0]
+        return out
+
+    def get_patch_ids(self, nside_spec):
+        """ Returns the index of the low-resolution pixel (sky patch) each
+        row of the data arrays belongs to.
+
+        Parameters
+        ----------
+        nside_spec: int
+            HEALPix resolution defining the patches. Patch indices follow the
+            same ordering as the maps (see `nest`).
+
+        Returns
+        -------
+        array_like(int)
+            Array with shape (N_pol*N_pix,).
+        """
+        nside = self.get_nside()
+        if nside_spec > nside or nside % nside_spec :
+            raise ValueError("nside_spec must divide the resolution of the maps")
+        ipix = self.get_pixel_ids()
+        if not self.nest :
+            import healpy as hp
+            ipix = hp.ring2nest(nside, ipix)
+        ipatch = ipix // (nside // nside_spec) ** 2
+        if not self.nest :
+            ipatch = hp.nest2ring(nside_spec, ipatch)
+        return ipatch
+
+    def degrade(self, nside_out):
+        r""" Returns a likelihood for the data degraded to a lower resolution.
+
+        Each low-resolution pixel P combines the pixels p it contains, channel
+        by channel, weighted by their inverse noise variance:
+
+        ..math::
+            N_P^{-1} = \sum_{p\in P} N_p^{-1}
+
+            d_P = N_P \sum_{p\in P} N_p^{-1} d_p
+
+        so that d_P is the optimal estimate of the (locally constant) sky in
+        P, with noise covariance N_P. Averaging the maps and the variances
+        (`hp.ud_grade`) would instead give the wrong noise. Correlated Q/U
+        noise (see `noisecov`) is combined in the same way, with 2x2 blocks.
+        Pixels with no data at the original resolution are ignored.
+
+        Parameters
+        ----------
+        nside_out: int
+            Resolution of the degraded maps. Must divide the resolution of
+            the maps.
+
+        Returns
+        -------
+        MapLike
+            Likelihood for the degraded data, with the same parameters,
+            priors and options as this one (and sharing its SED tables).
+        """
+        self._check_single('degrade')
+        # ids -> index of (polarization, low-resolution pixel) of each row
+        n_low = 12 * nside_out ** 2
+        ids = self.get_pol_ids() * n_low + self.get_patch_ids(nside_out)
+        keys, ids = np.unique(ids, return_inverse=True)
+        ids = np.ravel(ids)
+        pol_low = keys // n_low
+        pix_low = keys[pol_low == 0] % n_low
+        if ((len(keys) != self.n_pol * len(pix_low)) or
+            np.any(keys % n_low != np.tile(pix_low, self.n_pol))) :
+            raise ValueError("All polarization channels must cover the same pixels")
+        ivar = _sum_rows(self.noiseivar, ids, len(keys))
+        data_ivar = _sum_rows(self.dataivar, ids, len(keys))
+        config = {k: getattr(self, k) for k in ['var_pars', 'fixed_pars', 'var_prior_mean',
+                                                'var_prior_width', 'var_prior_type',
+                                                'compress_noise', 'sed_cache_size', 'nest',
+                                                'memory_budget', 'dtype', 'profile']}
+        config.update(nside=nside_out, pixel_ids=pix_low)
+        if self.noiseivar_qu is not None :
+            n_pix = self.npix // 2
+            ivar_qu = _sum_rows(self.noiseivar_qu, ids[:n_pix], len(pix_low))
+            ivar_q, ivar_u = ivar[:len(pix_low)], ivar[len(pix_low):]
+            det = ivar_q * ivar_u - ivar_qu ** 2
+            cov = np.array([[ivar_u, -ivar_qu], [-ivar_qu, ivar_q]]) / det
+            # cov -> (N_pix,N_freq,2,2)
+            config['noisecov'] = np.transpose(cov, axes=[2, 3, 0, 1])
+            data_ivar = data_ivar.reshape([2, len(pix_low), -1])
+            config['data'] = np.einsum("abpf,bpf->apf", cov, data_ivar)
+        else :
+            with np.errstate(divide='ignore', invalid='ignore') :
+                noisevar = 1. / ivar
+                data = np.where(ivar > 0, data_ivar * noisevar, 0)
+            shape = (len(pix_low), -1) if self.n_pol == 1 else (self.n_pol, len(pix_low), -1)
+            config['data'] = data.reshape(shape)
+            config['noisevar'] = noisevar.reshape(shape)
+        ml = MapLike(config, self.sky, self.inst)
+        if self.sed_tables is not None :
+            ml.sed_tables = self.sed_tables
+        return ml
+
+    def select_pixels(self, rows, compress=True):
+        """ Returns a likelihood restricted to a subset of the rows of the
+        data arrays. All other attributes are shared with this object.
+
+        Parameters
+        ----------
+        rows: slice or array_like(int)
+            Rows to select. If a slice is passed, the data arrays of the new
+            object are views of the arrays of this one, and no data is copied.
+            Otherwise the selected rows are copied.
+            With correlated Q/U noise (see `noisecov`), the Q rows of the
+            selected pixels must come first, followed by their U rows in the
+            same order.
+        compress: bool
+            If True, the noise groups of the new object are computed
+            (see `setup_noise_groups`). Otherwise they can be computed later.
+
+        Returns
+        -------
+        MapLike
+            Likelihood for the selected pixels.
+        """
+        ml = copy(self)
+        ml.nside = self.get_nside()
+        if self.noiseivar_qu is not None :
+            pix = self._paired_pixels(rows)
+            for name in self._qu_arrays() :
+                setattr(ml, name, getattr(self, name)[pix])
+        ml.pixel_ids = self.get_pixel_ids()[rows]
+        ml.pol_ids = self.get_pol_ids()[rows]
+        for name in self._data_arrays() :
+            setattr(ml, name, getattr(self, name)[rows])
+        ml.npix = len(ml.dataivar)
+        ml.set_dof()
+        ml.noise_groups = None
+        # Views of shared arrays stay shared, but are owned by this object
+        ml.shared_backend = None
+        if compress and self.compress_noise :
+            ml.setup_noise_groups()
+        if self.sed_caches is not None :
+            ml.sed_caches = [LRUCache(self.sed_cache_size) for c in self.sky.components]
+        return ml
+
+    def _paired_pixels(self, rows):
+        """ Returns the map pixels whose Q and U rows are selected by `rows`
+        (see `select_pixels`).
+        """
+        n_pix = self.npix // 2
+        ids = np.arange(self.npix)[rows]
+        pix = ids[:len(ids) // 2]
+        if ((len(ids) % 2) or np.any(pix >= n_pix) or
+            np.any(ids[len(ids) // 2:] != pix + n_pix)) :
+            raise ValueError("With correlated Q/U noise, the Q and U rows of each pixel "
+                             "must be selected together")
+        return pix
+
+    def pixel_chunks(self, bytes_per_pixel=None):
+        """ Method to split the rows of the data arrays into chunks whose
+        temporary arrays fit in `memory_budget`.
+
+        Parameters
+        ----------
+        bytes_per_pixel: int
+            Memory needed to process one row (optional, default is an estimate
+            for the marginal likelihood of a single parameter set).
+
+        Returns
+        -------
+        list(slice)
+            Slices covering all rows.
+        """
+        if bytes_per_pixel is None :
+            bytes_per_pixel = self._bytes_per_pixel()
+        chunk_size = max(int(self.memory_budget // bytes_per_pixel), 1)
+        return [slice(i0, min(i0 + chunk_size, self.npix))
+                for i0 in range(0, self.npix, chunk_size)]
+
+    def _bytes_per_pixel(self, n_sets=1, n_extra=0):
+        """ Rough size of the float64 temporaries needed per row and parameter
+        set by the amplitude covariance, its factorization, the amplitudes and
+        `n_extra` additional (N_freq,) arrays. The last two are needed for
+        each realization in a stack of them.
+        """
+        n_comp = self.sky.ncomps
+        n_freq = self.inst.n_channels
+        n_data = self.n_sims or 1
+        return 8 * n_sets * (3 * n_comp * n_comp + n_data * (4 * n_comp + (1 + n_extra) * n_freq))
+
+    def _new_array(self, name, shape, dtype):
+        """ Allocates a per-pixel array, in `storage_dir` if requested. Each
+        array gets a file of its own, so that several objects (e.g. those
+        returned by `degrade` or `select_pixels`) can share the directory.
+        """
+        if self.storage_dir is None :
+            return np.empty(shape, dtype=dtype)
+        fd, fname = tempfile.mkstemp(suffix='.npy', prefix=name + '_', dir=self.storage_dir)
+        os.close(fd)
+        return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape)
+
+    def _data_arrays(self):
+        """ Names of the per-row data arrays held by this object.
+        """
+        names = ['data', 'noisevar', 'noiseivar', 'dataivar', 'datanorm']
+        return [name for name in names if getattr(self, name) is not None]
+
+    def _qu_arrays(self):
+        """ Names of the per-pixel arrays describing correlated Q/U noise.
+        """
+        return [name for name in ['noisecov', 'noiseivar_qu'] if getattr(self, name) is not None]
+
+    def _check_noisecov(self):
+        """ Checks the shape of `noisecov` and sets `noisevar` to its
+        diagonal. If Q and U are uncorrelated, `noisecov` is dropped.
+        """
+        self.noisecov = np.asarray(self.noisecov)
+        if ((self.data.ndim != 3) or (self.data.shape[0] != 2) or
+            (self.noisecov.shape != self.data.shape[1:] + (2, 2))) :
+            raise ValueError("noisecov must have shape (N_pix,N_freq,2,2) for (Q,U) data "
+                             "with shape (2,N_pix,N_freq)")
+        if np.any(self.noisecov[..., 0, 1] != self.noisecov[..., 1, 0]) :
+            raise ValueError("noisecov must be symmetric")
+        self.noisevar = np.array([self.noisecov[..., 0, 0], self.noisecov[..., 1, 1]])
+        if not np.any(self.noisecov[..., 0, 1]) :
+            self.noisecov = None
+
+    def _invert_noisecov(self):
+        """ Computes the inverse noise covariance of each pixel and channel,
+        storing its diagonal in `noiseivar` and its Q-U element in
+        `noiseivar_qu`, together with `dataivar` and `datanorm`.
+        """
+        n_freq = self.inst.n_channels
+        self.noiseivar_qu = self._new_array('noiseivar_qu', (self.npix // 2, n_freq), self.dtype)
+        for pix in self._qu_chunks(8 * 10 * n_freq) :
+            rows_q, rows_u = self._qu_rows(pix)
+            cov = self.noisecov[pix]
+            det = cov[..., 0, 0] * cov[..., 1, 1] - cov[..., 0, 1] ** 2
+            if np.any(cov[..., 0, 0] <= 0) or np.any(det <= 0) :
+                raise ValueError("noisecov is not positive definite")
+            ivar_qq = cov[..., 1, 1] / det
+            ivar_uu = cov[..., 0, 0] / det
+            ivar_qu = -cov[..., 0, 1] / det
+            self.noiseivar[rows_q] = ivar_qq
+            self.noiseivar[rows_u] = ivar_uu
+            self.noiseivar_qu[pix] = ivar_qu
+            data_q = self.data[rows_q]
+            data_u = self.data[rows_u]
+            self.dataivar[rows_q] = ivar_qq * data_q + ivar_qu * data_u
+            self.dataivar[rows_u] = ivar_qu * data_q + ivar_uu * data_u
+            self.datanorm[rows_q] = np.sum(data_q * self.dataivar[rows_q], axis=-1)
+            self.datanorm[rows_u] = np.sum(data_u * self.dataivar[rows_u], axis=-1)
+
+    def _qu_chunks(self, bytes_per_pixel=None):
+        """ Same as `pixel_chunks` for correlated Q/U noise, returning slices
+        of map pixels, each of which covers one Q and one U row.
+        """
+        if bytes_per_pixel is None :
+            # (2 N_comp, 2 N_comp) blocks
+            bytes_per_pixel = 4 * self._bytes_per_pixel()
+        n_pix = self.npix // 2
+        chunk_size = max(int(self.memory_budget // bytes_per_pixel), 1)
+        return [slice(i0, min(i0 + chunk_size, n_pix))
+                for i0 in range(0, n_pix, chunk_size)]
+
+    def _qu_rows(self, pix):
+        """ Returns the Q and U rows of a slice of map pixels.
+        """
+        n_pix = self.npix // 2
+        start, stop, step = pix.indices(n_pix)
+        return slice(start, stop), slice(n_pix + start, n_pix + stop)
+
+    def _qu_covariance(self, f_matrix, pix):
+        """ Inverse covariance of the (Q, U) amplitudes of a slice of map
+        pixels, with shape (N_pix, 2*N_comp, 2*N_comp). Q and U share the F
+        matrix, so each of the blocks QQ, UU and QU (which is symmetric) is
+        a single product with the same F F^T.
+        """
+        n_comp, n_freq = f_matrix.shape
+        rows_q, rows_u = self._qu_rows(pix)
+        fprod = (f_matrix[:, None, :]*f_matrix[None, :, :]).reshape([n_comp*n_comp, n_freq]).T
+        out = np.empty([rows_q.stop - rows_q.start, 2 * n_comp, 2 * n_comp])
+        out[:, :n_comp, :n_comp] = np.dot(self.noiseivar[rows_q], fprod).reshape([-1, n_comp, n_comp])
+        out[:, n_comp:, n_comp:] = np.dot(self.noiseivar[rows_u], fprod).reshape([-1, n_comp, n_comp])
+        out[:, :n_comp, n_comp:] = np.dot(self.noiseivar_qu[pix], fprod).reshape([-1, n_comp, n_comp])
+        out[:, n_comp:, :n_comp] = out[:, :n_comp, n_comp:]
+        return out
+
+    def _qu_y(self, f_matrix, pix):
+        """ F N^-1 d for the (Q, U) amplitudes of a slice of map pixels, with
+        shape (N_pix, 2*N_comp).
+        """
+        rows_q, rows_u = self._qu_rows(pix)
+        return np.concatenate([np.dot(self.dataivar[rows_q], f_matrix.T),
+                               np.dot(self.dataivar[rows_u], f_matrix.T)], axis=1)
+
+    def _qu_ivar(self, res_q, res_u, pix):
+        """ Applies the inverse noise covariance of a slice of map pixels to
+        the Q and U parts of arrays with shape (..., N_pix, N_freq).
+        """
+        rows_q, rows_u = self._qu_rows(pix)
+        ivar_qu = self.noiseivar_qu[pix]
+        return (self.noiseivar[rows_q] * res_q + ivar_qu * res_u,
+                ivar_qu * res_q + self.noiseivar[rows_u] * res_u)
+
+    def _qu_likelihood(self, f_matrix, volume_prior=True):
+        """ Marginal likelihood (without prior) for correlated Q/U noise.
+        """
+        like = 0
+        for pix in self._qu_chunks() :
+            with timer(self.stats, 'covariance') :
+                amp_covar_matrix = self._qu_covariance(f_matrix, pix)
+                y = self._qu_y(f_matrix, pix)
+            with timer(self.stats, 'solve') :
+                amp_factor = BlockFactor(amp_covar_matrix)
+                amp_mean = amp_factor.solve(y)
+                if not volume_prior :
+                    like -= 0.5*np.sum(amp_factor.logdet())
+            with timer(self.stats, 'quadratic') :
+                like += 0.5*np.sum(y*amp_mean)
+        return like
+
+    def share_memory(self, backend='shm', directory=None):
+        """ Method to move the per-pixel data arrays (`data`, `noisevar`,
+        `noiseivar`, `dataivar` and, in lean mode, `datanorm`) into shared memory (see `bfore.parallel.share_array`). When
+        this object is then sent to the workers of a process pool, they attach
+        to the shared arrays instead of receiving a copy of them. The shared
+        memory is freed by `release_memory` or at exit.
+
+        Parameters
+        ----------
+        backend: str
+            'shm' (shared memory, for workers on the same node) or 'memmap'
+            (memory-mapped files in `directory`).
+        directory: str
+            Directory for the memory-mapped files.
+        """
+        for name in self._data_arrays() + self._qu_arrays() :
+            setattr(self, name, share_array(getattr(self, name), backend=backend,
+                                            directory=directory))
+        self.shared_backend = (backend, directory)
+
+    def release_memory(self):
+        """ Method to free the shared memory allocated by `share_memory`. The
+        data arrays are copied back into private memory.
+        """
+        for name in self._data_arrays() + self._qu_arrays() :
+            arr = getattr(self, name)
+            setattr(self, name, np.array(arr))
+            release_array(arr)
+        self.shared_backend = None
+
+    def __getstate__(self):
+        # Cached SEDs are not sent to other processes
+        state = self.__dict__.copy()
+        state['sed_caches'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sed_cache_size :
+            self.sed_caches = [LRUCache(self.sed_cache_size) for c in self.sky.components]
+
+    def tabulate_seds(self, grids, tol=1E-3, method='linear', cache=None):
+        """ Method to tabulate the bandpass-convolved SEDs of the sky
+        components on a grid of their varied parameters (see
+        `bfore.sedtable.SEDTable`). `f_matrix` will interpolate these tables
+        for parameter values inside the grids, and evaluate the SEDs directly
+        otherwise.
+
+        Parameters
+        ----------
+        grids: dict
+            Dictionary with a 1D array of values for some of the varied
+            parameters, keyed by parameter name. Only components for which all
+            varied parameters have a grid are tabulated.
+        tol: float
+            Maximum relative interpolation error, checked against direct
+            evaluation when building the tables.
+        method: str
+            Interpolation method, 'linear' or 'cubic'.
+        cache: str or DiskCache
+            Persistent cache of tables, or its directory (optional,
+            default=None, see `bfore.cache.DiskCache`).
+        """
+        if isinstance(cache, str) :
+            cache = DiskCache(cache)
+        self.sed_tables = []
+        for comp, par_names in zip(self.sky.components, self.sky.comp_par_names) :
+            var_names = [p for p in par_names if p in self.var_pars]
+            if len(var_names) > 0 and all([p in grids for p in var_names]) :
+                table = SEDTable(self.inst, comp, {p: grids[p] for p in var_names},
+                                 self.fixed_pars, tol=tol, method=method, cache=cache)
+            else :
+                table = None
+            self.sed_tables.append(table)
+        # cached columns may have been computed differently
+        if self.sed_caches is not None :
+            for cache in self.sed_caches :
+                cache.clear()
+        return
+
+    def setup_noise_groups(self):
+        r""" Method to group pixels sharing the same noise variance in all
+        channels and to precompute the sufficient statistics of the marginal
+        likelihood for each group.
+
+        For a group g of pixels with common inverse noise variance N_g^-1, the
+        marginal likelihood only depends on the data through the
+        (N_freq, N_freq) matrix
+
+        ..math::
+            D_g = \sum_{p\in g} (N_g^{-1} d_p) (N_g^{-1} d_p)^T
+
+        so that each likelihood evaluation scales as O(N_groups) rather than
+        O(N_pix). If grouping does not reduce the size of the problem (e.g.
+        every pixel has its own noise), `noise_groups` is left as None and the
+        per-pixel path is used. No groups are formed for correlated Q/U noise.
+        For a stack of realizations, D_g is computed for each of them, with
+        shape (N_sim,N_groups,N_freq,N_freq).
+        """
+        if self.noiseivar_qu is not None :
+            # the groups would need to match in Q, U and their correlation
+            self.noise_groups = None
+            return
+        n_freq = self.inst.n_channels
+        # the number of groups is at least the number of distinct rows in a
+        # sample of them, or of distinct values in a single channel, which
+        # are much cheaper to find
+        sample = np.asarray(self.noiseivar[::max(1, self.npix // 4096)])
+        if len(np.unique(sample, axis=0)) * n_freq >= self.npix :
+            self.noise_groups = None
+            return
+        if len(np.unique(np.asarray(self.noiseivar[:, 0]))) * n_freq >= self.npix :
+            self.noise_groups = None
+            return
+        group_ivar, group_ids = np.unique(self.noiseivar, axis=0,
+                                          return_inverse=True)
+        group_ivar = group_ivar.astype(float)
+        group_ids = np.ravel(group_ids)
+        n_groups = len(group_ivar)
+        if n_groups * n_freq >= self.npix :
+            self.noise_groups = None
+            return
+        # sort pixels by group and sum the outer products of each block
+        order = np.argsort(group_ids, kind='stable')
+        edges = np.concatenate(([0], np.cumsum(np.bincount(group_ids, minlength=n_groups))))
+        if self.n_sims is None :
+            group_ddt = np.zeros([n_groups, n_freq, n_freq])
+        else :
+            group_ddt = np.zeros([self.n_sims, n_groups, n_freq, n_freq])
+        for g in range(n_groups) :
+            d = np.asarray(self.dataivar[order[edges[g]:edges[g + 1]]], dtype=float)
+            if self.n_sims is None :
+                group_ddt[g] = np.dot(d.T, d)
+            else :
+                group_ddt[:, g] = np.einsum("pfs,pes->sfe", d, d)
+        self.noise_groups = {'ivar': group_ivar, 'ddt': group_ddt,
+                             'ids': group_ids, 'counts': np.diff(edges)}
+        return
+
     def check_parameters(self):
         """ Method to check that all the parameters required by the skymodel
         have been specified as either fixed, with a specific value, or are
@@ -95,6 +979,8 @@ class MapLike(object) :
         config_pars = set(self.fixed_pars)
         # update this with the variable parameter names, specified in the config
         config_pars.update(set(self.var_pars))
+        # instrument parameters are optional
+        config_pars.difference_update(self.inst.get_parameters())
         # check these sets are the same
         if not (model_pars == config_pars):
             print("Parameter mismatch between model and MapLike configuration")
@@ -110,22 +996,222 @@ class MapLike(object) :
         ----------
         var_pars_list: list
             Parameters necessary to describe all components in the sky model
-        inst_params: dictf(x, df, loc=0,
-            Parameters describing the instrument (none needed/implemented yet).
+        inst_params: dict
+            Values of instrument parameters (gains and bandpass shifts, see
+            `InstrumentModel.get_parameters`), overriding those in
+            `fixed_pars` (optional, default=None).
 
         Returns::
         -------
         array_like(float)
             The returned array has shape (N_comp, N_freq).
+
+        Notes
+        -----
+        If the SED cache is enabled, the convolved SED of each component is
+        stored keyed on the values of the parameters that component depends
+        on, so that only the columns whose parameters changed since a previous
+        call are recomputed. Components without parameters are only computed
+        once. If SED tables are available (see `tabulate_seds`), columns are
+        interpolated from them whenever the parameters lie inside the grid.
+
+        Instrument gains multiply the columns of the F matrix. Bandpass shifts
+        are applied through a second-order expansion in the shift, from the
+        bandpass integrals of the SEDs and of their frequency derivatives
+        (see `InstrumentModel.sed_moments`). These are cached like the SEDs,
+        so that only varying the instrument parameters is cheap. SED tables
+        are not used when there are bandpass shifts.
+        """
+        with timer(self.stats, 'f_matrix') :
+            gains, shifts = self._inst_values(var_pars_list, inst_params)
+            if shifts is None :
+                f_matrix = self._sed_matrix(var_pars_list)
+            else :
+                f_matrix = self.inst.apply_shifts(self._sed_moments(var_pars_list), shifts)
+            if gains is not None :
+                f_matrix *= gains
+            return f_matrix
+
+    def _sed_matrix(self, var_pars_list):
+        """ F matrix for unit gains and no bandpass shifts (see `f_matrix`).
+        The SEDs are evaluated through `sed_plan` into `_sed_buffer`: for all
+        the components at once if there are no caches or tables, otherwise
+        for each component missing from them.
+        """
+        if self.sed_caches is None and self.sed_tables is None :
+            with timer(self.stats, 'sed') :
+                seds = self.sed_plan.fnu(var_pars_list, out=self._sed_buffer)
+                return self.inst.integrate(seds, overwrite_input=True)
+        f_matrix = np.empty([self.sky.ncomps, self.inst.n_channels])
+        for i, args in enumerate(self.sed_plan.component_args(var_pars_list)) :
+            column = None
+            if self.sed_caches is not None :
+                column = self.sed_caches[i].get(args)
+            if column is None :
+                with timer(self.stats, 'sed') :
+                    if self.sed_tables is not None and self.sed_tables[i] is not None :
+                        column = self.sed_tables[i](args)
+                    if column is None :
+                        # through the plan, using its buffer as scratch space
+                        sed = self.sed_plan.component_fnu(i, args, out=self._sed_buffer[i])
+                        column = self.inst.integrate(sed, overwrite_input=True)
+                if self.sed_caches is not None :
+                    self.sed_caches[i].put(args, column)
+            f_matrix[i] = column
+        return f_matrix
+
+    def _sed_moments(self, var_pars_list):
+        """ Bandpass integrals of the SEDs and of their first and second
+        frequency derivatives (see `InstrumentModel.sed_moments`), with shape
+        (N_comp, 3, N_freq). They are cached together with the SEDs, so that
+        changing only the bandpass shifts does not require evaluating the SEDs.
         """
-        # put the list of parameter values into a dictionary
-        spec_params = {par_name:par_val for par_name, par_val in zip(self.var_pars, var_pars_list)}
-        # add the parameters that are fixed
-        spec_params.update(self.fixed_pars)
-        return self.inst.convolve_sed(self.sky.fnu,args=spec_params) #TODO: check/optimize
+        if self.sed_caches is None :
+            with timer(self.stats, 'sed') :
+                return self.inst.sed_moments(self._shift_plan().fnu(var_pars_list))
+        moments = np.empty([self.sky.ncomps, 3, self.inst.n_channels])
+        for i, (comp, args) in enumerate(zip(self.sky.components,
+                                             self.sed_plan.component_args(var_pars_list))) :
+            key = ('moments',) + args
+            m = self.sed_caches[i].get(key)
+            if m is None :
+                with timer(self.stats, 'sed') :
+                    m = self.inst.sed_moments(comp(self.inst.nu_shift_packed, args))
+                self.sed_caches[i].put(key, m)
+            moments[i] = m
+        return moments
+
+    def _shift_plan(self):
+        """ SED plan (see `SkyModel.compile`) evaluated at the nodes needed
+        for bandpass shifts (`InstrumentModel.nu_shift_packed`).
+        """
+        if self._sed_plan_shift is None :
+            self._sed_plan_shift = self.sky.compile(self.var_pars, self.fixed_pars,
+                                                    self.inst.nu_shift_packed)
+        return self._sed_plan_shift
+
+    def _inst_values(self, var_pars, inst_params=None):
+        """ Returns the gains and bandpass shifts of all channels (see
+        `InstrumentModel.inst_vectors`) for the varied parameters `var_pars`
+        (with shape (N_var,), or (N_sets, N_var), in which case the arrays
+        returned have shape (N_sets, N_freq) if they depend on the varied
+        parameters). Values in `inst_params` override the fixed parameters.
+        """
+        if (len(self.inst_var_ids) == 0 and len(self.fixed_inst_pars) == 0 and
+            not inst_params) :
+            return None, None
+        pars = dict(self.fixed_inst_pars)
+        if inst_params :
+            pars.update(inst_params)
+        gains, shifts = self.inst.inst_vectors(pars)
+        if len(self.inst_var_ids) == 0 :
+            return gains, shifts
+        var_pars = np.asarray(var_pars, dtype=float)
+        shape = var_pars.shape[:-1] + (self.inst.n_channels,)
+        values = {'gain': gains, 'shift': shifts}
+        defaults = {'gain': 1., 'shift': 0.}
+        for k, kind, ic in self.inst_var_ids :
+            if values[kind] is None :
+                values[kind] = np.full(shape, defaults[kind])
+            elif values[kind].shape != shape :
+                values[kind] = np.array(np.broadcast_to(values[kind], shape))
+            values[kind][..., ic] = var_pars[..., k]
+        return values['gain'], values['shift']
+
+    def sed_cache_info(self):
+        """ Returns the hit/miss statistics of the SED cache used by
+        `f_matrix`.
+
+        Returns
+        -------
+        dict
+            Dictionary with the total number of 'hits' and 'misses', and the
+            statistics of each component's cache under 'components', keyed by
+            component name. None if the cache is disabled.
+        """
+        if self.sed_caches is None :
+            return None
+        comps = {comp.comp_name: cache.info() for comp, cache in zip(self.sky.components,
+                                                                   self.sed_caches)}
+        return {'hits': sum([c.hits for c in self.sed_caches]),
+                'misses': sum([c.misses for c in self.sed_caches]),
+                'components': comps}
+
+    def f_matrix_batch(self, var_pars_array, inst_params=None) :
+        """
+        Returns the F matrix (see `f_matrix`) for several sets of parameters,
+        evaluating all of them in a single call to the SEDs.
+
+        Parameters
+        ----------
+        var_pars_array: array_like(float)
+            Array with shape (N_sets, N_var), with the values of the varied
+            parameters (in the order of the list self.var_pars) for each set.
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+
+        Returns
+        -------
+        array_like(float)
+            The returned array has shape (N_sets, N_comp, N_freq).
+        """
+        var_pars_array = np.atleast_2d(var_pars_array)
+        with timer(self.stats, 'f_matrix') :
+            gains, shifts = self._inst_values(var_pars_array, inst_params)
+            if shifts is None :
+                f_matrix = self.inst.integrate(self.sed_plan.fnu(var_pars_array), overwrite_input=True)
+            else :
+                moments = self.inst.sed_moments(self._shift_plan().fnu(var_pars_array))
+                f_matrix = self.inst.apply_shifts(moments, _per_set(shifts))
+            if gains is not None :
+                f_matrix *= _per_set(gains)
+            return f_matrix
+
+    def f_matrix_derivs(self, var_pars_list, inst_params=None) :
+        """
+        Returns the derivatives of the F matrix with respect to each of the
+        varied parameters.
+
+        Parameters
+        ----------
+        var_pars_list: list
+            Parameters necessary to describe all components in the sky model
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+
+        Returns
+        -------
+        array_like(float)
+            The returned array has shape (N_var, N_comp, N_freq).
+        """
+        gains, shifts = self._inst_values(var_pars_list, inst_params)
+        derivs = np.zeros([len(self.var_pars), self.sky.ncomps, self.inst.n_channels])
+        for i, (comp, var_ids, args) in enumerate(zip(self.sky.components, self.sed_plan.slots,
+                                                      self.sed_plan.component_args(var_pars_list))) :
+            if len(var_ids) == 0 :
+                continue
+            # comp_derivs -> (N_par_comp,N_freq)
+            comp_derivs = self.inst.response(comp.derivatives, args=args, gains=gains, shifts=shifts)
+            for j, k in var_ids :
+                derivs[k, i] = comp_derivs[j]
+        if len(self.inst_var_ids) > 0 :
+            # F = g * (I_0 + s * I_1 + s^2 * I_2 / 2) in each channel
+            if gains is None :
+                gains = np.ones(self.inst.n_channels)
+            if shifts is None :
+                f_nogain = self._sed_matrix(var_pars_list)
+            else :
+                moments = self._sed_moments(var_pars_list)
+                f_nogain = self.inst.apply_shifts(moments, shifts)
+            for k, kind, ic in self.inst_var_ids :
+                if kind == 'gain' :
+                    derivs[k, :, ic] = f_nogain[:, ic]
+                else :
+                    derivs[k, :, ic] = gains[ic] * (moments[:, 1, ic] + shifts[ic] * moments[:, 2, ic])
+        return derivs
 
     def get_amplitude_covariance(self, spec_params,
-                                 inst_params=None, f_matrix=None):
+                                 inst_params=None, f_matrix=None, rows=None):
         """
         Computes the covariance of the different component amplitudes.
 
@@ -134,29 +1220,79 @@ class MapLike(object) :
         spec_params: dict
             Parameters necessary to describe all components in the sky model
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
         f_matrix: array_like(float)
             Array with shape (N_comp, N_freq) (see f_matrix above). If not None,
             the F matrix won't be recalculated.
+        rows: slice
+            Rows of the data arrays to compute the covariance for (optional,
+            default=None, i.e. all of them). For correlated Q/U noise, slice
+            of map pixels.
 
         Returns
         -------
         array_like(float)
             Array with dimensions (N_pix,N_comp,N_comp), containing the
             noise covariance of all component amplitudes in each pixel and
-            polarization channel.
+            polarization channel. For correlated Q/U noise (see `noisecov`),
+            array with dimensions (N_pix,2*N_comp,2*N_comp) for the Q and U
+            amplitudes (in this order) of each map pixel.
         """
         if f_matrix is None:
             f_matrix = self.f_matrix(spec_params, inst_params)
+        if self.noiseivar_qu is not None :
+            return self._qu_covariance(f_matrix, slice(None) if rows is None else rows)
+        if rows is None:
+            rows = slice(None)
+        n_comp, n_freq = f_matrix.shape
         # f_matrix -> (N_comp,N_freq)
-        fprod=f_matrix[:,None,:]*f_matrix[None,:,:]
-        # fprod -> (N_comp,N_comp,N_freq)
+        fprod=(f_matrix[:,None,:]*f_matrix[None,:,:]).reshape([n_comp*n_comp,n_freq])
+        # fprod -> (N_comp*N_comp,N_freq)
         # noiseivar -> (N_pix,N_freq)
         # Output -> (N_pix,N_comp,N_comp)
-        return np.sum(fprod[None,:,:,:]*self.noiseivar[:,None,None,:],axis=3) #TODO: check/optimize
+        return np.dot(self.noiseivar[rows],fprod.T).reshape([-1,n_comp,n_comp])
+
+    def ill_conditioned_pixels(self, spec_params, inst_params=None, rcond=1E-12):
+        """
+        Finds the pixels whose amplitude covariance is ill-conditioned (see
+        `bfore.solvers.BlockFactor.rcond`), e.g. because the SEDs of some
+        components are nearly degenerate in the channels that observe them.
+        The likelihood does not check this, since it is costly.
+
+        Parameters
+        ----------
+        spec_params: dict
+            Parameters necessary to describe all components in the sky model
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+        rcond: float
+            Threshold on the reciprocal condition number (optional,
+            default=1E-12).
+
+        Returns
+        -------
+        array_like(int)
+            Sorted HEALPix indices of the pixels that are ill-conditioned in
+            any polarization channel.
+        """
+        f_matrix = self.f_matrix(spec_params, inst_params)
+        if self.noiseivar_qu is not None :
+            pixel_ids = self.get_pixel_ids()[:self.npix // 2]
+            chunks = self._qu_chunks()
+        else :
+            pixel_ids = self.get_pixel_ids()
+            chunks = self.pixel_chunks()
+        bad = [np.zeros(0, dtype=int)]
+        for rows in chunks :
+            amp_covar_matrix = self.get_amplitude_covariance(spec_params, inst_params,
+                                                             f_matrix=f_matrix, rows=rows)
+            amp_factor = BlockFactor(amp_covar_matrix, rcond=rcond)
+            bad.append(pixel_ids[rows][amp_factor.ill_conditioned])
+        return np.unique(np.concatenate(bad))
 
     def get_amplitude_mean(self, spec_params,
-                            inst_params=None, f_matrix=None, nt_inv_matrix=None):
+                            inst_params=None, f_matrix=None, nt_inv_matrix=None,
+                            nt_factor=None, rows=None):
         """
         Computes the best-fit amplitudes for all components.
 
@@ -165,7 +1301,7 @@ class MapLike(object) :
         spec_params: dict
             Parameters necessary to describe all components in the sky model
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
         f_matrix: array_like(float)
             Array with shape (N_comp, N_freq) (see f_matrix above). If not None,
             the F matrix won't be recalculated.
@@ -173,24 +1309,102 @@ class MapLike(object) :
             Array with shape (N_pix, N_comp, N_comp) (see
             `get_amplitude_covariance` above). If not None, the N_T matrix won't
             be recalculated.
+        nt_factor: BlockFactor
+            Factorization of the N_T matrix (see `bfore.solvers`). If not None,
+            the N_T matrix won't be recalculated nor factored.
+        rows: slice
+            Rows of the data arrays to compute the amplitudes for (optional,
+            default=None, i.e. all of them). `nt_inv_matrix` and `nt_factor`
+            must correspond to the same rows. For correlated Q/U noise, slice
+            of map pixels, for which the Q amplitudes are returned first,
+            followed by the U amplitudes.
 
         Returns
         -------
         array_like
-            Array with dimensions (N_pix, N_comp).
+            Array with dimensions (N_pix, N_comp), or (N_sim, N_pix, N_comp)
+            for a stack of realizations.
         """
         # Again, we're allowing F and N_T to be passed to avoid extra operations.
-        # Should we be passing choleskys here?
         if f_matrix is None:
             f_matrix = self.f_matrix(spec_params, inst_params)
         # f_matrix -> (N_comp,N_freq)
-        if nt_inv_matrix is None:
-            nt_inv_matrix = self.get_amplitude_covariance(spec_params, inst_params=inst_params,
-                                                          f_matrix=f_matrix)
-        # nt_inv_matrix -> (N_pix,N_comp,N_comp)
-        y = np.sum(f_matrix[None,:,:]*self.dataivar[:,None,:],axis=2) #TODO: check/optimize
-        # y -> (N_pix,N_comp)
-        return np.linalg.solve(nt_inv_matrix, y) #TODO: check/optimize
+        if nt_factor is None:
+            if nt_inv_matrix is None:
+                nt_inv_matrix = self.get_amplitude_covariance(spec_params, inst_params=inst_params,
+                                                              f_matrix=f_matrix, rows=rows)
+            # nt_inv_matrix -> (N_pix,N_comp,N_comp)
+            nt_factor = BlockFactor(nt_inv_matrix)
+        if rows is None:
+            rows = slice(None)
+        if self.noiseivar_qu is not None :
+            n_comp = len(f_matrix)
+            amps = nt_factor.solve(self._qu_y(f_matrix, rows))
+            return np.concatenate([amps[:, :n_comp], amps[:, n_comp:]])
+        y = self._data_projection(f_matrix, rows)
+        # y -> (N_pix,N_comp) (or (N_pix,N_comp,N_sim))
+        if self.n_sims is None :
+            return nt_factor.solve(y)
+        # contiguous, for the matrix products that follow
+        return np.ascontiguousarray(self._sims_first(nt_factor.solve(y)))
+
+    def sample_amplitudes(self, spec_params, n_draws=1, rng=None,
+                          inst_params=None):
+        """
+        Draws component amplitudes from their Gaussian distribution
+        conditional on a set of spectral parameters, with mean given by
+        `get_amplitude_mean` and covariance (F N^-1 F^T)^-1 in each pixel.
+
+        Parameters
+        ----------
+        spec_params: list
+            Varied parameters, in the order of the list self.var_pars.
+        n_draws: int
+            Number of draws (optional, default=1). If 0, the mean amplitudes
+            are returned instead.
+        rng: numpy.random.Generator
+            Random number generator (optional, default=None, i.e. a new
+            generator with a random seed).
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+
+        Returns
+        -------
+        array_like(float)
+            Array with shape (max(n_draws, 1), N_pix, N_comp).
+        """
+        self._check_single('sample_amplitudes')
+        if rng is None :
+            rng = np.random.default_rng()
+        f_matrix = self.f_matrix(spec_params, inst_params=inst_params)
+        n_comp = len(f_matrix)
+        out = np.empty([max(n_draws, 1), self.npix, n_comp])
+        if self.noiseivar_qu is not None :
+            for pix in self._qu_chunks(4 * self._bytes_per_pixel() + 32 * n_comp * n_draws) :
+                amp_factor = BlockFactor(self._qu_covariance(f_matrix, pix))
+                # amp_mean -> (N_pix,2*N_comp)
+                amp_mean = amp_factor.solve(self._qu_y(f_matrix, pix))
+                amps = amp_mean[None, :, :]
+                if n_draws > 0 :
+                    z = rng.standard_normal([len(amp_mean), 2 * n_comp, n_draws])
+                    amps = amps + np.transpose(amp_factor.draw(z), axes=[2, 0, 1])
+                rows_q, rows_u = self._qu_rows(pix)
+                out[:, rows_q] = amps[:, :, :n_comp]
+                out[:, rows_u] = amps[:, :, n_comp:]
+            return out
+        # z and the draws take 2*N_comp*N_draws extra floats per pixel
+        for rows in self.pixel_chunks(self._bytes_per_pixel() + 16 * n_comp * n_draws) :
+            amp_factor = BlockFactor(self.get_amplitude_covariance(spec_params, inst_params,
+                                                                   f_matrix, rows=rows))
+            amp_mean = self.get_amplitude_mean(spec_params, inst_params, f_matrix=f_matrix,
+                                               nt_factor=amp_factor, rows=rows)
+            if n_draws == 0 :
+                out[0, rows] = amp_mean
+                continue
+            # z -> (N_pix,N_comp,N_draws)
+            z = rng.standard_normal([len(amp_mean), n_comp, n_draws])
+            out[:, rows] = amp_mean[None, :, :] + np.transpose(amp_factor.draw(z), axes=[2, 0, 1])
+        return out
 
     def logprior(self,spec_params,inst_params=None):
         """ Function to calculate the prior for spectral parameters
@@ -201,7 +1415,7 @@ class MapLike(object) :
             List of the variable parameters that will be sampled. These must be
             passed in the order of the list self.var_pars.
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
 
         Returns
         -------
@@ -209,13 +1423,29 @@ class MapLike(object) :
             Prior at this point in parameter space.
         """
 
-        #Top-hat priors
-        if any(np.fabs(spec_params[self.id_tophat]-self.var_prior_meant)>self.var_prior_widtht) :
-            return None
-        else :
-            #Gausian priors
-            return -0.5*np.sum(((spec_params[self.id_gauss]-self.var_prior_meang)*
-                                self.var_prior_iwidthg)**2)
+        with timer(self.stats, 'prior') :
+            #Top-hat priors
+            if any(np.fabs(spec_params[self.id_tophat]-self.var_prior_meant)>self.var_prior_widtht) :
+                return None
+            else :
+                #Gausian priors
+                return -0.5*np.sum(((spec_params[self.id_gauss]-self.var_prior_meang)*
+                                    self.var_prior_iwidthg)**2)
+
+    def logprior_grad(self, spec_params, inst_params=None):
+        """ Function to calculate the gradient of the prior for spectral
+        parameters (see `logprior`). Top-hat priors have zero gradient inside
+        their support.
+
+        Returns
+        -------
+        array_like(float)
+            Gradient with respect to each varied parameter.
+        """
+        grad = np.zeros(len(self.var_pars))
+        grad[self.id_gauss] = -((spec_params[self.id_gauss]-self.var_prior_meang)*
+                                self.var_prior_iwidthg**2)
+        return grad
 
     def marginal_spectral_likelihood(self, spec_params,
                                      inst_params=None, volume_prior=True,
@@ -229,13 +1459,24 @@ class MapLike(object) :
             List of the variable parameters that will be sampled. These must be
             passed in the order of the list self.var_pars.
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
+        volume_prior: bool
+            If True (default), the amplitudes are marginalized with the
+            volume prior that cancels the determinant of their covariance,
+            and the likelihood is 0.5 y^T N_T y, with y = F N^-1 d. If False,
+            they are marginalized with a flat prior, which adds
+            -0.5 log det(N_T^-1) in each pixel. The determinant is computed
+            from the same factorization as the amplitudes (see
+            `bfore.solvers.BlockFactor.logdet`). The gradient and Fisher
+            matrix (see `marginal_spectral_likelihood_grad` and
+            `fisher_matrix`) are those of the default likelihood.
         add_prior: set to True if you want to include the parameter prior
 
         Returns
         -------
         float
-            Likelihood at this point in parameter space.
+            Likelihood at this point in parameter space (array with shape
+            (N_sim,) for a stack of realizations).
         """
 
         if add_prior :
@@ -243,26 +1484,351 @@ class MapLike(object) :
         else :
             lprior=0
         if lprior is None :
+            if self.n_sims is not None :
+                return np.full(self.n_sims,-np.inf)
             return -np.inf
         
         # calculate sed for proposal spectral parameters
         f_matrix = self.f_matrix(spec_params, inst_params=inst_params)
         # f_matrix -> (N_comp,N_freq)
-        # get amplitude covariance for proposal spectral parameters
-        amp_covar_matrix = self.get_amplitude_covariance(spec_params, inst_params, f_matrix)
-        # amp_covar_matrix -> (N_pix,N_comp,N_comp)
-        # get amplitude mean for proposal spectral parameters
-        amp_mean = self.get_amplitude_mean(spec_params,
-                                           inst_params, f_matrix=f_matrix,
-                                           nt_inv_matrix=amp_covar_matrix)
-        # amp_mean -> (N_pix,N_comp)
-        # NOTE:
-        #   - einsum only optimized for two matrices contraction, so split this
-        #   - This could be also written as (N^-1*d)^T*F^T*amp_mean, which might save some time
-        like=0.5*np.einsum("ij,ijk,ik->", amp_mean, amp_covar_matrix, amp_mean) #TODO: check/optimize
+        if self.noise_groups is not None :
+            return self.compressed_likelihood(f_matrix, volume_prior)+lprior
+        if self.noiseivar_qu is not None :
+            return self._qu_likelihood(f_matrix, volume_prior)+lprior
+        like=0
+        for rows in self.pixel_chunks() :
+            with timer(self.stats, 'covariance') :
+                # get amplitude covariance for proposal spectral parameters
+                amp_covar_matrix = self.get_amplitude_covariance(spec_params, inst_params, f_matrix,
+                                                                 rows=rows)
+                # amp_covar_matrix -> (N_pix,N_comp,N_comp)
+                # y = F N^-1 d -> (N_pix,N_comp) (or (N_pix,N_comp,N_sim))
+                y = self._data_projection(f_matrix, rows)
+            with timer(self.stats, 'solve') :
+                # factor it once for the mean, the quadratic form and the
+                # determinant
+                amp_factor = BlockFactor(amp_covar_matrix)
+                # get amplitude mean for proposal spectral parameters
+                amp_mean = amp_factor.solve(y)
+                # amp_mean -> same shape as y
+                if not volume_prior :
+                    like-=0.5*np.sum(amp_factor.logdet())
+            with timer(self.stats, 'quadratic') :
+                # amp_mean^T N_T^-1 amp_mean = y^T amp_mean
+                like+=0.5*np.sum(y*amp_mean,axis=(0,1))
 
         return like+lprior
-        
+
+    def compressed_likelihood(self, f_matrix, volume_prior=True):
+        """ Function to calculate the amplitude-marginalized likelihood from
+        the per-group sufficient statistics computed by `setup_noise_groups`.
+
+        Parameters
+        ----------
+        f_matrix: array_like(float)
+            Array with shape (N_comp, N_freq) (see f_matrix above).
+        volume_prior: bool
+            See `marginal_spectral_likelihood`.
+
+        Returns
+        -------
+        float
+            Likelihood (without prior) for this F matrix (array with shape
+            (N_sim,) for a stack of realizations).
+        """
+        with timer(self.stats, 'covariance') :
+            # amp_covar_matrix -> (N_groups,N_comp,N_comp)
+            amp_covar_matrix = np.einsum("ik,gk,jk->gij", f_matrix,
+                                         self.noise_groups['ivar'], f_matrix)
+            # f_ddt_ft -> (N_groups,N_comp,N_comp)
+            f_ddt_ft = np.matmul(np.matmul(f_matrix, self.noise_groups['ddt']),
+                                 f_matrix.T)
+        with timer(self.stats, 'solve') :
+            amp_factor = BlockFactor(amp_covar_matrix)
+            sol = amp_factor.solve(f_ddt_ft)
+            like = 0
+            if not volume_prior :
+                like = -0.5*np.sum(self.noise_groups['counts']*amp_factor.logdet())
+        with timer(self.stats, 'quadratic') :
+            # sum_p y_p^T N_T^-1 y_p = Tr(N_T^-1 F D_g F^T)
+            return like+0.5*np.einsum("...gii->...", sol)
+
+    def logprior_batch(self, spec_params, inst_params=None):
+        """ Function to calculate the prior (see `logprior`) for several sets
+        of spectral parameters.
+
+        Parameters
+        ----------
+        spec_params: array_like(float)
+            Array with shape (N_sets, N_var).
+
+        Returns
+        -------
+        array_like(float)
+            Prior for each set, -inf outside the top-hat priors.
+        """
+        lprior = -0.5*np.sum(((spec_params[:, self.id_gauss]-self.var_prior_meang)*
+                              self.var_prior_iwidthg)**2, axis=1)
+        out = np.any(np.fabs(spec_params[:, self.id_tophat]-self.var_prior_meant) >
+                     self.var_prior_widtht, axis=1)
+        lprior[out] = -np.inf
+        return lprior
+
+    def marginal_spectral_likelihood_batch(self, spec_params,
+                                           inst_params=None, volume_prior=True,
+                                           add_prior=True):
+        """ Function to calculate the marginal likelihood (see
+        `marginal_spectral_likelihood`) for several sets of spectral
+        parameters in a single pass, e.g. for all the walkers of an ensemble
+        sampler.
+
+        Parameters
+        ----------
+        spec_params: array_like(float)
+            Array with shape (N_sets, N_var), with the variable parameters of
+            each set in the order of the list self.var_pars.
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+        volume_prior: bool
+            See `marginal_spectral_likelihood`.
+        add_prior: set to True if you want to include the parameter prior
+
+        Returns
+        -------
+        array_like(float)
+            Likelihood for each parameter set.
+        """
+        self._check_single('marginal_spectral_likelihood_batch')
+        spec_params = np.atleast_2d(spec_params)
+        if add_prior :
+            with timer(self.stats, 'prior') :
+                lprior = self.logprior_batch(spec_params, inst_params)
+        else :
+            lprior = np.zeros(len(spec_params))
+        like = np.full(len(spec_params), -np.inf)
+        good = np.isfinite(lprior)
+        if not np.any(good) :
+            return like
+        # f_matrix -> (N_sets,N_comp,N_freq)
+        f_matrix = self.f_matrix_batch(spec_params[good], inst_params=inst_params)
+        if self.noiseivar_qu is not None :
+            like[good] = [self._qu_likelihood(f, volume_prior) for f in f_matrix]
+            return like+lprior
+        n_sets, n_comp, n_freq = f_matrix.shape
+        # fprod -> (N_sets,N_comp*N_comp,N_freq)
+        fprod = (f_matrix[:, :, None, :]*f_matrix[:, None, :, :]).reshape([n_sets, n_comp*n_comp, n_freq])
+        fprod_t = np.transpose(fprod, axes=[0, 2, 1])
+        if self.noise_groups is not None :
+            with timer(self.stats, 'covariance') :
+                # amp_covar_matrix -> (N_sets,N_groups,N_comp,N_comp)
+                amp_covar_matrix = np.matmul(self.noise_groups['ivar'], fprod_t)
+                amp_covar_matrix = amp_covar_matrix.reshape([n_sets, -1, n_comp, n_comp])
+                f_ddt_ft = np.matmul(np.matmul(f_matrix[:, None, :, :], self.noise_groups['ddt']),
+                                     np.transpose(f_matrix, axes=[0, 2, 1])[:, None, :, :])
+            with timer(self.stats, 'solve') :
+                amp_factor = BlockFactor(amp_covar_matrix)
+                sol = amp_factor.solve(f_ddt_ft)
+            with timer(self.stats, 'quadratic') :
+                like[good] = 0.5*np.einsum("sgii->s", sol)
+            if not volume_prior :
+                like[good] -= 0.5*np.sum(self.noise_groups['counts']*amp_factor.logdet(), axis=1)
+        else :
+            like[good] = 0
+            for rows in self.pixel_chunks(self._bytes_per_pixel(n_sets)) :
+                with timer(self.stats, 'covariance') :
+                    # amp_covar_matrix -> (N_sets,N_pix,N_comp,N_comp)
+                    amp_covar_matrix = np.matmul(self.noiseivar[rows], fprod_t)
+                    amp_covar_matrix = amp_covar_matrix.reshape([n_sets, -1, n_comp, n_comp])
+                    # y -> (N_sets,N_pix,N_comp)
+                    y = np.matmul(self.dataivar[rows], np.transpose(f_matrix, axes=[0, 2, 1]))
+                with timer(self.stats, 'solve') :
+                    amp_factor = BlockFactor(amp_covar_matrix)
+                    amp_mean = amp_factor.solve(y)
+                    if not volume_prior :
+                        like[good] -= 0.5*np.sum(amp_factor.logdet(), axis=1)
+                with timer(self.stats, 'quadratic') :
+                    like[good] += 0.5*np.sum(y*amp_mean, axis=(1, 2))
+        return like+lprior
+
+    def marginal_spectral_likelihood_grad(self, spec_params,
+                                          inst_params=None, add_prior=True):
+        r""" Function to calculate the analytic gradient of the marginal
+        likelihood (see `marginal_spectral_likelihood`) with respect to the
+        varied parameters.
+
+        For each pixel, with best-fit amplitudes T and inverse-variance-weighted
+        residuals r = N^-1 (d - F^T T), the gradient is
+
+        ..math::
+            \partial_k \log L = \sum_p T_p^T (\partial_k F) r_p
+
+        Parameters
+        ----------
+        spec_params: list
+            List of the variable parameters. These must be passed in the order
+            of the list self.var_pars.
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+        add_prior: set to True if you want to include the parameter prior
+
+        Returns
+        -------
+        array_like(float)
+            Gradient with respect to each varied parameter (array with shape
+            (N_sim, N_var) for a stack of realizations).
+        """
+        f_matrix = self.f_matrix(spec_params, inst_params=inst_params)
+        f_derivs = self.f_matrix_derivs(spec_params, inst_params=inst_params)
+        # amp_resid -> (N_comp,N_freq) = sum_p T_p r_p^T (or (N_sim,N_comp,N_freq))
+        if self.noise_groups is not None :
+            ivar = self.noise_groups['ivar']
+            # amplitudes are T_p = B_g N^-1 d_p, residuals r_p = R_g N^-1 d_p
+            amp_proj = self._group_amplitude_projector(f_matrix)
+            res_proj = np.eye(self.inst.n_channels) - ivar[:, :, None]*np.matmul(f_matrix.T, amp_proj)
+            amp_resid = np.sum(np.matmul(np.matmul(amp_proj, self.noise_groups['ddt']),
+                                         np.transpose(res_proj, axes=[0, 2, 1])), axis=-3)
+        elif self.noiseivar_qu is not None :
+            amp_resid = 0
+            for pix in self._qu_chunks() :
+                rows_q, rows_u = self._qu_rows(pix)
+                amp_mean = self.get_amplitude_mean(spec_params, inst_params, f_matrix=f_matrix,
+                                                   rows=pix)
+                amp_q = amp_mean[:len(amp_mean) // 2]
+                amp_u = amp_mean[len(amp_mean) // 2:]
+                model_q, model_u = self._qu_ivar(np.dot(amp_q, f_matrix), np.dot(amp_u, f_matrix), pix)
+                amp_resid = amp_resid + (np.dot(amp_q.T, self.dataivar[rows_q] - model_q) +
+                                         np.dot(amp_u.T, self.dataivar[rows_u] - model_u))
+        else :
+            amp_resid = 0
+            for rows in self.pixel_chunks(self._bytes_per_pixel(n_extra=2)) :
+                amp_mean = self.get_amplitude_mean(spec_params, inst_params, f_matrix=f_matrix,
+                                                   rows=rows)
+                resid = (self._sims_first(self.dataivar[rows]) -
+                         self.noiseivar[rows]*np.matmul(amp_mean, f_matrix))
+                amp_resid = amp_resid + np.matmul(np.swapaxes(amp_mean, -1, -2), resid)
+        grad = np.einsum("kcf,...cf->...k", f_derivs, amp_resid)
+        if add_prior :
+            grad += self.logprior_grad(spec_params, inst_params)
+        return grad
+
+    def fisher_matrix(self, spec_params, inst_params=None, add_prior=True):
+        r""" Function to calculate the Fisher (Gauss-Newton) matrix of the
+        marginal likelihood (see `marginal_spectral_likelihood`).
+
+        For each pixel, with best-fit amplitudes T and projector
+        Q = N^-1 - N^-1 F^T (F N^-1 F^T)^-1 F N^-1, the Fisher matrix is
+
+        ..math::
+            F_{kl} = \sum_p T_p^T (\partial_k F) Q (\partial_l F)^T T_p
+
+        which coincides with the Hessian of -log L when the residuals vanish.
+
+        Parameters
+        ----------
+        spec_params: list
+            List of the variable parameters. These must be passed in the order
+            of the list self.var_pars.
+        inst_params: dict
+            Parameters describing the instrument (see `f_matrix`).
+        add_prior: set to True if you want to include the (Gaussian) priors
+
+        Returns
+        -------
+        array_like(float)
+            Array with shape (N_var, N_var), or (N_sim, N_var, N_var) for a
+            stack of realizations.
+        """
+        f_matrix = self.f_matrix(spec_params, inst_params=inst_params)
+        f_derivs = self.f_matrix_derivs(spec_params, inst_params=inst_params)
+        if self.noise_groups is not None :
+            ivar = self.noise_groups['ivar']
+            amp_proj = self._group_amplitude_projector(f_matrix)
+            # proj -> (N_groups,N_freq,N_freq)
+            proj = (np.einsum("gf,fe->gfe", ivar, np.eye(self.inst.n_channels)) -
+                    ivar[:, :, None]*np.matmul(f_matrix.T, amp_proj)*ivar[:, None, :])
+            # deriv_proj -> (N_var,N_groups,N_freq,N_freq), maps N^-1 d_p to dF^T T_p
+            deriv_proj = np.einsum("kcf,gce->kgfe", f_derivs, amp_proj)
+            fisher = np.einsum("kgab,...lgab->...kl", deriv_proj,
+                               np.matmul(np.matmul(proj[None, :, :, :], deriv_proj),
+                                         self.noise_groups['ddt'][..., None, :, :, :]))
+        elif self.noiseivar_qu is not None :
+            n_var = len(f_derivs)
+            n_comp = len(f_matrix)
+            fisher = 0
+            for pix in self._qu_chunks(4 * self._bytes_per_pixel(n_extra=2*n_var)) :
+                amp_factor = BlockFactor(self._qu_covariance(f_matrix, pix))
+                amp_mean = amp_factor.solve(self._qu_y(f_matrix, pix))
+                # deriv_amp_q -> (N_var,N_pix,N_freq) = dF^T T_p for Q, and same for U
+                deriv_amp_q = np.einsum("kcf,pc->kpf", f_derivs, amp_mean[:, :n_comp])
+                deriv_amp_u = np.einsum("kcf,pc->kpf", f_derivs, amp_mean[:, n_comp:])
+                ivar_deriv_q, ivar_deriv_u = self._qu_ivar(deriv_amp_q, deriv_amp_u, pix)
+                # f_ivar_deriv -> (N_pix,2*N_comp,N_var)
+                f_ivar_deriv = np.transpose(np.concatenate([np.dot(ivar_deriv_q, f_matrix.T),
+                                                            np.dot(ivar_deriv_u, f_matrix.T)],
+                                                           axis=2), axes=[1, 2, 0])
+                fisher = fisher + (np.einsum("kpf,lpf->kl", ivar_deriv_q, deriv_amp_q) +
+                                   np.einsum("kpf,lpf->kl", ivar_deriv_u, deriv_amp_u) -
+                                   np.einsum("pck,pcl->kl", f_ivar_deriv,
+                                             amp_factor.solve(f_ivar_deriv)))
+        elif self.n_sims is not None :
+            n_var, n_comp, n_freq = f_derivs.shape
+            # deriv_flat -> (N_var*N_comp,N_freq)
+            deriv_flat = f_derivs.reshape([n_var*n_comp, n_freq])
+            n_block = n_var*n_comp
+            fisher = 0
+            for rows in self.pixel_chunks(self._bytes_per_pixel() +
+                                          8*(3*n_block*n_block+n_block*(n_comp+n_freq)+
+                                             self.n_sims*n_comp*n_comp)) :
+                amp_covar_matrix = self.get_amplitude_covariance(spec_params, inst_params, f_matrix,
+                                                                 rows=rows)
+                amp_factor = BlockFactor(amp_covar_matrix)
+                amp_mean = self.get_amplitude_mean(spec_params, inst_params, f_matrix=f_matrix,
+                                                   nt_factor=amp_factor, rows=rows)
+                # The data-independent part M_p = dF Q dF^T, with shape
+                # (N_pix,N_var*N_comp,N_var*N_comp), is computed once and
+                # contracted with T_p T_p^T for all realizations
+                ivar = self.noiseivar[rows][:, None, :]
+                f_ivar_deriv = np.matmul(f_matrix*ivar, deriv_flat.T)
+                m = (np.matmul(deriv_flat*ivar, deriv_flat.T) -
+                     np.matmul(np.swapaxes(f_ivar_deriv, -1, -2), amp_factor.solve(f_ivar_deriv)))
+                # m -> (N_pix,N_comp,N_comp,N_var,N_var)
+                m = m.reshape([-1, n_var, n_comp, n_var, n_comp]).transpose([0, 2, 4, 1, 3])
+                amp_prod = amp_mean[..., :, None]*amp_mean[..., None, :]
+                fisher = fisher + np.dot(amp_prod.reshape([self.n_sims, -1]),
+                                         m.reshape([-1, n_var*n_var])).reshape([-1, n_var, n_var])
+        else :
+            n_var = len(f_derivs)
+            fisher = 0
+            for rows in self.pixel_chunks(self._bytes_per_pixel(n_extra=2*n_var)) :
+                amp_covar_matrix = self.get_amplitude_covariance(spec_params, inst_params, f_matrix,
+                                                                 rows=rows)
+                amp_factor = BlockFactor(amp_covar_matrix)
+                amp_mean = self.get_amplitude_mean(spec_params, inst_params, f_matrix=f_matrix,
+                                                   nt_factor=amp_factor, rows=rows)
+                # deriv_amp -> (N_var,N_pix,N_freq) = dF^T T_p
+                deriv_amp = np.matmul(amp_mean[None, :, :], f_derivs)
+                ivar_deriv = self.noiseivar[None, rows, :]*deriv_amp
+                # f_ivar_deriv -> (N_var,N_pix,N_comp)
+                f_ivar_deriv = np.matmul(ivar_deriv, f_matrix.T)
+                # sol -> (N_pix,N_comp,N_var)
+                sol = amp_factor.solve(np.transpose(f_ivar_deriv, axes=[1, 2, 0]))
+                # sums over pixels and channels (or components) as matrix products
+                fisher = fisher + (np.dot(ivar_deriv.reshape([n_var, -1]), deriv_amp.reshape([n_var, -1]).T) -
+                                   np.dot(f_ivar_deriv.reshape([n_var, -1]), sol.reshape([-1, n_var])))
+        if add_prior :
+            fisher[..., self.id_gauss, self.id_gauss] += self.var_prior_iwidthg**2
+        return fisher
+
+    def _group_amplitude_projector(self, f_matrix):
+        """ Returns the (N_groups, N_comp, N_freq) matrices B_g = (F N_g^-1
+        F^T)^-1 F mapping N_g^-1 d_p into the best-fit amplitudes of each
+        pixel in noise group g.
+        """
+        amp_covar_matrix = np.einsum("ik,gk,jk->gij", f_matrix,
+                                     self.noise_groups['ivar'], f_matrix)
+        n_groups = len(amp_covar_matrix)
+        return BlockFactor(amp_covar_matrix).solve(np.broadcast_to(f_matrix, (n_groups,) + f_matrix.shape))
+
     def chi2(self, spec_params, inst_params=None,
              f_matrix=None, volume_prior=True, lnprior=None):
         """ Function to calculate the chi2 of a given set of spectral
@@ -280,21 +1846,42 @@ class MapLike(object) :
             List of the variable parameters that will be sampled. These must be
             passed in the order of the list self.var_pars.
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
 
         Returns
         -------
         float
-            Chi squared for given spectral parameters.
+            Chi squared for given spectral parameters (array with shape
+            (N_sim,) for a stack of realizations).
         """
         if f_matrix is None:
             f_matrix = self.f_matrix(spec_params, inst_params)
-        # calculate amplitude templates for given spectral parameters
-        amp_mean = self.get_amplitude_mean(spec_params,
-                                           inst_params=None, f_matrix=None,
-                                           nt_inv_matrix=None)
-        res=self.data-np.dot(amp_mean,f_matrix) #TODO: check/optimize
-        return np.sum(res**2*self.noiseivar)
+        if self.noiseivar_qu is not None :
+            # d^T N^-1 d - T^T F N^-1 d, as in lean mode
+            chi2=np.sum(self.datanorm)
+            for pix in self._qu_chunks() :
+                amp_factor = BlockFactor(self._qu_covariance(f_matrix, pix))
+                y = self._qu_y(f_matrix, pix)
+                chi2-=np.sum(y*amp_factor.solve(y))
+            return chi2
+        chi2=0
+        for rows in self.pixel_chunks(self._bytes_per_pixel(n_extra=1)) :
+            # calculate amplitude templates for given spectral parameters
+            amp_mean = self.get_amplitude_mean(spec_params,
+                                               inst_params=None, f_matrix=f_matrix,
+                                               rows=rows)
+            if self.data is None :
+                # (d-F^T T)^T N^-1 (d-F^T T) = d^T N^-1 d - T^T F N^-1 d
+                y = np.matmul(self._sims_first(self.dataivar[rows]), f_matrix.T)
+                chi2+=(np.sum(self._sims_first(self.datanorm[rows]),axis=-1)-
+                       np.sum(y*amp_mean,axis=(-2,-1)))
+            else :
+                res=self._sims_first(self.data[rows])-np.matmul(amp_mean,f_matrix)
+                ivar=self.noiseivar[rows]
+                # unobserved channels may contain anything
+                with np.errstate(invalid='ignore') :
+                    chi2+=np.sum(np.where(ivar>0,res**2*ivar,0),axis=(-2,-1))
+        return chi2
 
     def chi2perdof(self, spec_params, inst_params=None,
                 f_matrix=None, volume_prior=True, lnprior=None):
@@ -313,14 +1900,14 @@ class MapLike(object) :
             List of the variable parameters that will be sampled. These must be
             passed in the order of the list self.var_pars.
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
 
         Returns
         -------
         float
             Chi squared per degree of freedom for given spectral parameters.
         """
-        chi2 = self.chi2(spec_params, inst_params=None,
+        chi2 = self.chi2(spec_params, inst_params=inst_params,
                          f_matrix=f_matrix, volume_prior=volume_prior,
                          lnprior=lnprior)
         return chi2 / float(self.dof)
@@ -336,14 +1923,44 @@ class MapLike(object) :
             List of the variable parameters that will be sampled. These must be
             passed in the order of the list self.var_pars.
         inst_params: dict
-            Parameters describing the instrument (none needed/implemented yet).
+            Parameters describing the instrument (see `f_matrix`).
 
         Returns
         -------
         float
             p-value for given spectral parameters.
         """
-        chi2 = self.chi2(spec_params, inst_params=None,
+        chi2 = self.chi2(spec_params, inst_params=inst_params,
                          f_matrix=f_matrix, volume_prior=volume_prior,
                          lnprior=lnprior)
+        from scipy import stats
         return 1. - stats.chi2.cdf(chi2, self.dof)
+
+
+def _npix2nside(npix):
+    """ HEALPix resolution of a full-sky map with `npix` pixels (as
+    `healpy.npix2nside`).
+    """
+    nside = int(round(np.sqrt(npix / 12.)))
+    if 12 * nside ** 2 != npix :
+        raise ValueError("Wrong pixel number (it is not 12*nside**2)")
+    return nside
+
+
+def _per_set(values):
+    """ Inserts a component axis in per-set channel values with shape
+    (N_sets, N_freq), so that they broadcast against (N_sets, N_comp, N_freq).
+    """
+    if values.ndim == 2 :
+        return values[:, None, :]
+    return values
+
+
+def _sum_rows(arr, ids, n_out):
+    """ Sums the rows of `arr` with the same index in `ids` (from 0 to
+    n_out-1, all present), in float64.
+    """
+    order = np.argsort(ids, kind='stable')
+    starts = np.searchsorted(ids[order], np.arange(n_out))
+    return np.add.reduceat(np.asarray(arr[order], dtype=float), starts, axis=0)
+
@@ -0,0 +1,182 @@
+from __future__ import print_function
+import os
+import atexit
+import tempfile
+import numpy as np
+try :
+    from numpy.lib.array_utils import byte_bounds
+except ImportError : # numpy < 2.0
+    byte_bounds = np.byte_bounds
+
+# Shared blocks created by this process, and blocks attached to by it
+_owned = {}
+_attached = {}
+
+
+class SharedArray(np.ndarray):
+    """
+    Numpy array stored in a block of shared memory (`multiprocessing`
+    shared memory, or a memory-mapped file). When pickled (e.g. when sent to
+    the workers of a process pool), shared arrays and any views of them are
+    serialized as a reference to the shared block, so that workers attach to
+    the same memory instead of receiving a copy of the data.
+    """
+    def __array_finalize__(self, obj):
+        self._shared = getattr(obj, '_shared', None)
+
+    def _in_block(self):
+        """ Checks whether this array lies within its shared block.
+        """
+        if self._shared is None :
+            return False
+        backend, name, base, nbytes = self._shared
+        start, end = byte_bounds(self)
+        return (start >= base) and (end <= base + nbytes)
+
+    def __reduce__(self):
+        if not self._in_block() :
+            # e.g. the result of an operation on a shared array
+            return np.asarray(self).copy().__reduce__()
+        backend, name, base, nbytes = self._shared
+        offset = self.__array_interface__['data'][0] - base
+        return (_attach, (backend, name, self.shape, self.dtype.str, offset, self.strides))
+
+
+def share_array(arr, backend='shm', directory=None):
+    """ Copies an array into a new block of shared memory.
+
+    Parameters
+    ----------
+    arr: array_like
+        Array to share.
+    backend: str
+        'shm' to use `multiprocessing.shared_memory` (workers on the same node),
+        or 'memmap' to use a memory-mapped file (e.g. on a filesystem shared by
+        all MPI workers).
+    directory: str
+        Directory for the memory-mapped files (optional, default is the
+        system's temporary directory). Only used if backend='memmap'.
+
+    Returns
+    -------
+    SharedArray
+        Shared copy of `arr`.
+    """
+    arr = np.ascontiguousarray(arr)
+    nbytes = max(arr.nbytes, 1)
+    if backend == 'shm' :
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        name = shm.name
+        buf = shm.buf
+        _owned[name] = shm
+    elif backend == 'memmap' :
+        fd, name = tempfile.mkstemp(suffix='.dat', prefix='bfore_', dir=directory)
+        os.close(fd)
+        mm = np.memmap(name, dtype=np.uint8, mode='w+', shape=(nbytes,))
+        buf = mm
+        _owned[name] = mm
+    else :
+        raise ValueError("Unknown shared memory backend " + backend)
+    out = np.ndarray.__new__(SharedArray, arr.shape, dtype=arr.dtype, buffer=buf)
+    out[...] = arr
+    out._shared = (backend, name, out.__array_interface__['data'][0], nbytes)
+    return out
+
+
+def release_array(arr):
+    """ Frees the shared block backing `arr`. The memory is returned to the
+    system once all arrays using it (in this and other processes) have been
+    deleted, and the block can no longer be attached to.
+    """
+    shared = getattr(arr, '_shared', None)
+    if shared is None :
+        return
+    block = _owned.pop(shared[1], None)
+    if block is not None :
+        _release_block(shared[1], block)
+
+
+def _release_block(name, block):
+    if isinstance(block, np.memmap) :
+        os.remove(name)
+    else :
+        block.unlink()
+        try :
+            block.close()
+        except BufferError : # arrays still using the block
+            pass
+
+
+def _attach(backend, name, shape, dtype, offset, strides):
+    """ Reconstructs a shared array from a reference to its shared block.
+    """
+    if name in _owned :
+        block = _owned[name]
+    elif name in _attached :
+        block = _attached[name]
+    elif backend == 'shm' :
+        block = _attach_shm(name)
+        _attached[name] = block
+    else :
+        block = np.memmap(name, dtype=np.uint8, mode='r+')
+        _attached[name] = block
+    if backend == 'shm' :
+        buf = block.buf
+        nbytes = block.size
+    else :
+        buf = block
+        nbytes = block.nbytes
+    out = np.ndarray.__new__(SharedArray, shape, dtype=dtype, buffer=buf,
+                             offset=offset, strides=strides)
+    out._shared = (backend, name, byte_bounds(np.frombuffer(buf, dtype=np.uint8))[0], nbytes)
+    return out
+
+
+def _attach_shm(name):
+    """ Attaches to an existing shared memory block without registering it
+    with this process' resource tracker, so that the block is not destroyed
+    when a worker exits.
+    """
+    from multiprocessing import shared_memory
+    try :
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError : # Python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _release_all():
+    for name in list(_owned.keys()) :
+        try :
+            _release_block(name, _owned.pop(name))
+        except OSError :
+            pass
+
+atexit.register(_release_all)
+
+
+def get_pool(mpi=False, processes=None):
+    """ Returns a pool of processes that can be passed to `clean_pixels`,
+    `clean_patches`, `run_emcee` and `run_fisher`.
+
+    Parameters
+    ----------
+    mpi: bool
+        If True, returns a `schwimmbad.MPIPool` (requires `mpi4py`). In that case
+        only the master process should run the sampler, and the other ranks should
+        call `pool.wait()` and exit.
+    processes: int
+        Number of local processes (optional, default is the number of CPUs). Used
+        when mpi=False.
+
+    Returns
+    -------
+        `schwimmbad` pool with a `map` method.
+    """
+    import schwimmbad
+    if processes is None :
+        processes = os.cpu_count()
+    return schwimmbad.choose_pool(mpi=mpi, processes=processes)
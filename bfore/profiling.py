@@ -0,0 +1,138 @@
+from __future__ import print_function
+import json
+import time
+
+
+class Stats(object):
+    """
+    Call counts and cumulative wall time of the different stages of a
+    likelihood evaluation or of a sampler run. Stages are timed with
+
+        with stats.timer('stage'):
+            ...
+
+    Objects that may or may not be instrumented use `timer(stats, stage)`,
+    which returns a no-op timer when `stats` is None.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+
+    def timer(self, stage):
+        """ Returns a context manager adding the time spent inside it to
+        `stage`.
+        """
+        return _StageTimer(self, stage)
+
+    def add(self, stage, dt, n=1):
+        """ Adds `n` calls taking a total time `dt` (in seconds) to `stage`.
+        """
+        self.counts[stage] = self.counts.get(stage, 0) + n
+        self.times[stage] = self.times.get(stage, 0.) + dt
+
+    def reset(self):
+        """ Forgets all recorded calls.
+        """
+        self.counts.clear()
+        self.times.clear()
+
+    def merge(self, other):
+        """ Adds the calls recorded by another `Stats` object (e.g. from a
+        different process).
+        """
+        for stage in other.counts :
+            self.add(stage, other.times[stage], n=other.counts[stage])
+        return self
+
+    def as_dict(self):
+        """ Returns a dictionary with the number of calls ('count'), the total
+        time ('time', in seconds) and the time per call ('time_per_call') of
+        each stage.
+        """
+        return {stage: {'count': n, 'time': self.times[stage],
+                        'time_per_call': self.times[stage] / max(n, 1)}
+                for stage, n in self.counts.items()}
+
+    def to_json(self, fname=None, **extra):
+        """ Returns the statistics (see `as_dict`) as a JSON string, and
+        optionally writes them to the file `fname`. Additional keyword
+        arguments are stored alongside the stages.
+        """
+        d = {'stages': self.as_dict()}
+        d.update(extra)
+        s = json.dumps(d, indent=1, default=_to_builtin)
+        if fname is not None :
+            with open(fname, 'w') as f :
+                f.write(s)
+        return s
+
+    def report(self):
+        """ Returns a table with the statistics of each stage, sorted by
+        total time.
+        """
+        lines = ["%-32s %10s %12s %14s" % ("stage", "calls", "time[s]", "per call[s]")]
+        for stage in sorted(self.counts, key=lambda s: -self.times[s]) :
+            n = self.counts[stage]
+            lines.append("%-32s %10d %12.4g %14.4g" % (stage, n, self.times[stage],
+                                                        self.times[stage] / max(n, 1)))
+        return "\n".join(lines)
+
+
+class _StageTimer(object):
+    __slots__ = ['stats', 'stage', 't0']
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(stats, stage):
+    """ Returns a timer for `stage` (see `Stats.timer`), or a shared no-op
+    timer if `stats` is None.
+    """
+    if stats is None :
+        return _NULL_TIMER
+    return _StageTimer(stats, stage)
+
+
+class CountedFunction(object):
+    """ Wraps a function, recording its calls under `stage` in a `Stats`
+    object. Copies sent to other processes record their calls separately.
+    """
+    def __init__(self, func, stats, stage='likelihood'):
+        self.func = func
+        self.stats = stats
+        self.stage = stage
+
+    def __call__(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        out = self.func(*args, **kwargs)
+        self.stats.add(self.stage, time.perf_counter() - t0)
+        return out
+
+
+def _to_builtin(obj):
+    # numpy scalars
+    if hasattr(obj, 'item') :
+        return obj.item()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
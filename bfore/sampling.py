@@ -1,9 +1,13 @@
 import numpy as np
-import emcee
-from scipy.optimize import minimize
-import numdifftools  as nd
+import inspect
+import time
+from .profiling import CountedFunction
+from .chains import ChainBackend
+from .maplike import UNSEEN
+# scipy.optimize, emcee and numdifftools are imported by the samplers using them
 
-def run_minimize(func,pos0,dpos=None,method='Powell',tol=None,callback=None,options=None,verbose=False):
+def run_minimize(func,pos0,dpos=None,method='Powell',tol=None,callback=None,options=None,verbose=False,
+                 grad=None,stats=None,stats_file=None):
     """ Function to find maximum-likelihood parameters
 
     Parameters
@@ -24,19 +28,36 @@ def run_minimize(func,pos0,dpos=None,method='Powell',tol=None,callback=None,opti
     options : dict
         Optional dictionary containing additional options for each method. One particularly
         useful option is maxiter:int
+    grad : function
+        Gradient of `func` (optional, default=None). If passed, it will be used by gradient-based
+        methods (e.g. 'BFGS' or 'L-BFGS-B'), and ignored by the others.
+    stats : Stats
+        `bfore.profiling.Stats` object where the number of likelihood evaluations and the time
+        spent in them are recorded (optional, default=None, i.e. no instrumentation). If passed,
+        the output dictionary contains a 'stats' entry (see `sampler_stats`).
+    stats_file : str
+        If not None, the statistics are also written to this JSON file.
 
     Returns
     -------
         Dictionary with maximum likelihood parameters and status of minimizer on exit.
     """
+    from scipy.optimize import minimize
     if verbose :
         print("Minimizing")
+    t0=time.perf_counter()
+    func=_counted(func,stats,'likelihood')
+    grad=_counted(grad,stats,'gradient')
     def mfunc(p,*a) :
         return -func(p,*a)
-    res=minimize(mfunc,pos0,method=method,tol=tol,callback=callback,options=options)
-    return {'params_ML':res.x,'ML_success':res.success,'ML_nev':res.nfev}
+    res=minimize(mfunc,pos0,method=method,tol=tol,callback=callback,options=options,
+                 jac=_jac(method,grad))
+    outputs={'params_ML':res.x,'ML_success':res.success,'ML_nev':res.nfev}
+    return sampler_stats(outputs,stats,'run_minimize',time.perf_counter()-t0,n_evals=res.nfev,
+                         stats_file=stats_file)
 
-def run_fisher(func,pos0,dpos=None,ml_first=False,ml_method='Powell',ml_options=None,verbose=False):
+def run_fisher(func,pos0,dpos=None,ml_first=False,ml_method='Powell',ml_options=None,verbose=False,
+               grad=None,fisher=None,pool=None,fisher_step=1E-3,stats=None,stats_file=None):
     """ Function to find Fisher matrix uncertainties (optionally) maximum-likelihood parameters
 
     Parameters
@@ -55,34 +76,125 @@ def run_fisher(func,pos0,dpos=None,ml_first=False,ml_method='Powell',ml_options=
     ml_options : dict
         Optional dictionary containing additional options for the minimizer. One particularly
         useful option is maxiter:int
+    grad : function
+        Gradient of `func` (optional, default=None). If passed, it is used for the Fisher bias
+        vector (and by gradient-based minimizers) instead of a numerical derivative.
+    fisher : function
+        Function returning the Fisher matrix (i.e. minus the Hessian of `func`) (optional,
+        default=None). If passed, it is used instead of a numerical Hessian.
+    pool : object
+        Pool of processes with a `map` method (optional, default=None). If passed, the numerical
+        gradient and Hessian are computed with a central-difference stencil whose points are
+        evaluated in parallel (`func` must then be picklable).
+    fisher_step : float
+        Relative step of the central-difference stencil used when `pool` is passed (optional,
+        default=1E-3). The step for parameter i is fisher_step*max(|p_i|,1).
+    stats : Stats
+        `bfore.profiling.Stats` object where the number of likelihood evaluations and the time
+        spent in them are recorded (evaluations done by `pool` are counted but not timed) (optional, default=None, i.e. no instrumentation). If passed,
+        the output dictionary contains a 'stats' entry (see `sampler_stats`).
+    stats_file : str
+        If not None, the statistics are also written to this JSON file.
 
     Returns
     -------
         Dictionary with central parameter values, Fisher matrix and Fisher bias vector
     """
+    t0=time.perf_counter()
+    n0=_n_calls(stats)
+    lfunc=_counted(func,stats,'likelihood')
+    grad=_counted(grad,stats,'gradient')
+    fisher=_counted(fisher,stats,'fisher')
     def mfunc(p,*a) :
-        return -func(p,*a)
+        return -lfunc(p,*a)
     
     if ml_first :
+        from scipy.optimize import minimize
         if verbose :
             print("Finding ML")
-        res=minimize(mfunc,pos0,method=ml_method,options=ml_options)
+        res=minimize(mfunc,pos0,method=ml_method,options=ml_options,jac=_jac(ml_method,grad))
         pcent=res.x
         ml_success=res.success
     else :
         pcent=pos0
         ml_success=None
-    if verbose :
-        print("Computing gradient")
-    fisher_v=-nd.Gradient(mfunc)(pcent)
-    if verbose :
-        print("Computing Hessian")
-    fisher_m=nd.Hessian(mfunc)(pcent)
-    
-    return {'params_cent':pcent,'fisher_m':fisher_m,'fisher_v':fisher_v,'ML_success':ml_success}
+    if (pool is not None) and ((grad is None) or (fisher is None)) :
+        if verbose :
+            print("Computing gradient and Hessian")
+        fisher_v,fisher_m=_stencil_derivatives(func,pcent,pool,fisher_step)
+        if stats is not None :
+            ndim=len(pcent)
+            stats.add('likelihood',0.,n=1+2*ndim*(ndim+1))
+        if grad is not None :
+            fisher_v=grad(pcent)
+        if fisher is not None :
+            fisher_m=fisher(pcent)
+    else :
+        if verbose :
+            print("Computing gradient")
+        if (grad is None) or (fisher is None) :
+            import numdifftools as nd
+        if grad is None :
+            fisher_v=-nd.Gradient(mfunc)(pcent)
+        else :
+            fisher_v=grad(pcent)
+        if verbose :
+            print("Computing Hessian")
+        if fisher is None :
+            fisher_m=nd.Hessian(mfunc)(pcent)
+        else :
+            fisher_m=fisher(pcent)
+
+    outputs={'params_cent':pcent,'fisher_m':fisher_m,'fisher_v':fisher_v,'ML_success':ml_success}
+    return sampler_stats(outputs,stats,'run_fisher',time.perf_counter()-t0,
+                         n_evals=_n_calls(stats)-n0,stats_file=stats_file)
+
+def _stencil_derivatives(func,pcent,pool,step):
+    """ Gradient and minus the Hessian of `func` at `pcent` from central-difference
+    stencils (fourth order for the gradient, second order for the Hessian), with all
+    the stencil points evaluated in a single `pool.map` call.
+    """
+    pcent=np.asarray(pcent,dtype=float)
+    ndim=len(pcent)
+    h=step*np.maximum(np.fabs(pcent),1.)
+    dp=h[:,None]*np.eye(ndim)
+    shifts=[np.zeros(ndim)]
+    for i in range(ndim) :
+        shifts+=[dp[i],-dp[i],2*dp[i],-2*dp[i]]
+    for i in range(ndim) :
+        for j in range(i+1,ndim) :
+            shifts+=[dp[i]+dp[j],dp[i]-dp[j],-dp[i]+dp[j],-dp[i]-dp[j]]
+    fvals=np.array(list(pool.map(func,[pcent+d for d in shifts])))
+    f0=fvals[0]
+    fp,fm,fp2,fm2=fvals[1:4*ndim+1].reshape([ndim,4]).T
+    grad=(8*(fp-fm)-(fp2-fm2))/(12*h)
+    hess=np.diag((fp-2*f0+fm)/h**2)
+    n=4*ndim+1
+    for i in range(ndim) :
+        for j in range(i+1,ndim) :
+            fpp,fpm,fmp,fmm=fvals[n:n+4]
+            hess[i,j]=hess[j,i]=(fpp-fpm-fmp+fmm)/(4*h[i]*h[j])
+            n+=4
+    return grad,-hess
+
+class _PooledBatch(object):
+    """ Evaluates a batched function by splitting the batch into chunks that are
+    mapped over a pool of processes (see `run_emcee`).
+    """
+    def __init__(self,func,pool,n_chunks):
+        self.func=func
+        self.pool=pool
+        self.n_chunks=n_chunks
+
+    def __call__(self,params):
+        chunks=np.array_split(params,min(self.n_chunks,len(params)))
+        return np.concatenate(list(self.pool.map(self.func,chunks)))
 
 def run_emcee(func, pos0, dpos=None, nwalkers=100, nsamps=500,
-              nburn=50, verbose=False):
+              nburn=50, verbose=False, vectorize=False, pool=None,
+              n_chunks=None, stats=None, stats_file=None, checkpoint_dir=None,
+              checkpoint_every=100, resume=True, thin=1, chain_dtype='float64',
+              autocorr_every=None, autocorr_factor=50, autocorr_tol=0.01):
     """ Function to run the emcee sampler on a given likelihood function.
 
     Parameters
@@ -102,10 +214,61 @@ def run_emcee(func, pos0, dpos=None, nwalkers=100, nsamps=500,
     nbrun: int
         Number of samples to be taken as burn-in, and discarded before returning
         the chain.
+    vectorize: bool
+        If True, `func` takes an array with shape (N_walkers, N_par) and returns
+        one value per walker (e.g. `MapLike.marginal_spectral_likelihood_batch`),
+        and all walkers are evaluated in a single call (optional, default=False).
+    pool: object
+        Pool of processes with a `map` method (e.g. `multiprocessing.Pool` or a
+        `schwimmbad` pool, see `bfore.parallel.get_pool`) used to evaluate the
+        walkers in parallel (optional, default=None). `func` must be picklable.
+        If `vectorize` is True, the walkers are split into `n_chunks` batches,
+        each evaluated with a single call to `func`.
+    n_chunks: int
+        Number of batches the walkers are split into if both `vectorize` and
+        `pool` are used (optional, default is the size of the pool, if known,
+        or 8).
+    stats: Stats
+        `bfore.profiling.Stats` object where the number of likelihood
+        evaluations and the time spent in them are recorded (evaluations done
+        by `pool` are counted but not timed) (optional, default=None, i.e. no
+        instrumentation). If passed, the output dictionary contains a 'stats'
+        entry (see `sampler_stats`).
+    stats_file: str
+        If not None, the statistics are also written to this JSON file.
+    checkpoint_dir: str
+        Directory where the chain is saved every `checkpoint_every` steps
+        (see `bfore.chains.ChainBackend`) (optional, default=None, i.e. the
+        chain is only kept in memory).
+    checkpoint_every: int
+        Number of steps between checkpoints (optional, default=100).
+    resume: bool
+        If True and `checkpoint_dir` contains a chain, sampling continues from
+        its last checkpoint until a total of `nsamps` steps is reached.
+        Otherwise any saved chain is deleted (optional, default=True).
+    thin: int
+        Only one in every `thin` steps is stored (optional, default=1). The
+        burn-in `nburn` is still given in steps.
+    chain_dtype: str
+        Data type used to store the chain (optional, default='float64').
+        'float32' halves its memory and disk footprint.
+    autocorr_every: int
+        If not None, the integrated autocorrelation time tau of each parameter
+        is estimated every `autocorr_every` steps, and sampling stops early
+        once the chain is longer than `autocorr_factor` times tau and the
+        estimate of tau changed by less than a fraction `autocorr_tol` since
+        the previous check (optional, default=None).
+    autocorr_factor: float
+        See `autocorr_every` (optional, default=50).
+    autocorr_tol: float
+        See `autocorr_every` (optional, default=0.01).
 
     Returns
     -------
-        Dictionary containing the parameter chains.
+        Dictionary containing the parameter chains ('chains'), the number of
+        steps taken ('n_steps'), the last estimate of the autocorrelation time
+        in steps ('tau', if `autocorr_every` was passed) and whether the
+        early-stopping criterion was met ('converged').
     """
     if verbose:
         print("Sampling")
@@ -120,15 +283,155 @@ def run_emcee(func, pos0, dpos=None, nwalkers=100, nsamps=500,
             dp[i]=1e-2
         else :
             dp[i]=d*0.1
-    # initial positions of the walkers
-    pos = [pos0 + dp * np.random.randn(ndim) for i in range(nwalkers)]
+    import emcee
+    t0 = time.perf_counter()
+    if pool is None :
+        func = _counted(func, stats, 'likelihood')
+
+    # resume from the last checkpoint
+    backend = None
+    saved = None
+    iteration = 0
+    chain_saved = np.zeros([0, nwalkers, ndim], dtype=chain_dtype)
+    if checkpoint_dir is not None :
+        backend = ChainBackend(checkpoint_dir, nwalkers, ndim, thin=thin, dtype=chain_dtype,
+                               resume=resume)
+        saved = backend.load_state()
+        if saved is not None :
+            state = emcee.State(saved['coords'], log_prob=saved['log_prob'],
+                                random_state=saved['random_state'])
+            iteration = saved['iteration']
+            chain_saved = backend.get_chain()
+            if verbose :
+                print("Resuming from step %d" % iteration)
+    if saved is None :
+        # initial positions of the walkers, only drawn when starting afresh
+        # so that resumed runs leave the random state untouched
+        pos = [pos0 + dp * np.random.randn(ndim) for i in range(nwalkers)]
+        state = emcee.State(np.array(pos))
     # initiate emcee sampler
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, func)
-    sampler.run_mcmc(pos, nsamps)
-    samples = sampler.chain[:, nburn:, :].reshape((-1, ndim))
-    return {'chains':samples}
+    if vectorize and (pool is not None) :
+        if n_chunks is None :
+            n_chunks = getattr(pool, 'size', None) or getattr(pool, '_processes', None) or 8
+        func = _PooledBatch(func, pool, n_chunks)
+        pool = None
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, func, vectorize=vectorize, pool=pool)
+
+    n_evals = 0 if state.log_prob is not None else nwalkers
+
+    # sample, storing one in every `thin` steps
+    chain = []
+    lnprob = []
+    tau = None
+    converged = False
+    n_steps = max(nsamps - iteration, 0)
+    for step in sampler.sample(state, iterations=n_steps, store=False) :
+        iteration += 1
+        n_evals += nwalkers
+        state = step
+        if iteration % thin == 0 :
+            chain.append(np.array(state.coords, dtype=chain_dtype))
+            lnprob.append(np.array(state.log_prob))
+        checkpoint = (iteration % checkpoint_every == 0) or (iteration == nsamps)
+        check_tau = (autocorr_every is not None) and (iteration % autocorr_every == 0)
+        if backend is not None and (checkpoint or check_tau) :
+            backend.save(chain, lnprob, state.coords, state.log_prob,
+                         state.random_state, iteration)
+            chain_saved = np.concatenate([chain_saved] + [c[None] for c in chain])
+            chain = []
+            lnprob = []
+        if check_tau :
+            full_chain = np.concatenate([chain_saved] + [c[None] for c in chain])
+            tau_new = thin * emcee.autocorr.integrated_time(full_chain, tol=0)
+            if tau is not None :
+                converged = (np.all(autocorr_factor * tau_new < iteration) and
+                             np.all(np.fabs(tau - tau_new) < autocorr_tol * tau_new))
+            tau = tau_new
+            if verbose :
+                print("Step %d, tau = %s" % (iteration, str(tau)))
+            if converged :
+                break
+    if backend is not None and len(chain) > 0 :
+        backend.save(chain, lnprob, state.coords, state.log_prob, state.random_state, iteration)
+    full_chain = np.concatenate([chain_saved] + [c[None] for c in chain])
+    # (N_steps,N_walkers,N_par) -> (N_walkers*N_steps,N_par), walker by walker
+    samples = np.transpose(full_chain[nburn // thin:], axes=[1, 0, 2]).reshape((-1, ndim))
+    outputs = {'chains':samples, 'n_steps':iteration, 'converged':converged}
+    if tau is not None :
+        outputs['tau'] = tau
+    return sampler_stats(outputs, stats, 'run_emcee', time.perf_counter() - t0,
+                         n_evals=n_evals, stats_file=stats_file)
+
+def sampler_stats(outputs,stats,name,t_run,n_evals,stats_file=None):
+    """ Adds the statistics of a sampler run to its output dictionary, as an entry 'stats'
+    with fields:
+    - 'n_evals': number of likelihood evaluations.
+    - 'time': wall time of the run (in seconds).
+    - 'evals_per_sec': likelihood evaluations per second.
+    - 'stages': calls and time of each instrumented stage (see `Stats.as_dict`), accumulated
+      over all the runs using `stats`.
+
+    Parameters
+    ----------
+    outputs: dict
+        Output dictionary of the sampler.
+    stats: Stats
+        Statistics collected during the run. If None, `outputs` is returned unchanged.
+    name: str
+        Name of the sampler, recorded as an additional stage.
+    t_run: float
+        Wall time of the run.
+    n_evals: int
+        Number of likelihood evaluations during the run.
+    stats_file: str
+        If not None, the statistics are also written to this JSON file.
+    """
+    if stats is None :
+        return outputs
+    stats.add(name,t_run)
+    info={'n_evals':n_evals,'time':t_run,'evals_per_sec':n_evals/max(t_run,1E-300)}
+    outputs['stats']=dict(info,stages=stats.as_dict())
+    if stats_file is not None :
+        stats.to_json(stats_file,**info)
+    return outputs
+
+def _n_calls(stats,stage='likelihood'):
+    """ Number of calls recorded in `stats` for `stage` (0 if `stats` is None).
+    """
+    if stats is None :
+        return 0
+    return stats.counts.get(stage,0)
+
+def _counted(func,stats,stage):
+    """ Wraps `func` to record its calls in `stats` if needed.
+    """
+    if (stats is None) or (func is None) :
+        return func
+    return CountedFunction(func,stats,stage)
+
+def _minus(func):
+    """ Returns a function computing -func, or None if func is None.
+    """
+    if func is None :
+        return None
+    def mfunc(p,*a) :
+        return -func(p,*a)
+    return mfunc
 
-def clean_pixels(maplike,sampler,d_params=None,**sampler_args):
+#Methods of scipy.optimize.minimize that use the gradient
+_GRADIENT_METHODS=['cg','bfgs','newton-cg','l-bfgs-b','tnc','slsqp','dogleg','trust-ncg',
+                   'trust-krylov','trust-exact','trust-constr']
+
+def _jac(method,grad):
+    """ Returns the `jac` argument of `scipy.optimize.minimize` for a given method: -grad for
+    gradient-based methods, and None otherwise (or if grad is None).
+    """
+    if (not isinstance(method,str)) or (method.lower() in _GRADIENT_METHODS) :
+        return _minus(grad)
+    return None
+
+def clean_pixels(maplike,sampler,d_params=None,analytic_derivatives=False,pool=None,pos0=None,
+                 **sampler_args):
     """ Function to combine a given MapLike likelihood object and a given
     sampler.
 
@@ -140,17 +443,372 @@ def clean_pixels(maplike,sampler,d_params=None,**sampler_args):
         Which sampling function to be used.
     d_params: (list(float))
         Expected width for each parameter (pass None if no idea).
+    analytic_derivatives: bool
+        If True, the analytic gradient and Fisher matrix of the likelihood are passed to
+        samplers that can use them (`run_minimize` and `run_fisher`).
+    pool: object
+        Pool of processes with a `map` method, passed to samplers that accept it (`run_emcee`
+        and `run_fisher`) (optional, default=None). Call `maplike.share_memory()` first so
+        that the workers attach to the data instead of receiving a copy of it.
+    pos0: list(float)
+        Starting point of the sampler (optional, default=None, i.e. `maplike.var_prior_mean`).
+
+    If `maplike` is profiled (see the 'profile' option of `MapLike`), its `stats` are passed
+    to the sampler, so the output 'stats' entry includes the likelihood stages.
     sampler_args: dict
         Keyword arguments containing hyperparameters specific to whichever
-        sampler was chosen.
+        sampler was chosen. If it contains `vectorize=True`, the batched likelihood
+        `MapLike.marginal_spectral_likelihood_batch` is passed to the sampler.
 
     Returns
     -------
     list(array_like(float))
         List of MCMC chains corresponding to the pixels in `ipix`.
     """
-    outputs=sampler(maplike.marginal_spectral_likelihood,
-                    pos0=maplike.var_prior_mean,
+    sampler_pars=inspect.signature(sampler).parameters
+    if (pool is not None) and ('pool' in sampler_pars) :
+        sampler_args['pool']=pool
+    if (maplike.stats is not None) and ('stats' in sampler_pars) :
+        sampler_args.setdefault('stats',maplike.stats)
+    if analytic_derivatives :
+        if 'grad' in sampler_pars :
+            sampler_args['grad']=maplike.marginal_spectral_likelihood_grad
+        if 'fisher' in sampler_pars :
+            sampler_args['fisher']=maplike.fisher_matrix
+    if sampler_args.get('vectorize',False) :
+        func=maplike.marginal_spectral_likelihood_batch
+    else :
+        func=maplike.marginal_spectral_likelihood
+    if pos0 is None :
+        pos0=maplike.var_prior_mean
+    outputs=sampler(func,
+                    pos0=pos0,
                     dpos=d_params,
                     **sampler_args)
     return outputs
+
+def run_multires(maplike,nsides,sampler=run_minimize,pos0=None,d_params=None,
+                 analytic_derivatives=False,level_args=None,verbose=False,**sampler_args):
+    """ Function to fit the data coarse-to-fine: the maximum-likelihood parameters are first
+    found on degraded copies of the data (see `MapLike.degrade`), from the lowest resolution
+    up, each level starting from the optimum of the previous one. The sampler is then run on
+    the full-resolution data starting from the last optimum, so that few of its (expensive)
+    likelihood evaluations are spent far from it.
+
+    The Fisher matrix of each level is also used to set the scale of the next one: as the
+    initial directions of Powell's method (unless 'direc' is passed in the options), and as
+    `d_params` for the other samplers (unless passed).
+
+    Parameters
+    ----------
+    maplike: MapLike
+        Full-resolution likelihood.
+    nsides: list(int)
+        Resolutions of the intermediate levels. Those not lower than the resolution of the
+        maps are ignored.
+    sampler: function
+        Sampler run at full resolution (optional, default=`run_minimize`).
+    pos0: list(float)
+        Starting point at the lowest resolution (optional, default=None, i.e.
+        `maplike.var_prior_mean`).
+    d_params: (list(float))
+        Expected width for each parameter (pass None if no idea).
+    analytic_derivatives: bool
+        See `clean_pixels`.
+    level_args: dict
+        Keyword arguments passed to `run_minimize` at the intermediate levels (optional,
+        default=None).
+    verbose: bool
+        If True, the optimum of each level is printed.
+    sampler_args: dict
+        Keyword arguments passed to `sampler` (see `clean_pixels`).
+
+    Returns
+    -------
+        Dictionary with the outputs of `sampler`, plus 'levels', a list with the resolution
+        ('nside') and the outputs of `run_minimize` for each intermediate level.
+    """
+    if level_args is None :
+        level_args={}
+    nside=maplike.get_nside()
+    if pos0 is None :
+        pos0=maplike.var_prior_mean
+    pos0=np.array(pos0,dtype=float)
+    cov=None
+    levels=[]
+    for ns in sorted(set(nsides)) :
+        if ns>=nside :
+            continue
+        ml=maplike.degrade(ns)
+        res=clean_pixels(ml,run_minimize,analytic_derivatives=analytic_derivatives,pos0=pos0,
+                         **_warm_start_args(run_minimize,level_args,d_params,cov))
+        pos0=res['params_ML']
+        cov=_parameter_covariance(ml,pos0)
+        res['nside']=ns
+        levels.append(res)
+        if verbose :
+            print("nside=%d: "%ns,pos0)
+    outputs=clean_pixels(maplike,sampler,analytic_derivatives=analytic_derivatives,pos0=pos0,
+                         **_warm_start_args(sampler,sampler_args,d_params,cov))
+    outputs['levels']=levels
+    return outputs
+
+def _parameter_covariance(maplike,params):
+    """ Inverse of the Fisher matrix, or None if it can't be computed.
+    """
+    try :
+        return np.linalg.inv(maplike.fisher_matrix(params))
+    except (NotImplementedError,np.linalg.LinAlgError) :
+        return None
+
+def _warm_start_args(sampler,sampler_args,d_params,cov):
+    """ Adds the scale of the parameters estimated from a previous fit (see `run_multires`)
+    to the arguments of a sampler.
+    """
+    args=dict(sampler_args)
+    args['d_params']=d_params
+    if cov is None :
+        return args
+    w,v=np.linalg.eigh(cov)
+    if np.any(w<=0) :
+        return args
+    if d_params is None :
+        args['d_params']=np.sqrt(np.diag(cov))
+    if sampler is run_minimize and args.get('method','Powell')=='Powell' :
+        options=dict(args.get('options') or {})
+        # directions along the principal axes of the covariance, with their widths
+        options.setdefault('direc',(v*np.sqrt(w)).T)
+        args['options']=options
+    return args
+
+def clean_patches(maplike,sampler,nside_spec,pool=None,d_params=None,patches_per_task=8,
+                  analytic_derivatives=False,**sampler_args):
+    """ Function to fit independent spectral parameters in each sky patch, defined by the
+    pixels of a low-resolution HEALPix grid.
+
+    The patches are views of the data of `maplike` if the rows of each patch are already
+    contiguous (e.g. NESTED maps of a single polarization channel). Otherwise the data are
+    copied once: sorted by patch, so that each patch is a view of the sorted copy, or, with
+    correlated Q/U noise, patch by patch (see `MapLike.select_pixels`).
+
+    Parameters
+    ----------
+    maplike: MapLike
+        Instance of the Maplike method, covering all patches.
+    sampler: function
+        Which sampling function to be used in each patch (e.g. `run_minimize`, `run_fisher`
+        or `run_emcee`).
+    nside_spec: int
+        HEALPix resolution defining the patches.
+    pool: object
+        Pool of processes with a `map` method (e.g. `multiprocessing.Pool` or a `schwimmbad`
+        pool) used to distribute the patches (optional, default=None, patches are fitted
+        serially). If the data of `maplike` are in shared memory (see `MapLike.share_memory`),
+        the patches are sent to the workers as references to shared memory.
+    d_params: (list(float))
+        Expected width for each parameter (pass None if no idea).
+    patches_per_task: int
+        Number of patches sent to a worker in each task (optional, default=8). Larger values
+        reduce the scheduling overhead when fitting many small patches.
+    analytic_derivatives: bool
+        See `clean_pixels`.
+    sampler_args: dict
+        Keyword arguments containing hyperparameters specific to whichever
+        sampler was chosen.
+
+    Returns
+    -------
+        Dictionary with the following fields:
+        - 'params_map': array with shape (N_var, N_pix_spec) with the best-fit parameters
+          (see `patch_params`) of each patch. Patches without data are set to `hp.UNSEEN`.
+        - 'success_map': boolean array with shape (N_pix_spec,), True for patches where the
+          fit succeeded.
+        - 'patch_results': dictionary with the outputs of the sampler for each patch, keyed by
+          patch index.
+    """
+    #Sort rows by patch, so that each patch is a contiguous block
+    patch_ids=maplike.get_patch_ids(nside_spec)
+    paired=maplike.noiseivar_qu is not None
+    if paired :
+        #With correlated Q/U noise, sort the Q rows and keep the U rows in the same order
+        n_pix=maplike.npix//2
+        patch_ids=patch_ids[:n_pix]
+    order=np.argsort(patch_ids,kind='stable')
+    ipatches,starts=np.unique(patch_ids[order],return_index=True)
+    edges=np.append(starts,len(order))
+    shared=None
+    if paired :
+        #The Q and U rows of a patch can't form a single block, so each patch is copied
+        #from its rows, Q first
+        rows=[np.concatenate([order[i0:i1],order[i0:i1]+n_pix])
+              for i0,i1 in zip(edges[:-1],edges[1:])]
+    else :
+        if np.any(order!=np.arange(len(order))) :
+            shared=maplike.shared_backend
+            maplike=maplike.select_pixels(order,compress=False)
+            if shared is not None :
+                #Share the sorted copy too
+                maplike.share_memory(*shared)
+        #Each patch is a view of the sorted likelihood
+        rows=[slice(i0,i1) for i0,i1 in zip(edges[:-1],edges[1:])]
+    #Noise groups are computed by the workers
+    patches=[(ip,maplike.select_pixels(r,compress=False)) for ip,r in zip(ipatches,rows)]
+    tasks=[(sampler,d_params,analytic_derivatives,sampler_args,patches[i:i+patches_per_task])
+           for i in range(0,len(patches),patches_per_task)]
+    if pool is None :
+        outputs=list(map(_clean_patch_task,tasks))
+    else :
+        outputs=list(pool.map(_clean_patch_task,tasks))
+    if shared is not None :
+        maplike.release_memory()
+
+    npix_spec=12*nside_spec**2
+    params_map=np.full([len(maplike.var_pars),npix_spec],UNSEEN)
+    success_map=np.zeros(npix_spec,dtype=bool)
+    patch_results={}
+    for output in outputs :
+        for ip,res in output :
+            patch_results[ip]=res
+            if 'error' not in res :
+                params_map[:,ip]=patch_params(res)
+                success_map[ip]=res.get('ML_success',True) is not False
+    return {'params_map':params_map,'success_map':success_map,'patch_results':patch_results}
+
+def patch_params(outputs):
+    """ Function to extract a single set of parameter values from the outputs of a sampler:
+    the maximum-likelihood parameters for `run_minimize`, the central values for `run_fisher`
+    and the median of the chains for `run_emcee`.
+    """
+    if 'params_ML' in outputs :
+        return outputs['params_ML']
+    if 'params_cent' in outputs :
+        return outputs['params_cent']
+    return np.median(outputs['chains'],axis=0)
+
+def _clean_patch_task(task):
+    """ Runs a sampler on a list of patches (see `clean_patches`).
+    """
+    sampler,d_params,analytic_derivatives,sampler_args,patches=task
+    outputs=[]
+    for ip,maplike in patches :
+        try :
+            if maplike.compress_noise :
+                maplike.setup_noise_groups()
+            res=clean_pixels(maplike,sampler,d_params=d_params,
+                             analytic_derivatives=analytic_derivatives,**sampler_args)
+        except Exception as e :
+            res={'error':repr(e)}
+        outputs.append((ip,res))
+    return outputs
+
+def clean_realizations(maplike,sampler=None,pos0=None,n_iter=20,tol=1E-3,pool=None,d_params=None,
+                       analytic_derivatives=False,verbose=False,**sampler_args):
+    """ Function to fit all the data realizations held by a likelihood (see the 'data' option
+    of `MapLike`) together, e.g. for Monte Carlo studies of the bias and scatter of the
+    parameters.
+
+    The parameters of all realizations are first estimated by Fisher scoring around a common
+    point p_c, at which the F matrix, amplitude covariances and their factorizations are
+    computed once and applied to all realizations:
+
+    p_s = p_c + F_s^-1 g_s
+
+    where g_s and F_s are the gradient and Fisher matrix of realization s at p_c. p_c is then
+    moved to the mean of the p_s, until it changes by less than `tol` times the typical
+    uncertainty. Each iteration costs about as much as one gradient and one Fisher matrix of a
+    single data set. For realizations scattered over a range in which the F matrix is close
+    to linear in the parameters, the p_s are the maximum-likelihood parameters. Otherwise,
+    `sampler` can be run on each realization (see `MapLike.realization`), starting from its
+    Fisher estimate.
+
+    Parameters
+    ----------
+    maplike: MapLike
+        Likelihood holding a stack of data realizations.
+    sampler: function
+        Sampler run on each realization after the Fisher fit (e.g. `run_minimize` for the
+        exact maximum-likelihood parameters) (optional, default=None, i.e. only the Fisher
+        fit is done).
+    pos0: list(float)
+        Starting point of the Fisher fit (optional, default=None, i.e.
+        `maplike.var_prior_mean`).
+    n_iter: int
+        Maximum number of Fisher scoring iterations (optional, default=20).
+    tol: float
+        Convergence threshold on the change of p_c, relative to the mean Fisher uncertainty of
+        each parameter (optional, default=1E-3).
+    pool: object
+        Pool of processes with a `map` method used to distribute the sampler runs over the
+        realizations (optional, default=None). See `clean_patches`.
+    d_params: (list(float))
+        Expected width for each parameter, passed to `sampler` (optional, default=None, i.e.
+        the Fisher uncertainties of each realization).
+    analytic_derivatives: bool
+        See `clean_pixels`.
+    verbose: bool
+        If True, the common point of each iteration is printed.
+    sampler_args: dict
+        Keyword arguments passed to `sampler` (see `clean_pixels`).
+
+    Returns
+    -------
+        Dictionary with the following fields:
+        - 'params_fisher': array with shape (N_sim, N_var) with the Fisher estimates.
+        - 'cov_fisher': array with shape (N_sim, N_var, N_var) with the inverse Fisher matrix
+          of each realization.
+        - 'params_cent': common point p_c of the last iteration.
+        - 'n_iter': number of iterations.
+        - 'converged': True if p_c converged within `n_iter` iterations.
+        - 'params': array with shape (N_sim, N_var) with the best-fit parameters (see
+          `patch_params`) of each realization if `sampler` was passed (NaN where it failed),
+          otherwise the Fisher estimates.
+        - 'realization_results': if `sampler` was passed, list with its outputs for each
+          realization.
+    """
+    if maplike.n_sims is None :
+        raise ValueError("maplike does not hold a stack of realizations")
+    if pos0 is None :
+        pos0=maplike.var_prior_mean
+    pcent=np.array(pos0,dtype=float)
+    converged=False
+    for it in range(n_iter) :
+        # fisher -> (N_sim,N_var,N_var), grad -> (N_sim,N_var)
+        fisher=maplike.fisher_matrix(pcent)
+        grad=maplike.marginal_spectral_likelihood_grad(pcent)
+        cov=np.linalg.inv(fisher)
+        params=pcent+np.einsum("sij,sj->si",cov,grad)
+        shift=np.mean(params,axis=0)-pcent
+        sigma=np.sqrt(np.mean(np.diagonal(cov,axis1=1,axis2=2),axis=0))
+        if verbose :
+            print("Iteration %d: "%(it+1),pcent)
+        if np.all(np.fabs(shift)<tol*sigma) :
+            converged=True
+            break
+        pcent=pcent+shift
+    outputs={'params_fisher':params,'cov_fisher':cov,'params_cent':pcent,'n_iter':it+1,
+             'converged':converged,'params':params}
+    if sampler is None :
+        return outputs
+
+    tasks=[(sampler,d_params,analytic_derivatives,sampler_args,maplike.realization(i),params[i],
+            np.sqrt(np.diagonal(cov[i]))) for i in range(maplike.n_sims)]
+    if pool is None :
+        results=list(map(_clean_realization_task,tasks))
+    else :
+        results=list(pool.map(_clean_realization_task,tasks))
+    outputs['realization_results']=results
+    outputs['params']=np.array([patch_params(r) if 'error' not in r
+                                else np.full(len(pcent),np.nan) for r in results])
+    return outputs
+
+def _clean_realization_task(task):
+    """ Runs a sampler on one realization (see `clean_realizations`).
+    """
+    sampler,d_params,analytic_derivatives,sampler_args,maplike,pos0,sigma=task
+    if d_params is None :
+        d_params=sigma
+    try :
+        return clean_pixels(maplike,sampler,d_params=d_params,analytic_derivatives=analytic_derivatives,
+                            pos0=pos0,**sampler_args)
+    except Exception as e :
+        return {'error':repr(e)}
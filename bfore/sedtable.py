@@ -0,0 +1,207 @@
+from __future__ import print_function
+import inspect
+import itertools
+import numpy as np
+from .cache import content_hash
+
+
+class SEDTable(object):
+    """
+    Bandpass-integrated SED of a single component, tabulated on a regular grid
+    of the component's varied parameters. Calls inside the grid are
+    interpolated, which makes their cost independent of the number of
+    bandpass frequency nodes. Positive SEDs are interpolated in log space,
+    where power laws in the spectral indices become linear.
+    """
+    def __init__(self, instrument_model, component, grids, fixed_pars,
+                 tol=1E-3, method='linear', n_check=1000, cache=None):
+        """
+        Builds and validates the table.
+
+        Parameters
+        ----------
+        instrument_model: InstrumentModel
+            Instrument whose bandpasses the SED is convolved with.
+        component: Component
+            Sky component to tabulate.
+        grids: dict
+            Dictionary with one monotonically increasing 1D array per varied
+            parameter of `component`, keyed by parameter name.
+        fixed_pars: dict
+            Values of the remaining parameters of `component`.
+        tol: float
+            Maximum allowed relative interpolation error (optional,
+            default=1E-3). It is checked against direct evaluation at the
+            centres of the grid cells, where interpolation errors are largest.
+        method: str
+            Interpolation method. 'linear' (multilinear, default) or 'cubic'
+            (uses `scipy.interpolate.RegularGridInterpolator`).
+        n_check: int
+            Maximum number of grid cells used to check the accuracy of the
+            table (optional, default=1000).
+        cache: DiskCache
+            Persistent cache (see `bfore.cache.DiskCache`) where the table is
+            looked up, and stored after being built (optional, default=None).
+            Entries are keyed by a hash of the bandpasses, the source code of
+            the component's SED, the fixed parameters, the grids, `method`
+            and `n_check`, so tables are rebuilt when any of these change.
+
+        Raises
+        ------
+        ValueError
+            If the interpolation error is larger than `tol`.
+        """
+        self.inst = instrument_model
+        self.comp = component
+        self.method = method
+        self.tol = tol
+        par_names = component.get_parameters()
+        self.var_pars = [p for p in par_names if p in grids]
+        self.var_index = [par_names.index(p) for p in self.var_pars]
+        self.grids = [np.asarray(grids[p], dtype=float) for p in self.var_pars]
+        for p, g in zip(self.var_pars, self.grids) :
+            if len(g) < 2 or np.any(np.diff(g) <= 0) :
+                raise ValueError("Grid for parameter %s must be increasing with at least 2 points" % p)
+        self.lo = np.array([g[0] for g in self.grids])
+        self.hi = np.array([g[-1] for g in self.grids])
+        self.fixed_pars = fixed_pars
+        entry = None
+        if cache is not None :
+            key = self.cache_key(n_check)
+            entry = cache.get(key)
+        if entry is not None :
+            self.table = entry['table']
+            self.log = bool(entry['log'])
+        else :
+            # tabulate: table -> (N_1, ..., N_d, N_freq)
+            points = np.array(list(itertools.product(*self.grids)))
+            shape = tuple(len(g) for g in self.grids) + (self.inst.n_channels,)
+            self.table = self.evaluate(points).reshape(shape)
+            self.log = np.all(self.table > 0)
+            if self.log :
+                self.table = np.log(self.table)
+        if method == 'cubic' :
+            from scipy.interpolate import RegularGridInterpolator
+            self._rgi = RegularGridInterpolator(self.grids, self.table, method='cubic')
+        elif method != 'linear' :
+            raise ValueError("Unknown interpolation method " + method)
+        if entry is not None :
+            self.max_error = float(entry['max_error'])
+        else :
+            self.max_error = self.check_accuracy(n_check)
+            if cache is not None :
+                cache.put(key, {'table': self.table, 'log': self.log,
+                                'max_error': self.max_error})
+        if self.max_error > tol :
+            raise ValueError("SED table for component %s has interpolation error %.2E > %.2E. "
+                             % (component.comp_name, self.max_error, tol) +
+                             "Use a finer grid.")
+
+    def cache_key(self, n_check=1000):
+        """ Returns the key of the table in a persistent cache (see
+        `bfore.cache.DiskCache`): a hash of all the inputs it depends on.
+        """
+        try :
+            source = inspect.getsource(self.comp.sed)
+        except (OSError, TypeError) :
+            source = None
+        fixed = {p: self.fixed_pars.get(p) for p in self.comp.get_parameters()
+                 if p not in self.var_pars}
+        return content_hash('SEDTable', self.inst.nu_packed, self.inst.bps_packed,
+                            self.inst.chan_offsets, self.comp.comp_name, source, fixed,
+                            self.var_pars, self.grids, self.method, n_check)
+
+    def evaluate(self, points, chunk_size=1024):
+        """ Directly computes the convolved SED for a set of parameter values.
+
+        Parameters
+        ----------
+        points: array_like(float)
+            Array with shape (N_points, N_var) with values of the varied
+            parameters.
+
+        Returns
+        -------
+        array_like(float)
+            Array with shape (N_points, N_freq).
+        """
+        points = np.atleast_2d(points)
+        out = np.empty([len(points), self.inst.n_channels])
+        for i0 in range(0, len(points), chunk_size) :
+            p = points[i0:i0 + chunk_size]
+            args = [self.fixed_pars.get(par) for par in self.comp.get_parameters()]
+            for ip, iv in enumerate(self.var_index) :
+                args[iv] = p[:, ip:ip + 1]
+            out[i0:i0 + chunk_size] = self.inst.convolve_sed(self.comp, args=tuple(args))
+        return out
+
+    def interpolate(self, x):
+        """ Interpolates the table at a point inside the grid.
+
+        Parameters
+        ----------
+        x: array_like(float)
+            Values of the varied parameters.
+
+        Returns
+        -------
+        array_like(float)
+            Convolved SED in each channel.
+        """
+        if self.method == 'cubic' :
+            cell = self._rgi(x[None, :])[0]
+        else :
+            cell = self._interpolate_linear(x)
+        if self.log :
+            return np.exp(cell)
+        return cell
+
+    def _interpolate_linear(self, x):
+        # multilinear interpolation over the 2^d corners of the enclosing cell
+        idx = []
+        frac = []
+        for xi, g in zip(x, self.grids) :
+            i = min(max(np.searchsorted(g, xi) - 1, 0), len(g) - 2)
+            idx.append(i)
+            frac.append((xi - g[i]) / (g[i + 1] - g[i]))
+        cell = self.table[tuple(slice(i, i + 2) for i in idx)]
+        for t in frac :
+            cell = cell[0] * (1 - t) + cell[1] * t
+        return cell
+
+    def check_accuracy(self, n_check=1000, seed=1234):
+        """ Returns the maximum relative interpolation error at the centres of
+        (a random subset of) the grid cells.
+        """
+        centres = [0.5 * (g[1:] + g[:-1]) for g in self.grids]
+        n_cells = np.prod([len(c) for c in centres])
+        if n_cells <= n_check :
+            points = np.array(list(itertools.product(*centres)))
+        else :
+            rng = np.random.RandomState(seed)
+            points = np.array([[c[rng.randint(len(c))] for c in centres]
+                               for i in range(n_check)])
+        direct = self.evaluate(points)
+        interp = np.array([self.interpolate(p) for p in points])
+        return np.max(np.fabs(interp - direct) / np.fabs(direct))
+
+    def __call__(self, args):
+        """ Returns the convolved SED for a given set of component arguments.
+
+        Parameters
+        ----------
+        args: tuple
+            Positional parameters taken by the component's SED. Only the
+            varied parameters are read, the rest are assumed to take the
+            values the table was built with.
+
+        Returns
+        -------
+        array_like(float) or None
+            Convolved SED in each channel, or None if the point lies outside
+            the grid.
+        """
+        x = np.array([args[i] for i in self.var_index], dtype=float)
+        if np.any(x < self.lo) or np.any(x > self.hi) :
+            return None
+        return self.interpolate(x)
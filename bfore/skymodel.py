@@ -54,13 +54,15 @@ class SkyModel(object) :
         nu: array_like(float)
             Frequencies in GHz at which to calculate the spectrum.
         params: dict
-            Parameters for all the SEDs
+            Parameters for all the SEDs. Parameter values may also be arrays
+            broadcastable against `nu` (e.g. with shape (N_sets, 1)) to
+            evaluate the SEDs for several parameter sets at once.
 
         Returns
         -------
         array_like(float)
             Matrix containing the scaling for each parameter. Shape is
-            (N_pol, N_comp, N_freq)
+            (N_comp, N_freq), or (N_sets, N_comp, N_freq) for batched parameters.
         """
         # if nu is not already array_like, make it so
         if not hasattr(nu, '__iter__'):
@@ -71,5 +73,137 @@ class SkyModel(object) :
         # the arguments for each of the seds.
         component_params = [tuple(params[par_name] for par_name in comp_par_names) for comp_par_names in self.comp_par_names]
         # calculate the seds
-        # Returns Ncomp x Nfreq array
-        return np.array([sed(nu, params) for (sed, params) in zip(self.components, component_params)])
+        seds = [sed(nu, params) for (sed, params) in zip(self.components, component_params)]
+        # Returns Ncomp x Nfreq array (or Nsets x Ncomp x Nfreq if batched)
+        return np.stack(np.broadcast_arrays(*seds), axis=-2)
+
+    def compile(self, var_pars, fixed_pars, nu):
+        """
+        Returns an evaluation plan for the SEDs of this model (see `SEDPlan`),
+        taking the varied parameters as a flat vector.
+
+        Parameters
+        ----------
+        var_pars: list(str)
+            Names of the varied parameters, in the order they will be passed.
+        fixed_pars: dict
+            Values of all other parameters.
+        nu: array_like(float)
+            Frequencies in GHz at which the SEDs will be evaluated.
+
+        Returns
+        -------
+        SEDPlan
+        """
+        return SEDPlan(self, var_pars, fixed_pars, nu)
+
+
+class SEDPlan(object) :
+    """
+    SEDs of a sky model evaluated at a fixed set of frequencies, for parameters
+    passed as a flat vector. The argument slots of each component are mapped to
+    positions in the vector once, with the fixed parameters pre-bound, so that
+    evaluating the SEDs involves no dictionary lookups. The SEDs of components
+    with no varied parameters are only computed once.
+    """
+    def __init__(self, sky_model, var_pars, fixed_pars, nu):
+        """
+        Builds the plan (see `SkyModel.compile`).
+        """
+        self.nu = np.atleast_1d(np.asarray(nu, dtype=float))
+        self.var_pars = list(var_pars)
+        self.ncomps = sky_model.ncomps
+        self.seds = [comp.sed for comp in sky_model.components]
+        # args[i] -> arguments of component i, with None in the varied slots
+        # slots[i] -> list of (argument slot, index in the parameter vector)
+        self.args = []
+        self.slots = []
+        for par_names in sky_model.comp_par_names :
+            args = []
+            slots = []
+            for j, p in enumerate(par_names) :
+                if p in self.var_pars :
+                    args.append(None)
+                    slots.append((j, self.var_pars.index(p)))
+                elif p in fixed_pars :
+                    args.append(fixed_pars[p])
+                else :
+                    raise ValueError("Parameter %s is neither fixed nor varied" % p)
+            self.args.append(args)
+            self.slots.append(slots)
+        self.constant = [None if len(slots) > 0 else
+                         np.broadcast_to(sed(self.nu, *args), self.nu.shape).copy()
+                         for sed, args, slots in zip(self.seds, self.args, self.slots)]
+
+    def component_args(self, x):
+        """ Returns the positional arguments of each component's SED for the
+        parameter vector `x` (see `var_pars`), as a list of tuples.
+        """
+        out = []
+        for args, slots in zip(self.args, self.slots) :
+            for j, k in slots :
+                args[j] = x[k]
+            out.append(tuple(args))
+        return out
+
+    def component_fnu(self, i, args, out=None):
+        """
+        Evaluates the SED of a single component.
+
+        Parameters
+        ----------
+        i: int
+            Index of the component.
+        args: tuple
+            Arguments of its SED (see `component_args`).
+        out: array_like(float)
+            Array with shape (N_nu,) where the SED will be stored (optional,
+            default=None, i.e. a new array is returned).
+
+        Returns
+        -------
+        array_like(float)
+            `out`, containing the SED.
+        """
+        if out is None :
+            out = np.empty(len(self.nu))
+        if self.constant[i] is not None :
+            out[:] = self.constant[i]
+        else :
+            out[:] = self.seds[i](self.nu, *args)
+        return out
+
+    def fnu(self, x, out=None):
+        """
+        Evaluates the SEDs.
+
+        Parameters
+        ----------
+        x: array_like(float)
+            Values of the varied parameters, with shape (N_var,), or
+            (N_sets, N_var) to evaluate several parameter sets at once.
+        out: array_like(float)
+            Array with shape (N_comp, N_nu) (or (N_sets, N_comp, N_nu)) where
+            the SEDs will be stored (optional, default=None, i.e. a new
+            array is returned).
+
+        Returns
+        -------
+        array_like(float)
+            `out`, containing the SED of each component.
+        """
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 2 :
+            # columns broadcast against nu
+            x = x.T[:, :, None]
+        if out is None :
+            out = np.empty(x.shape[1:-1] + (self.ncomps, len(self.nu)))
+        for i, (sed, args, slots, const) in enumerate(zip(self.seds, self.args,
+                                                          self.slots, self.constant)) :
+            if const is not None :
+                out[..., i, :] = const
+                continue
+            for j, k in slots :
+                args[j] = x[k]
+            out[..., i, :] = sed(self.nu, *args)
+        return out
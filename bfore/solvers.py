@@ -0,0 +1,351 @@
+from __future__ import print_function
+import warnings
+import numpy as np
+
+
+class BlockFactor(object):
+    """
+    Factorization of a stack of small symmetric positive-definite matrices,
+    such as the per-pixel amplitude covariances N_T^-1 = F N^-1 F^T.
+
+    Each block is factored once and the factor is then reused to compute
+    solutions, quadratic forms and log-determinants. Blocks with N <= 3 are
+    inverted in closed form, larger blocks use a batched Cholesky
+    decomposition.
+    """
+    def __init__(self, matrices, rcond=1E-12, warn=False):
+        """
+        Factors a stack of matrices.
+
+        Parameters
+        ----------
+        matrices: array_like(float)
+            Array with shape (..., N, N) containing symmetric positive-definite
+            matrices.
+        rcond: float
+            Blocks with a reciprocal condition number below this value are
+            reported as ill-conditioned (optional, default=1E-12, see
+            `ill_conditioned`).
+        warn: bool
+            If True, a single warning is issued if any ill-conditioned blocks
+            are found (optional, default=False). Otherwise the condition
+            numbers are only computed if `rcond` or `ill_conditioned` are
+            accessed, from `matrices`, which must not be modified before.
+
+        Raises
+        ------
+        numpy.linalg.LinAlgError
+            If any of the blocks is not positive definite.
+        """
+        matrices = np.asarray(matrices, dtype=float)
+        self.shape = matrices.shape[:-2]
+        self.n = matrices.shape[-1]
+        self.rcond_min = rcond
+        if self.n <= 3 :
+            self.method = 'closed'
+            self._inv, self.det, minors = _closed_form_inverse(matrices)
+            # Sylvester's criterion on the leading principal minors
+            bad = ~(minors[0] > 0)
+            for minor in minors[1:] :
+                bad |= ~(minor > 0)
+        else :
+            self.method = 'cholesky'
+            self._chol, bad = _cholesky_elements(matrices)
+        if np.any(bad) :
+            raise np.linalg.LinAlgError("Non positive-definite blocks at indices " +
+                                        _format_indices(bad))
+        # only needed to compute the condition numbers
+        self._matrices = matrices
+        self._rcond = None
+        if warn and np.any(self.ill_conditioned) :
+            warnings.warn("Ill-conditioned blocks found (see BlockFactor.ill_conditioned)",
+                          RuntimeWarning)
+
+    @property
+    def rcond(self):
+        """
+        Reciprocal 1-norm condition number of each block after Jacobi
+        scaling, D^-1/2 A D^-1/2 with D the diagonal of A.
+        """
+        if self._rcond is None :
+            # the condition number of the Jacobi-scaled matrix does not depend
+            # on the units of each row and column
+            sqrt_diag = np.sqrt(np.diagonal(self._matrices, axis1=-2, axis2=-1))
+            with np.errstate(divide='ignore', invalid='ignore') :
+                self._rcond = 1. / (_norm1(self._matrices, 1. / sqrt_diag) *
+                                    _norm1(self.inv, sqrt_diag))
+            self._matrices = None
+        return self._rcond
+
+    @property
+    def ill_conditioned(self):
+        """
+        Boolean mask flagging the blocks whose reciprocal condition number
+        (see `rcond`) is below the `rcond` threshold passed when factoring.
+        """
+        return ~(self.rcond >= self.rcond_min)
+
+    def solve(self, rhs):
+        """
+        Solves A x = rhs for each block.
+
+        Parameters
+        ----------
+        rhs: array_like(float)
+            Array with shape (..., N) or (..., N, K).
+
+        Returns
+        -------
+        array_like(float)
+            Solution, with the same shape as `rhs`.
+        """
+        rhs = np.asarray(rhs)
+        is_vec = (rhs.ndim == len(self.shape) + 1)
+        if is_vec :
+            rhs = rhs[..., None]
+        if self.method == 'closed' :
+            x = _closed_form_solve(self._inv, self.n, rhs)
+        else :
+            x = _cholesky_solve(self._chol, self.n, rhs)
+        if is_vec :
+            x = x[..., 0]
+        return x
+
+    def quadratic(self, rhs, sol=None):
+        """
+        Computes the quadratic form rhs^T A^-1 rhs for each block.
+
+        Parameters
+        ----------
+        rhs: array_like(float)
+            Array with shape (..., N).
+        sol: array_like(float)
+            Solution A^-1 rhs, if already available (optional, default=None).
+
+        Returns
+        -------
+        array_like(float)
+            Array with the same shape as the stack of blocks.
+        """
+        if sol is None :
+            sol = self.solve(rhs)
+        return np.sum(rhs * sol, axis=-1)
+
+    @property
+    def inv(self):
+        """
+        Inverse of each block, with shape (..., N, N).
+        """
+        if self.method == 'closed' :
+            inv = np.empty(self.shape + (self.n, self.n))
+            for (i, j), v in self._inv.items() :
+                inv[..., i, j] = v
+                inv[..., j, i] = v
+            return inv
+        else :
+            return self.solve(np.broadcast_to(np.eye(self.n), self.shape + (self.n, self.n)))
+
+    @property
+    def chol(self):
+        """
+        Lower-triangular Cholesky factor of each block, with shape
+        (..., N, N). Only available for blocks with N > 3.
+        """
+        chol = np.zeros(self.shape + (self.n, self.n))
+        for (i, j), v in self._chol.items() :
+            chol[..., i, j] = v
+        return chol
+
+    def draw(self, z):
+        """
+        Transforms standard normal deviates into draws from a Gaussian with
+        covariance A^-1 in each block. For Cholesky-factored blocks
+        A = L L^T, x = L^-T z; for the closed-form path, x = C z, with C the
+        Cholesky factor of A^-1.
+
+        Parameters
+        ----------
+        z: array_like(float)
+            Array with shape (..., N) (or (..., N, K) for K draws per block)
+            containing independent standard normal deviates.
+
+        Returns
+        -------
+        array_like(float)
+            Zero-mean draws, with the same shape as `z`.
+        """
+        z = np.asarray(z)
+        is_vec = (z.ndim == len(self.shape) + 1)
+        if is_vec :
+            z = z[..., None]
+        if self.method == 'closed' :
+            if not hasattr(self, '_inv_chol') :
+                inv = {(j, i): v for (i, j), v in self._inv.items()}
+                self._inv_chol = _cholesky_elements(_ElementMatrix(inv, self.n))[0]
+            x = _lower_multiply(self._inv_chol, self.n, z)
+        else :
+            x = _cholesky_back_substitute(self._chol, self.n, [z[..., i, :] for i in range(self.n)])
+        if is_vec :
+            x = x[..., 0]
+        return x
+
+    def logdet(self):
+        """
+        Returns the log-determinant of each block.
+        """
+        if self.method == 'closed' :
+            return np.log(self.det)
+        else :
+            return 2 * np.sum([np.log(self._chol[i, i]) for i in range(self.n)], axis=0)
+
+
+def _norm1(m, scale):
+    """ 1-norm (maximum absolute column sum) of S m S for a stack of (N,N)
+    matrices m, with S = diag(scale).
+    """
+    sm = np.abs(m) * scale[..., :, None] * scale[..., None, :]
+    return np.max(np.sum(sm, axis=-2), axis=-1)
+
+
+def _format_indices(mask, nmax=10):
+    """ Returns a short string listing the indices where `mask` is True.
+    """
+    ids = [tuple(int(i) for i in idx) for idx in np.argwhere(mask)[:nmax]]
+    if len(ids) > 0 and len(ids[0]) == 1 :
+        ids = [i[0] for i in ids]
+    s = str(ids)
+    if np.sum(mask) > nmax :
+        s += " (and %d more)" % (np.sum(mask) - nmax)
+    return s
+
+
+def _closed_form_inverse(m):
+    """ Inverse and determinant of a stack of symmetric (N,N) matrices with
+    N <= 3, computed from their cofactors.
+
+    Returns a dictionary with the independent elements (i,j), i<=j, of the
+    inverse, each stored as a contiguous array over the stack, the
+    determinant, and the leading principal minors.
+    """
+    n = m.shape[-1]
+    # Contiguous copies of the independent elements
+    e = {(i, j): np.ascontiguousarray(m[..., i, j]) for i in range(n) for j in range(i, n)}
+    if n == 1 :
+        det = e[0, 0]
+        cof = {(0, 0): np.ones_like(det)}
+        minors = [det]
+    elif n == 2 :
+        det = e[0, 0] * e[1, 1] - e[0, 1] ** 2
+        cof = {(0, 0): e[1, 1], (0, 1): -e[0, 1], (1, 1): e[0, 0]}
+        minors = [e[0, 0], det]
+    else :
+        a, b, c = e[0, 0], e[0, 1], e[0, 2]
+        d, g, f = e[1, 1], e[1, 2], e[2, 2]
+        cof = {(0, 0): d * f - g * g,
+               (0, 1): c * g - b * f,
+               (0, 2): b * g - c * d,
+               (1, 1): a * f - c * c,
+               (1, 2): b * c - a * g,
+               (2, 2): a * d - b * b}
+        det = a * cof[0, 0] + b * cof[0, 1] + c * cof[0, 2]
+        minors = [a, cof[2, 2], det]
+    with np.errstate(divide='ignore', invalid='ignore') :
+        idet = 1. / det
+    inv = {k: v * idet for k, v in cof.items()}
+    return inv, det, minors
+
+
+def _closed_form_solve(inv, n, rhs):
+    """ Computes x = A^-1 rhs from the independent elements of A^-1 returned by
+    `_closed_form_inverse`, for rhs with shape (..., N, K).
+    """
+    x = np.empty(np.broadcast_shapes(inv[0, 0].shape, rhs.shape[:-2]) + rhs.shape[-2:])
+    for i in range(n) :
+        xi = 0
+        for j in range(n) :
+            xi = xi + inv[min(i, j), max(i, j)][..., None] * rhs[..., j, :]
+        x[..., i, :] = xi
+    return x
+
+
+def _cholesky_elements(m):
+    """ Batched Cholesky decomposition of a stack of symmetric (N,N) matrices,
+    vectorized over the stack.
+
+    Returns a dictionary with the elements (i,j), i>=j, of the lower-triangular
+    factor, each stored as a contiguous array over the stack, and a boolean
+    mask flagging the blocks that are not positive definite.
+    """
+    n = m.shape[-1]
+    chol = {}
+    bad = np.zeros(m.shape[:-2], dtype=bool)
+    for j in range(n) :
+        s = np.array(m[..., j, j])
+        for k in range(j) :
+            s -= chol[j, k] ** 2
+        bad |= ~(s > 0)
+        with np.errstate(invalid='ignore') :
+            chol[j, j] = np.sqrt(s)
+        with np.errstate(divide='ignore', invalid='ignore') :
+            idiag = 1. / chol[j, j]
+        for i in range(j + 1, n) :
+            s = np.array(m[..., i, j])
+            for k in range(j) :
+                s -= chol[i, k] * chol[j, k]
+            s *= idiag
+            chol[i, j] = s
+    return chol, bad
+
+
+class _ElementMatrix(object):
+    """ Minimal stand-in for a (..., N, N) array built from a dictionary of
+    its lower-triangular elements, as read by `_cholesky_elements`.
+    """
+    def __init__(self, elements, n):
+        self.elements = elements
+        self.shape = np.shape(elements[0, 0]) + (n, n)
+
+    def __getitem__(self, idx):
+        i, j = idx[-2:]
+        return self.elements[max(i, j), min(i, j)]
+
+
+def _lower_multiply(chol, n, z):
+    """ Computes x = L z for L given by the elements returned by
+    `_cholesky_elements` and z with shape (..., N, K).
+    """
+    x = []
+    for i in range(n) :
+        s = 0
+        for k in range(i + 1) :
+            s = s + chol[i, k][..., None] * z[..., k, :]
+        x.append(s)
+    return np.stack(x, axis=-2)
+
+
+def _cholesky_back_substitute(chol, n, z):
+    """ Solves L^T x = z by back substitution, with L given by the elements
+    returned by `_cholesky_elements` and z given as a list of its N rows,
+    each with shape (..., K).
+    """
+    x = [None] * n
+    for i in range(n - 1, -1, -1) :
+        s = z[i]
+        for k in range(i + 1, n) :
+            s = s - chol[k, i][..., None] * x[k]
+        x[i] = s / chol[i, i][..., None]
+    return np.stack(x, axis=-2)
+
+
+def _cholesky_solve(chol, n, rhs):
+    """ Solves L L^T x = rhs by forward and back substitution, with L given by
+    the elements returned by `_cholesky_elements` and rhs with shape
+    (..., N, K).
+    """
+    z = []
+    for i in range(n) :
+        s = rhs[..., i, :]
+        for k in range(i) :
+            s = s - chol[i, k][..., None] * z[k]
+        z.append(s / chol[i, i][..., None])
+    return _cholesky_back_substitute(chol, n, z)
@@ -0,0 +1,51 @@
+from unittest import TestCase
+import numpy as np
+from multiprocessing import Pool
+from .setup_maplike import setup_maplike
+from bfore.amplitudes import RunningMoments, Reservoir, amplitude_maps
+
+class test_amplitudes(TestCase):
+    def setUp(self):
+        self.maplike, self.true_params = setup_maplike()
+        self.chains = np.array(self.true_params) + 0.01 * np.random.RandomState(1).randn(20, 4)
+        return
+
+    def test_moments(self):
+        rng = np.random.default_rng(1)
+        x = rng.standard_normal((1000, 3, 2))
+        acc = RunningMoments((3, 2)).update(x[:300])
+        acc.merge(RunningMoments((3, 2)).update(x[300:700])).update(x[700:])
+        self.assertEqual(acc.n, 1000)
+        self.assertTrue(np.allclose(acc.mean, np.mean(x, axis=0)))
+        self.assertTrue(np.allclose(acc.var, np.var(x, axis=0, ddof=1)))
+        # merged reservoirs keep a subsample of both streams
+        res = Reservoir(50, (1,)).update(np.zeros((100, 1)), rng)
+        res.merge(Reservoir(50, (1,)).update(np.ones((100, 1)), rng), rng)
+        self.assertEqual(res.n, 200)
+        self.assertTrue(0 < np.sum(res.samples) < 50)
+        return
+
+    def test_amplitude_maps(self):
+        ml = self.maplike
+        p = np.array(self.true_params)
+        # the mean of the draws for a fixed set of parameters tends to the
+        # conditional mean amplitudes
+        out = amplitude_maps(ml, np.tile(p, (200, 1)), batch_size=50, quantiles=[0.5], seed=1)
+        self.assertEqual(out['n'], 200)
+        mean = ml.get_amplitude_mean(p)
+        std = np.sqrt(np.diagonal(np.linalg.inv(ml.get_amplitude_covariance(p)), axis1=1, axis2=2))
+        self.assertTrue(np.all(np.fabs(out['mean'] - mean) < 5 * std / np.sqrt(200)))
+        self.assertTrue(np.allclose(np.median(out['std'] / std), 1, atol=0.1))
+        self.assertEqual(out['quantiles'].shape, (1,) + mean.shape)
+        # results don't depend on the pool
+        serial = amplitude_maps(ml, self.chains, n_draws=2, batch_size=6, seed=2)
+        pool = Pool(2)
+        pooled = amplitude_maps(ml, self.chains, n_draws=2, batch_size=6, seed=2, pool=pool)
+        pool.close()
+        self.assertTrue(np.allclose(serial['mean'], pooled['mean']))
+        self.assertTrue(np.allclose(serial['var'], pooled['var']))
+        # with no draws, the mean is that of the conditional means
+        means = amplitude_maps(ml, self.chains, n_draws=0)
+        self.assertTrue(np.allclose(means['mean'],
+                                    np.mean([ml.get_amplitude_mean(c) for c in self.chains], axis=0)))
+        return
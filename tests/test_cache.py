@@ -0,0 +1,81 @@
+from unittest import TestCase
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+from bfore.cache import DiskCache, content_hash
+
+def put_entry(args):
+    directory, i = args
+    cache = DiskCache(directory)
+    cache.put(content_hash('entry', i % 4), {'x': np.full(1000, i % 4)})
+    arrays = cache.get(content_hash('entry', i % 4))
+    return arrays is None or bool(np.all(arrays['x'] == i % 4))
+
+class test_DiskCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def test_content_hash(self):
+        a = np.linspace(0, 1, 10)
+        self.assertEqual(content_hash(a, {'b': 1., 'a': 'x'}), content_hash(a.copy(), {'a': 'x', 'b': 1.}))
+        self.assertEqual(content_hash(np.float64(1.)), content_hash(1.))
+        self.assertNotEqual(content_hash(a), content_hash(a.astype('float32')))
+        self.assertNotEqual(content_hash(a), content_hash(a.reshape([2, 5])))
+        self.assertNotEqual(content_hash([1, 2]), content_hash([[1, 2]]))
+        self.assertNotEqual(content_hash('a'), content_hash(b'a'))
+        self.assertRaises(TypeError, content_hash, object())
+        return
+
+    def test_get_put(self):
+        cache = DiskCache(self.directory)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', {'x': np.arange(10.), 'flag': True})
+        out = cache.get('a')
+        self.assertTrue(isinstance(out['x'], np.memmap))
+        self.assertTrue(np.all(out['x'] == np.arange(10.)))
+        self.assertTrue(bool(out['flag']))
+        # existing entries are kept, and visible from other objects
+        cache.put('a', {'x': np.zeros(10)})
+        self.assertTrue(np.all(DiskCache(self.directory).get('a')['x'] == np.arange(10.)))
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 1, 1))
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+        return
+
+    def test_eviction(self):
+        # room for ~3 entries of 8 kB
+        cache = DiskCache(self.directory, maxbytes=30000)
+        for key in 'abc' :
+            cache.put(key, {'x': np.zeros(1000)})
+            time.sleep(0.01)
+        # 'a' was used more recently than 'b'
+        cache.get('a')
+        os.utime(os.path.join(self.directory, 'a'), (time.time() + 1, time.time() + 1))
+        cache.put('d', {'x': np.zeros(1000)})
+        self.assertIsNone(cache.get('b'))
+        for key in 'acd' :
+            self.assertIsNotNone(cache.get(key))
+        self.assertTrue(cache.nbytes() <= 30000)
+        return
+
+    def test_concurrent(self):
+        pool = Pool(4)
+        try :
+            ok = pool.map(put_entry, [(self.directory, i) for i in range(32)])
+        finally :
+            pool.close()
+            pool.join()
+        self.assertTrue(all(ok))
+        self.assertEqual(DiskCache(self.directory).info()['size'], 4)
+        # no temporary directories left behind
+        self.assertEqual([f for f in os.listdir(self.directory) if f.startswith('.tmp')], [])
+        return
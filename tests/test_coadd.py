@@ -0,0 +1,123 @@
+from unittest import TestCase
+import numpy as np
+from bfore import MapLike
+from bfore.coadd import MapAccumulator
+from .setup_maplike import setup_maplike
+
+class test_coadd(TestCase):
+    def setUp(self):
+        self.maplike, self.true_params = setup_maplike()
+        ml = self.maplike
+        # three splits of each channel: the sky plus noise with 1, 2 and 3
+        # times the variance of the full data
+        rng = np.random.RandomState(1)
+        self.sky = ml.data.reshape([2, -1, ml.inst.n_channels])
+        self.var = ml.noisevar.reshape([2, -1, ml.inst.n_channels])
+        self.splits = [(s, self.sky + np.sqrt(s * self.var) * rng.randn(*self.sky.shape),
+                        s * self.var) for s in [1., 2., 3.]]
+        return
+
+    def fill(self, acc, channels, splits):
+        for ic in channels :
+            for s, d, v in splits :
+                acc.add(ic, d[..., ic], v[..., ic], split=s)
+        return acc
+
+    def test_coadd(self):
+        n_chan = self.maplike.inst.n_channels
+        acc = self.fill(MapAccumulator(), range(n_chan), self.splits)
+        self.assertEqual(acc.channels, list(range(n_chan)))
+        self.assertEqual(acc.splits(), [1., 2., 3.])
+        ivar = sum([1. / v for s, d, v in self.splits])
+        dataivar = sum([d / v for s, d, v in self.splits])
+        out = acc.coadd()
+        self.assertTrue(np.allclose(out['noiseivar'], ivar))
+        self.assertTrue(np.allclose(out['dataivar'], dataivar))
+        # merging accumulators filled separately, in any order
+        acc2 = self.fill(MapAccumulator(), range(n_chan)[::-1], self.splits[:1])
+        acc2.merge(self.fill(MapAccumulator(), range(n_chan), self.splits[1:]))
+        out2 = acc2.coadd(channels=range(n_chan))
+        for k in ['noiseivar', 'dataivar'] :
+            self.assertTrue(np.allclose(out[k], out2[k]))
+        # co-adding twice to the same split is the same as co-adding once
+        # with the inverse-variance combination
+        acc3 = self.fill(MapAccumulator(), range(n_chan), [(0, d, v) for s, d, v in self.splits])
+        self.assertEqual(acc3.splits(), [0])
+        for k in ['noiseivar', 'dataivar'] :
+            self.assertTrue(np.allclose(out[k], acc3.coadd()[k]))
+        # jackknife: all splits but one
+        jk = acc.coadd(splits=[2., 3.])
+        self.assertTrue(np.allclose(jk['noiseivar'], 1. / (2 * self.var) + 1. / (3 * self.var)))
+        # replacing and removing channels
+        acc.add(0, np.zeros(self.sky.shape[:2]), np.ones(self.sky.shape[:2]), split=1., replace=True)
+        acc.remove(1)
+        self.assertEqual(acc.channels, [0] + list(range(2, n_chan)))
+        ivar, dataivar = acc.ivar(channels=[0])
+        self.assertTrue(np.allclose(ivar[..., 0], 1 + 1. / (2 * self.var[..., 0]) +
+                                    1. / (3 * self.var[..., 0])))
+        with self.assertRaises(KeyError) :
+            acc.coadd(channels=range(n_chan))
+        with self.assertRaises(ValueError) :
+            acc.add(1, np.zeros(3), np.ones(3))
+        return
+
+    def test_null(self):
+        ml = self.maplike
+        acc = self.fill(MapAccumulator(), range(ml.inst.n_channels), self.splits)
+        null = acc.null([1.], [2., 3.])
+        # the sky cancels
+        chi2 = np.sum(null['dataivar'] ** 2 / null['noiseivar'])
+        n_dat = null['dataivar'].size
+        # same as the difference of the co-adds
+        a = acc.coadd(splits=[1.])
+        b = acc.coadd(splits=[2., 3.])
+        var = 0.25 * (1. / a['noiseivar'] + 1. / b['noiseivar'])
+        d = 0.5 * (a['dataivar'] / a['noiseivar'] - b['dataivar'] / b['noiseivar'])
+        self.assertTrue(np.allclose(null['noiseivar'], 1. / var))
+        self.assertTrue(np.allclose(null['dataivar'], d / var))
+        self.assertTrue(np.fabs(chi2 - n_dat) < 5 * np.sqrt(2 * n_dat))
+        with self.assertRaises(ValueError) :
+            acc.null([1.], [1., 2.])
+        # pixels missing from one of the sets are not observed
+        acc.add(0, np.zeros(self.sky.shape[:2]), np.full(self.sky.shape[:2], np.inf),
+                split=2., replace=True)
+        acc.add(0, np.zeros(self.sky.shape[:2]), np.full(self.sky.shape[:2], np.inf),
+                split=3., replace=True)
+        null = acc.null([1.], [2., 3.])
+        self.assertTrue(np.all(null['noiseivar'][..., 0] == 0))
+        self.assertTrue(np.all(null['dataivar'][..., 0] == 0))
+        return
+
+    def test_maplike(self):
+        ml = self.maplike
+        acc = self.fill(MapAccumulator(), range(ml.inst.n_channels), self.splits)
+        keys = ['var_pars', 'fixed_pars', 'var_prior_mean', 'var_prior_width', 'var_prior_type']
+        config = {k: getattr(ml, k) for k in keys}
+        ivar, dataivar = acc.ivar()
+        ml_acc = MapLike(dict(config, **acc.coadd()), ml.sky, ml.inst)
+        self.assertTrue(np.all(ml_acc.noiseivar == ivar.reshape([-1, ivar.shape[-1]])))
+        ml_ref = MapLike(dict(config, data=dataivar / ivar, noisevar=1. / ivar), ml.sky, ml.inst)
+        p = np.array(self.true_params)
+        self.assertTrue(np.isclose(ml_acc.marginal_spectral_likelihood(p),
+                                   ml_ref.marginal_spectral_likelihood(p)))
+        self.assertTrue(np.isclose(ml_acc.chi2(p), ml_ref.chi2(p)))
+        # unobserved pixels and channels
+        ivar[:, :10] = 0
+        ivar[:, 10:20, 3] = 0
+        # fewer channels than components: the pixel is dropped
+        ivar[1, 20, 2:] = 0
+        ml_acc = MapLike(dict(config, noiseivar=ivar, dataivar=np.where(ivar > 0, dataivar, np.nan)),
+                         ml.sky, ml.inst)
+        self.assertEqual(ml_acc.npix, ml.npix - 22)
+        self.assertFalse(20 in ml_acc.get_pixel_ids())
+        with np.errstate(divide='ignore') :
+            ml_ref = MapLike(dict(config, data=dataivar / np.where(ivar > 0, ivar, 1),
+                                  noisevar=1. / ivar), ml.sky, ml.inst)
+        self.assertTrue(np.isclose(ml_acc.marginal_spectral_likelihood(p),
+                                   ml_ref.marginal_spectral_likelihood(p)))
+        with self.assertRaises(ValueError) :
+            MapLike(dict(config, noiseivar=ivar, dataivar=dataivar, noisevar=1. / ivar),
+                    ml.sky, ml.inst)
+        with self.assertRaises(ValueError) :
+            MapLike(dict(config, noiseivar=ivar), ml.sky, ml.inst)
+        return
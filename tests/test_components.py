@@ -1,5 +1,6 @@
 from unittest import TestCase
 from bfore.components import Component, cmb, syncpl, dustmbb
+import numpy as np
 
 class test_Component(TestCase):
     def setUp(self):
@@ -13,3 +14,22 @@ class test_Component(TestCase):
         self.assertEqual(self.component_syncpl.get_parameters(), ["nu_ref_s", "beta_s"])
         self.assertEqual(self.component_dustmbb.get_parameters(), ["nu_ref_d", "beta_d", "T_d"])
         return
+
+    def test_derivatives(self):
+        nu = np.logspace(1, 2.8, 20)
+        for comp_name, args in [("syncpl", (23., -3.)),
+                                ("sync_curvedpl", (23., -3., 0.05)),
+                                ("dustmbb", (353., 1.6, 20.))]:
+            component = Component(comp_name)
+            derivs = component.derivatives(nu, args)
+            self.assertEqual(derivs.shape, (len(args), len(nu)))
+            for i in range(len(args)):
+                step = 1E-6 * abs(args[i])
+                args_p = list(args)
+                args_m = list(args)
+                args_p[i] += step
+                args_m[i] -= step
+                num = (component(nu, args_p) - component(nu, args_m)) / (2 * step)
+                self.assertTrue(np.allclose(derivs[i], num, rtol=1E-6, atol=0))
+        self.assertEqual(self.component_cmb.derivatives(nu, ()).shape, (0, 20))
+        return
@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import sys
+import json
+import subprocess
+
+HEAVY = ['healpy', 'scipy', 'emcee', 'numdifftools', 'matplotlib', 'astropy']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_after(code):
+    """ Runs `code` in a new interpreter and returns the heavy modules it
+    loaded.
+    """
+    report = ("import sys, json\n" + code +
+              "\nprint(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules) & set(%r))))"
+              % HEAVY)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    out = subprocess.check_output([sys.executable, '-c', report], env=env)
+    return json.loads(out.decode().strip().split('\n')[-1])
+
+
+class test_imports(TestCase):
+    def test_core(self):
+        # the likelihood only needs numpy
+        code = """
+import numpy as np
+import bfore
+nus = [30., 90., 150., 220., 350.]
+inst = bfore.InstrumentModel([{'nu': np.array([n])} for n in nus])
+sky = bfore.SkyModel(['syncpl', 'dustmbb', 'cmb'])
+config = {'data': np.random.randn(2, 12, len(nus)), 'noisevar': np.ones([2, 12, len(nus)]),
+          'var_pars': ['beta_s', 'beta_d', 'T_d'],
+          'fixed_pars': {'nu_ref_s': 23., 'nu_ref_d': 353.},
+          'var_prior_mean': [-3., 1.6, 20.], 'var_prior_width': [1., 1., 1.],
+          'var_prior_type': ['gauss', 'gauss', 'gauss']}
+ml = bfore.MapLike(config, sky, inst)
+assert np.isfinite(ml.marginal_spectral_likelihood(np.array([-3., 1.6, 20.])))
+ml.marginal_spectral_likelihood_grad(np.array([-3., 1.6, 20.]))
+ml.fisher_matrix(np.array([-3., 1.6, 20.]))
+"""
+        self.assertEqual(loaded_after(code), [])
+
+    def test_sampling(self):
+        # the samplers import their dependencies when they are called
+        self.assertEqual(loaded_after("from bfore.sampling import clean_pixels, run_fisher"), [])
+        self.assertEqual(loaded_after("import bfore\nbfore.run_emcee"), [])
+
+    def test_io(self):
+        # healpy is only needed to read FITS maps
+        self.assertEqual(loaded_after("from bfore.io import load_maplike"), [])
+
+    def test_lazy_attributes(self):
+        import bfore
+        from bfore import sampling
+        self.assertIs(bfore.sampling, sampling)
+        self.assertIs(bfore.run_emcee, sampling.run_emcee)
+        with self.assertRaises(AttributeError) :
+            bfore.not_an_attribute
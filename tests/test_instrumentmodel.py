@@ -0,0 +1,55 @@
+from unittest import TestCase
+from bfore import InstrumentModel, SkyModel
+import numpy as np
+
+class test_InstrumentModel(TestCase):
+    def setUp(self):
+        self.skymodel = SkyModel(["cmb", "dustmbb", "syncpl"])
+        self.params = {'nu_ref_d': 353., 'beta_d': 1.6, 'T_d': 20.,
+                       'nu_ref_s': 23., 'beta_s': -3.}
+        # ragged bandpasses: top-hats with different numbers of bins,
+        # plus two delta bandpasses
+        self.bandpasses = [{'nu': np.linspace(0.8 * n, 1.2 * n, nb + 1),
+                            'bps': np.ones(nb)}
+                           for n, nb in zip([30., 90., 150.], [5, 20, 11])]
+        self.bandpasses += [{'nu': np.array([219.5, 220.5]), 'bps': np.array([1.])},
+                            {'nu': np.array([353.]), 'bps': None}]
+        self.instrumentmodel = InstrumentModel(self.bandpasses)
+        return
+
+    def test_layout(self):
+        self.assertEqual(self.instrumentmodel.n_channels, 5)
+        self.assertEqual(list(np.diff(self.instrumentmodel.chan_offsets)), [5, 20, 11, 1, 1])
+        for bp in self.instrumentmodel.bps_arrs:
+            self.assertTrue(np.isclose(np.sum(bp), 1.))
+        return
+
+    def test_convolve_sed(self):
+        f_matrix = self.instrumentmodel.convolve_sed(self.skymodel.fnu, args=self.params)
+        self.assertEqual(f_matrix.shape, (3, 5))
+        # compare with a per-channel convolution
+        for i, (nu, bp) in enumerate(zip(self.instrumentmodel.nu_arrs,
+                                         self.instrumentmodel.bps_arrs)):
+            f_chan = np.sum(bp * self.skymodel.fnu(nu, self.params), axis=1)
+            self.assertTrue(np.allclose(f_matrix[:, i], f_chan))
+        f_delta = self.skymodel.fnu(np.array([220., 353.]), self.params)
+        self.assertTrue(np.allclose(f_matrix[:, 3:], f_delta))
+        return
+
+    def test_inst_params(self):
+        inst = self.instrumentmodel
+        self.assertEqual(inst.get_parameters()[:2], ['gain_0', 'gain_1'])
+        f_matrix = inst.convolve_sed(self.skymodel.fnu, args=self.params)
+        # gains scale the channel responses
+        f_gain = inst.convolve_sed(self.skymodel.fnu, args=self.params,
+                                   instpar={'gain_1': 1.1, 'gain_4': 0.9})
+        self.assertTrue(np.allclose(f_gain, f_matrix * np.array([1., 1.1, 1., 1., 0.9])))
+        # small shifts agree with the shifted bandpasses (to third order in the shift)
+        shifts = np.array([0.3, -1., 2., 0.5, -1.5])
+        f_shift = inst.convolve_sed(self.skymodel.fnu, args=self.params,
+                                    instpar={'shift_%d' % i: s for i, s in enumerate(shifts)})
+        bps_shifted = [dict(b, nu=b['nu'] + s) for b, s in zip(self.bandpasses, shifts)]
+        f_exact = InstrumentModel(bps_shifted).convolve_sed(self.skymodel.fnu, args=self.params)
+        self.assertTrue(np.allclose(f_shift, f_exact, rtol=1E-4, atol=0))
+        self.assertFalse(np.allclose(f_matrix, f_exact, rtol=1E-3, atol=0))
+        return
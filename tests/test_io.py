@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import healpy as hp
+from .setup_maplike import setup_maplike
+from bfore import MapLike
+from bfore.io import read_channel_map, stack_channel_maps, load_maplike
+
+class test_IO(TestCase):
+    def setUp(self):
+        self.maplike, self.true_params = setup_maplike()
+        self.tmpdir = tempfile.mkdtemp()
+        # write (N_pol, N_pix) maps for each channel
+        npix = self.maplike.npix // self.maplike.n_pol
+        self.data = self.maplike.data.reshape([self.maplike.n_pol, npix, -1])
+        self.noisevar = self.maplike.noisevar.reshape([self.maplike.n_pol, npix, -1])
+        self.files = {}
+        for name, maps in [('data', self.data), ('noisevar', self.noisevar)]:
+            self.files[name] = {'npy': [], 'fits': []}
+            for ic in range(maps.shape[-1]):
+                fname = os.path.join(self.tmpdir, '%s_%d' % (name, ic))
+                np.save(fname + '.npy', maps[:, :, ic])
+                # IQU map with a dummy temperature field
+                hp.write_map(fname + '.fits', [np.zeros(npix), maps[0, :, ic], maps[1, :, ic]],
+                             dtype=np.float64)
+                self.files[name]['npy'].append(fname + '.npy')
+                self.files[name]['fits'].append(fname + '.fits')
+        self.config = {k: getattr(self.maplike, k)
+                       for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                 'var_prior_width', 'var_prior_type']}
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        m_npy = read_channel_map(self.files['data']['npy'][0])
+        m_fits = read_channel_map(self.files['data']['fits'][0], fields=[1, 2])
+        self.assertTrue(np.all(m_npy == self.data[:, :, 0]))
+        self.assertTrue(np.all(m_fits == self.data[:, :, 0]))
+        stack = stack_channel_maps(self.files['data']['npy'],
+                                   os.path.join(self.tmpdir, 'stack.npy'), chunk_size=100)
+        self.assertTrue(isinstance(stack, np.memmap))
+        self.assertTrue(np.all(stack == self.data))
+
+    def test_load_maplike(self):
+        params = np.array(self.true_params) + 0.01
+        lkl = self.maplike.marginal_spectral_likelihood(params)
+        for fmt, fields in [('npy', None), ('fits', [1, 2])]:
+            storage_dir = os.path.join(self.tmpdir, fmt)
+            ml = load_maplike(self.config, self.maplike.sky, self.maplike.inst,
+                              self.files['data'][fmt], self.files['noisevar'][fmt],
+                              storage_dir, fields=fields)
+            self.assertTrue(isinstance(ml.dataivar, np.memmap))
+            self.assertTrue(isinstance(ml.noiseivar, np.memmap))
+            self.assertIsNone(ml.noise_groups)
+            self.assertTrue(os.path.isfile(os.path.join(storage_dir, 'data_maps.npy')))
+            self.assertTrue(np.isclose(ml.marginal_spectral_likelihood(params), lkl,
+                                       rtol=1E-10, atol=0))
+            # read in chunks
+            ml.memory_budget = 100 * ml._bytes_per_pixel()
+            self.assertTrue(np.isclose(ml.marginal_spectral_likelihood(params), lkl,
+                                       rtol=1E-10, atol=0))
+
+    def test_reuse(self):
+        storage_dir = os.path.join(self.tmpdir, 'stack')
+        args = (self.config, self.maplike.sky, self.maplike.inst)
+        files = self.files['data']['npy']
+        load_maplike(*args, files, self.files['noisevar']['npy'], storage_dir)
+        mtime = os.path.getmtime(os.path.join(storage_dir, 'data_maps.npy'))
+        # same inputs: the stacks are reused and the arrays are only read in
+        # chunks
+        config = dict(self.config, memory_budget=10 * 8 * 2 * self.data.shape[-1])
+        tracemalloc.start()
+        ml = load_maplike(config, *args[1:], files, self.files['noisevar']['npy'], storage_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(os.path.getmtime(os.path.join(storage_dir, 'data_maps.npy')), mtime)
+        self.assertTrue(peak < self.noisevar.nbytes / 2)
+        self.assertTrue(np.allclose(ml.dataivar, self.data.reshape([-1, self.data.shape[-1]]) /
+                                    self.noisevar.reshape([-1, self.data.shape[-1]])))
+        # objects sharing the directory have arrays of their own
+        ml2 = load_maplike(*args, files, self.files['noisevar']['npy'], storage_dir)
+        self.assertNotEqual(ml2.dataivar.filename, ml.dataivar.filename)
+        ml2.dataivar[:] = 0
+        self.assertTrue(np.allclose(ml.dataivar, self.data.reshape([-1, self.data.shape[-1]]) /
+                                    self.noisevar.reshape([-1, self.data.shape[-1]])))
+        # different channel order, fields or dtype: the stacks are rebuilt
+        ml = load_maplike(*args, files[::-1], self.files['noisevar']['npy'][::-1], storage_dir)
+        self.assertTrue(np.all(np.load(os.path.join(storage_dir, 'data_maps.npy')) ==
+                               self.data[..., ::-1]))
+        ml = load_maplike(*args, files, self.files['noisevar']['npy'], storage_dir,
+                          dtype='float32')
+        self.assertEqual(ml.dataivar.dtype, np.float32)
+        self.assertEqual(np.load(os.path.join(storage_dir, 'data_maps.npy')).dtype, np.float32)
+        with self.assertRaises(Exception) :
+            # fields that the .npy files don't have
+            load_maplike(*args, files, self.files['noisevar']['npy'], storage_dir,
+                         fields=[0, 1, 2])
+
+    def test_partial_sky(self):
+        npix = self.data.shape[1]
+        mask = np.arange(npix) < npix // 2
+        noisevar = self.noisevar.copy()
+        noisevar[:, ~mask] = np.inf
+        files = []
+        for ic in range(noisevar.shape[-1]):
+            fname = os.path.join(self.tmpdir, 'noisevar_partial_%d.npy' % ic)
+            np.save(fname, noisevar[:, :, ic])
+            files.append(fname)
+        params = np.array(self.true_params) + 0.01
+        ml_mem = MapLike(dict(self.config, data=self.data, noisevar=self.noisevar, mask=mask),
+                         self.maplike.sky, self.maplike.inst)
+        # the observed pixels are copied in chunks
+        config = dict(self.config, memory_budget=10 * 8 * 2 * self.data.shape[-1])
+        args = (config, self.maplike.sky, self.maplike.inst, self.files['data']['npy'], files,
+                os.path.join(self.tmpdir, 'partial'))
+        load_maplike(*args)
+        tracemalloc.start()
+        ml = load_maplike(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertTrue(peak < self.noisevar.nbytes / 2)
+        self.assertTrue(isinstance(ml.dataivar, np.memmap))
+        self.assertEqual(ml.npix, ml_mem.npix)
+        self.assertTrue(np.array_equal(ml.get_pixel_ids(), ml_mem.get_pixel_ids()))
+        self.assertTrue(np.isclose(ml.marginal_spectral_likelihood(params),
+                                   ml_mem.marginal_spectral_likelihood(params),
+                                   rtol=1E-10, atol=0))
@@ -4,10 +4,12 @@ import numpy as np
 import healpy as hp
 import matplotlib.pyplot as plt
 from .setup_maplike import setup_maplike
+from bfore import MapLike
 
 
 class test_MapLike(TestCase):
     def setUp(self):
+        np.random.seed(1234)
         self.maplike, self.true_params = setup_maplike()
         return
 
@@ -16,6 +18,203 @@ class test_MapLike(TestCase):
         print(covar_shape)
         return
 
+    def test_compressed_likelihood(self):
+        # uniform noise in setup_maplike -> a single noise group
+        self.assertEqual(len(self.maplike.noise_groups['ivar']), 1)
+        params = np.array(self.true_params) + 0.01
+        lkl_comp = self.maplike.marginal_spectral_likelihood(params)
+        noise_groups = self.maplike.noise_groups
+        self.maplike.noise_groups = None
+        lkl_pix = self.maplike.marginal_spectral_likelihood(params)
+        self.maplike.noise_groups = noise_groups
+        self.assertTrue(np.isclose(lkl_comp, lkl_pix, rtol=1e-10, atol=0))
+        # every pixel with its own noise -> per-pixel fallback
+        self.maplike.noiseivar = self.maplike.noiseivar * \
+            (1. + np.random.rand(self.maplike.npix))[:, None]
+        self.maplike.setup_noise_groups()
+        self.assertIsNone(self.maplike.noise_groups)
+        # no grouping in lean mode unless asked for
+        config = {k: getattr(self.maplike, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                                        'var_prior_width', 'var_prior_type']}
+        config.update(data=self.maplike.data, noisevar=np.ones_like(self.maplike.noisevar), lean=True)
+        self.assertIsNone(MapLike(config, self.maplike.sky, self.maplike.inst).noise_groups)
+        config['compress_noise'] = True
+        self.assertIsNotNone(MapLike(config, self.maplike.sky, self.maplike.inst).noise_groups)
+        return
+
+    def test_volume_prior(self):
+        # a flat prior on the amplitudes adds -0.5 log det(N_T^-1) per pixel
+        ml = self.maplike
+        params = np.array(self.true_params) + 0.01
+        logdet = np.sum(np.linalg.slogdet(ml.get_amplitude_covariance(params))[1])
+        lkl = ml.marginal_spectral_likelihood(params)
+        lkl_flat = ml.marginal_spectral_likelihood(params, volume_prior=False)
+        self.assertTrue(np.isclose(lkl_flat, lkl - 0.5 * logdet, rtol=1E-10, atol=0))
+        batch = ml.marginal_spectral_likelihood_batch(np.array([params, params]), volume_prior=False)
+        self.assertTrue(np.allclose(batch, lkl_flat, rtol=1E-10, atol=0))
+        # per-pixel path
+        ml.noise_groups = None
+        self.assertTrue(np.isclose(ml.marginal_spectral_likelihood(params, volume_prior=False),
+                                   lkl_flat, rtol=1E-10, atol=0))
+        batch = ml.marginal_spectral_likelihood_batch(np.array([params, params]), volume_prior=False)
+        self.assertTrue(np.allclose(batch, lkl_flat, rtol=1E-10, atol=0))
+        return
+
+    def test_sed_cache(self):
+        params = np.array(self.true_params)
+        f_cached = self.maplike.f_matrix(params)
+        caches = self.maplike.sed_caches
+        self.maplike.sed_caches = None
+        f_direct = self.maplike.f_matrix(params)
+        self.maplike.sed_caches = caches
+        self.assertTrue(np.allclose(f_cached, f_direct, rtol=1e-14, atol=0))
+        # changing T_d only recomputes the dust column
+        params[2] += 1.
+        self.maplike.f_matrix(params)
+        info = self.maplike.sed_cache_info()
+        self.assertEqual(info['components']['cmb']['misses'], 1)
+        self.assertEqual(info['components']['cmb']['hits'], 1)
+        self.assertEqual(info['components']['sync_curvedpl']['hits'], 1)
+        self.assertEqual(info['components']['dustmbb']['misses'], 2)
+        self.assertEqual(info['hits'], 2)
+        return
+
+    def test_sed_tables(self):
+        params = np.array(self.true_params) + 0.01
+        f_direct = self.maplike.f_matrix(params)
+        grids = {'beta_s': np.linspace(-3.5, -2.5, 41),
+                 'beta_c': np.linspace(-0.1, 0.2, 31),
+                 'beta_d': np.linspace(1.2, 2.0, 41),
+                 'T_d': np.linspace(15., 25., 41)}
+        self.maplike.tabulate_seds(grids, tol=1E-3)
+        self.assertIsNone(self.maplike.sed_tables[2])
+        f_table = self.maplike.f_matrix(params)
+        self.assertTrue(np.allclose(f_table, f_direct, rtol=1E-3, atol=0))
+        # outside the grid -> direct evaluation
+        params[2] = 40.
+        f_table = self.maplike.f_matrix(params)
+        self.maplike.sed_tables = None
+        self.maplike.sed_caches = None
+        self.assertTrue(np.allclose(self.maplike.f_matrix(params)[1], f_table[1], rtol=1E-14, atol=0))
+        return
+
+    def test_gradient(self):
+        params = np.array(self.true_params) + np.array([0.02, -0.03, 0.5, 0.01])
+        grad = self.maplike.marginal_spectral_likelihood_grad(params)
+        fisher = self.maplike.fisher_matrix(params)
+        # components near zero are compared against their Fisher scale
+        atol = 1E-3 * np.sqrt(np.diag(fisher))
+        for i in range(len(params)):
+            step = np.zeros(len(params))
+            step[i] = 1E-4 * abs(params[i])
+            num = (self.maplike.marginal_spectral_likelihood(params + step) -
+                   self.maplike.marginal_spectral_likelihood(params - step)) / (2 * step[i])
+            self.assertTrue(np.isclose(grad[i], num, rtol=1E-4, atol=atol[i]))
+        # per-pixel path agrees with the compressed one
+        self.maplike.noise_groups = None
+        self.assertTrue(np.allclose(self.maplike.marginal_spectral_likelihood_grad(params),
+                                    grad, rtol=1E-8, atol=0))
+        self.assertTrue(np.allclose(self.maplike.fisher_matrix(params),
+                                    fisher, rtol=1E-8, atol=0))
+        return
+
+    def test_ill_conditioned(self):
+        params = np.array(self.true_params)
+        self.assertEqual(len(self.maplike.ill_conditioned_pixels(params)), 0)
+        # a pixel effectively seen in only two channels
+        row = self.maplike.npix // 2 + 5
+        ivar = self.maplike.noiseivar[row].copy()
+        self.maplike.noiseivar[row] = 0
+        self.maplike.noiseivar[row, 4:6] = ivar[4:6]
+        self.maplike.noiseivar[row, 6] = 1E-10 * ivar[6]
+        bad = self.maplike.ill_conditioned_pixels(params)
+        self.assertTrue(np.array_equal(bad, [self.maplike.get_pixel_ids()[row]]))
+        return
+
+    def test_select_pixels(self):
+        params = np.array(self.true_params) + 0.01
+        patch_ids = self.maplike.get_patch_ids(2)
+        self.assertEqual(len(np.unique(patch_ids)), hp.nside2npix(2))
+        # contiguous selections are views
+        sub = self.maplike.select_pixels(slice(0, 100))
+        self.assertTrue(np.shares_memory(sub.dataivar, self.maplike.dataivar))
+        self.assertEqual(sub.npix, 100)
+        # the likelihood is additive over disjoint sets of pixels
+        lkl = [self.maplike.select_pixels(np.where(patch_ids == ip)[0]).marginal_spectral_likelihood(params, add_prior=False)
+               for ip in range(hp.nside2npix(2))]
+        self.assertTrue(np.isclose(np.sum(lkl), self.maplike.marginal_spectral_likelihood(params, add_prior=False)))
+        return
+
+    def test_batch(self):
+        params = np.array(self.true_params) + 0.01 * np.random.randn(20, 4)
+        params[3, 3] = 5.  # outside the top-hat prior
+        for noise_groups in [self.maplike.noise_groups, None]:
+            self.maplike.noise_groups = noise_groups
+            lkl_batch = self.maplike.marginal_spectral_likelihood_batch(params)
+            lkl = np.array([self.maplike.marginal_spectral_likelihood(p) for p in params])
+            self.assertEqual(lkl_batch[3], -np.inf)
+            self.assertTrue(np.allclose(lkl_batch[lkl > -np.inf], lkl[lkl > -np.inf],
+                                        rtol=1E-10, atol=0))
+        return
+
+    def test_chunks(self):
+        params = np.array(self.true_params) + 0.01
+        self.maplike.noise_groups = None
+        full = [self.maplike.marginal_spectral_likelihood(params),
+                self.maplike.marginal_spectral_likelihood_batch(params[None, :])[0],
+                self.maplike.marginal_spectral_likelihood_grad(params),
+                self.maplike.fisher_matrix(params),
+                self.maplike.chi2(params)]
+        # budget for ~10 pixels per chunk
+        self.maplike.memory_budget = 10 * self.maplike._bytes_per_pixel()
+        chunks = self.maplike.pixel_chunks()
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(sum(c.stop - c.start for c in chunks), self.maplike.npix)
+        chunked = [self.maplike.marginal_spectral_likelihood(params),
+                   self.maplike.marginal_spectral_likelihood_batch(params[None, :])[0],
+                   self.maplike.marginal_spectral_likelihood_grad(params),
+                   self.maplike.fisher_matrix(params),
+                   self.maplike.chi2(params)]
+        for a, b in zip(full, chunked):
+            self.assertTrue(np.allclose(a, b, rtol=1E-10, atol=0))
+        return
+
+    def test_lean(self):
+        # accuracy of the lean float32 mode with respect to the float64 one
+        ml = self.maplike
+        config = {k: getattr(ml, k) for k in ['data', 'noisevar', 'fixed_pars', 'var_pars',
+                                              'var_prior_mean', 'var_prior_width',
+                                              'var_prior_type']}
+        p0 = np.array(self.true_params)
+        p1 = p0 + 0.01
+        for dtype, rtol in [('float64', 1E-8), ('float32', 1E-3)]:
+            config.update(lean=True, dtype=dtype)
+            ml_lean = MapLike(config, ml.sky, ml.inst)
+            self.assertIsNone(ml_lean.data)
+            self.assertEqual(ml_lean.noiseivar.dtype, np.dtype(dtype))
+            for compress in [True, False]:
+                if compress:
+                    ml.setup_noise_groups()
+                    ml_lean.setup_noise_groups()
+                else:
+                    ml.noise_groups = None
+                    ml_lean.noise_groups = None
+                lkl = [m.marginal_spectral_likelihood(p0) for m in [ml, ml_lean]]
+                self.assertTrue(np.isclose(lkl[0], lkl[1], rtol=1E-3 * rtol, atol=0))
+                dlkl = [m.marginal_spectral_likelihood(p1) - m.marginal_spectral_likelihood(p0)
+                        for m in [ml, ml_lean]]
+                self.assertTrue(np.isclose(dlkl[0], dlkl[1], rtol=rtol, atol=0))
+                grad = [m.marginal_spectral_likelihood_grad(p1) for m in [ml, ml_lean]]
+                self.assertTrue(np.allclose(grad[0], grad[1], rtol=0,
+                                            atol=rtol * np.max(np.fabs(grad[0]))))
+                fisher = [m.fisher_matrix(p1) for m in [ml, ml_lean]]
+                self.assertTrue(np.allclose(fisher[0], fisher[1], rtol=0,
+                                            atol=rtol * np.max(np.fabs(fisher[0]))))
+            # computed as a difference of large numbers in lean mode
+            chi2 = [m.chi2(p0) for m in [ml, ml_lean]]
+            self.assertTrue(np.isclose(chi2[0], chi2[1], rtol=1E-4, atol=0))
+        return
+
     def test_likelihood(self):
         # get input data for each large pixel
         (beta_s_true, beta_d_true, T_d_true, beta_c_true) = self.true_params
@@ -103,3 +302,236 @@ class test_MapLike(TestCase):
         plt.show()
 
         return
+
+    def test_inst_params(self):
+        ml = self.maplike
+        inst_pars = ['gain_3', 'shift_5', 'shift_9']
+        config = {k: getattr(ml, k) for k in ['data', 'noisevar']}
+        config.update(var_pars=ml.var_pars + inst_pars,
+                      fixed_pars=dict(ml.fixed_pars, shift_1=0.2),
+                      var_prior_mean=list(ml.var_prior_mean) + [1., 0., 0.],
+                      var_prior_width=list(ml.var_prior_width) + [0.1, 1., 1.],
+                      var_prior_type=list(ml.var_prior_type) + ['gauss', 'gauss', 'gauss'])
+        for cache_size in [0, 128]:
+            config['sed_cache_size'] = cache_size
+            ml_inst = MapLike(config, ml.sky, ml.inst)
+            params = np.append(np.array(self.true_params) + 0.01, [1.02, 0.5, -1.])
+            instpar = {'gain_3': 1.02, 'shift_5': 0.5, 'shift_9': -1., 'shift_1': 0.2}
+            f_matrix = ml_inst.f_matrix(params)
+            par_dict = dict(ml.fixed_pars, **dict(zip(ml.var_pars, params)))
+            f_inst = ml.inst.convolve_sed(ml.sky.fnu, args=par_dict, instpar=instpar)
+            self.assertTrue(np.allclose(f_matrix, f_inst, rtol=1E-12, atol=0))
+            # call-time instrument parameters override the fixed ones
+            f_override = ml_inst.f_matrix(params, inst_params={'shift_1': 0.})
+            self.assertTrue(np.allclose(f_override[:, 1], f_matrix[:, 1] / f_inst[:, 1] *
+                                        ml.f_matrix(params[:4])[:, 1]))
+            self.assertTrue(np.allclose(ml_inst.f_matrix_batch(np.array([params, params]))[1],
+                                        f_matrix, rtol=1E-12, atol=0))
+            # derivatives with respect to all parameters
+            derivs = ml_inst.f_matrix_derivs(params)
+            for i in range(len(params)):
+                step = np.zeros(len(params))
+                step[i] = 1E-5 * max(abs(params[i]), 1.)
+                num = (ml_inst.f_matrix(params + step) - ml_inst.f_matrix(params - step)) / (2 * step[i])
+                self.assertTrue(np.allclose(derivs[i], num, rtol=1E-5, atol=1E-9 * np.max(np.fabs(num))))
+            grad = ml_inst.marginal_spectral_likelihood_grad(params)
+            self.assertEqual(grad.shape, (7,))
+        return
+
+    def test_noisecov(self):
+        ml = self.maplike
+        n_pix = ml.npix // 2
+        noisevar = ml.noisevar.reshape([2, n_pix, -1])
+        config = {k: getattr(ml, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                              'var_prior_width', 'var_prior_type']}
+        config['data'] = ml.data.reshape([2, n_pix, -1])
+        params = np.array(self.true_params) + 0.01
+        # uncorrelated Q and U -> same as the diagonal noise variance
+        cov = np.zeros([n_pix, ml.inst.n_channels, 2, 2])
+        cov[..., 0, 0] = noisevar[0]
+        cov[..., 1, 1] = noisevar[1]
+        ml_cov = MapLike(dict(config, noisecov=cov), ml.sky, ml.inst)
+        self.assertIsNone(ml_cov.noiseivar_qu)
+        self.assertEqual(ml_cov.marginal_spectral_likelihood(params),
+                         ml.marginal_spectral_likelihood(params))
+        # correlated noise, compared with a dense solution
+        rho = np.random.RandomState(1).uniform(-0.5, 0.5, [n_pix, ml.inst.n_channels])
+        cov[..., 0, 1] = cov[..., 1, 0] = rho * np.sqrt(noisevar[0] * noisevar[1])
+        ml_cov = MapLike(dict(config, noisecov=cov), ml.sky, ml.inst)
+        self.assertIsNone(ml_cov.noise_groups)
+        f_matrix = ml.f_matrix(params)
+        icov = np.linalg.inv(cov)
+        # a_mat -> (N_pix,2*N_comp,2*N_comp), amplitudes ordered (Q comps, U comps)
+        a_mat = np.einsum("if,jf,pfab->paibj", f_matrix, f_matrix, icov).reshape([n_pix, 6, 6])
+        d = np.transpose(config['data'], axes=[1, 2, 0])
+        y = np.einsum("if,pfab,pfb->pai", f_matrix, icov, d).reshape([n_pix, 6])
+        amps = np.linalg.solve(a_mat, y[:, :, None])[:, :, 0]
+        lkl = 0.5 * np.sum(y * amps) + ml.logprior(params)
+        self.assertTrue(np.isclose(ml_cov.marginal_spectral_likelihood(params), lkl, rtol=1E-10, atol=0))
+        lkl_flat = lkl - 0.5 * np.sum(np.linalg.slogdet(a_mat)[1])
+        self.assertTrue(np.isclose(ml_cov.marginal_spectral_likelihood(params, volume_prior=False),
+                                   lkl_flat, rtol=1E-10, atol=0))
+        self.assertTrue(np.allclose(ml_cov.get_amplitude_mean(params),
+                                    np.concatenate([amps[:, :3], amps[:, 3:]]), rtol=1E-8))
+        res = d - np.einsum("pai,if->pfa", amps.reshape([n_pix, 2, 3]), f_matrix)
+        chi2 = np.einsum("pfa,pfab,pfb->", res, icov, res)
+        self.assertTrue(np.isclose(ml_cov.chi2(params), chi2, rtol=1E-6, atol=0))
+        self.assertTrue(np.isclose(ml_cov.marginal_spectral_likelihood_batch(params[None, :])[0], lkl,
+                                   rtol=1E-10, atol=0))
+        # gradient and Fisher matrix, and chunking
+        grad = ml_cov.marginal_spectral_likelihood_grad(params)
+        for i in range(len(params)):
+            step = np.zeros(len(params))
+            step[i] = 1E-5 * abs(params[i])
+            num = (ml_cov.marginal_spectral_likelihood(params + step) -
+                   ml_cov.marginal_spectral_likelihood(params - step)) / (2 * step[i])
+            self.assertTrue(np.isclose(grad[i], num, rtol=1E-4, atol=0))
+        fisher = ml_cov.fisher_matrix(params)
+        ml_cov.memory_budget = 40 * ml_cov._bytes_per_pixel()
+        self.assertTrue(np.isclose(ml_cov.marginal_spectral_likelihood(params), lkl, rtol=1E-10, atol=0))
+        self.assertTrue(np.allclose(ml_cov.fisher_matrix(params), fisher, rtol=1E-8, atol=0))
+        self.assertTrue(np.allclose(ml_cov.marginal_spectral_likelihood_grad(params), grad,
+                                    rtol=1E-8, atol=0))
+        # Q and U rows of a pixel are selected together
+        patch_ids = ml_cov.get_patch_ids(2)
+        lkl = [ml_cov.select_pixels(np.where(patch_ids == ip)[0]).marginal_spectral_likelihood(params, add_prior=False)
+               for ip in range(hp.nside2npix(2))]
+        self.assertTrue(np.isclose(np.sum(lkl), ml_cov.marginal_spectral_likelihood(params, add_prior=False)))
+        with self.assertRaises(ValueError):
+            ml_cov.select_pixels(slice(0, 10))
+        return
+
+    def test_partial_sky(self):
+        ml = self.maplike
+        n_pix = ml.npix // 2
+        nside = ml.get_nside()
+        config = {k: getattr(ml, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                              'var_prior_width', 'var_prior_type']}
+        data = ml.data.reshape([2, n_pix, -1])
+        noisevar = ml.noisevar.reshape([2, n_pix, -1])
+        params = np.array(self.true_params) + 0.01
+        # observed pixels: a disc, with one channel missing in part of it
+        ipix = hp.query_disc(nside, [1., 0., 0.], 0.6)
+        mask = np.zeros(n_pix, dtype=bool)
+        mask[ipix] = True
+        rows = np.concatenate([ipix, ipix + n_pix])
+        sub = ml.select_pixels(rows)
+        lkl = sub.marginal_spectral_likelihood(params)
+        # from full maps with a mask, with infinite variance and from compact arrays
+        var_inf = noisevar.copy()
+        var_inf[:, ~mask] = np.inf
+        data_nan = data.copy()
+        data_nan[:, ~mask] = np.nan
+        mls = [MapLike(dict(config, data=data, noisevar=noisevar, mask=mask), ml.sky, ml.inst),
+               MapLike(dict(config, data=data_nan, noisevar=var_inf), ml.sky, ml.inst),
+               MapLike(dict(config, data=data[:, ipix], noisevar=noisevar[:, ipix],
+                            pixel_ids=ipix, nside=nside), ml.sky, ml.inst)]
+        for m in mls:
+            self.assertEqual(m.npix, len(rows))
+            self.assertTrue(np.array_equal(m.get_pixel_ids(), sub.get_pixel_ids()))
+            self.assertTrue(np.isclose(m.marginal_spectral_likelihood(params), lkl, rtol=1E-12, atol=0))
+            amps = m.to_healpix(m.get_amplitude_mean(params))
+            self.assertEqual(amps.shape, (2, n_pix, 3))
+            self.assertTrue(np.all(amps[:, ~mask] == hp.UNSEEN))
+            self.assertTrue(np.allclose(amps[:, mask], ml.to_healpix(ml.get_amplitude_mean(params))[:, mask]))
+        # unobserved channels get zero weight
+        var_inf[0, ipix[:10], 3] = np.inf
+        data_nan[0, ipix[:10], 3] = np.nan
+        m = MapLike(dict(config, data=data_nan, noisevar=var_inf, lean=True), ml.sky, ml.inst)
+        self.assertTrue(np.isfinite(m.marginal_spectral_likelihood(params)))
+        self.assertTrue(np.isfinite(m.chi2(params)))
+        m_full = MapLike(dict(config, data=data_nan, noisevar=var_inf), ml.sky, ml.inst)
+        self.assertTrue(np.isclose(m_full.chi2(params), m.chi2(params), rtol=1E-8, atol=0))
+        # pixels seen in fewer channels than components are dropped
+        var_inf[0, ipix[20], 1:] = np.inf
+        var_inf[1, ipix[21], 2:] = np.inf
+        for lean in [False, True]:
+            m = MapLike(dict(config, data=data_nan, noisevar=var_inf, lean=lean), ml.sky, ml.inst)
+            self.assertEqual(m.npix, len(rows) - 4)
+            self.assertFalse(np.any(np.isin(ipix[20:22], m.get_pixel_ids())))
+            self.assertTrue(np.isfinite(m.marginal_spectral_likelihood(params)))
+            self.assertTrue(np.isfinite(m.chi2(params)))
+            # compressed path without lean mode
+            self.assertEqual(m.noise_groups is None, lean)
+        return
+
+    def test_degrade(self):
+        ml = self.maplike
+        params = np.array(self.true_params) + 0.01
+        # degrading to the same resolution changes nothing
+        same = ml.degrade(ml.get_nside())
+        self.assertTrue(np.isclose(same.marginal_spectral_likelihood(params),
+                                   ml.marginal_spectral_likelihood(params), rtol=1E-12, atol=0))
+        # inverse-variance weighting
+        low = ml.degrade(2)
+        self.assertEqual(low.npix, 2 * hp.nside2npix(2))
+        rows = np.where((ml.get_patch_ids(2) == 5) & (ml.get_pol_ids() == 1))[0]
+        ivar = np.sum(ml.noiseivar[rows], axis=0)
+        row = np.where((low.get_pixel_ids() == 5) & (low.get_pol_ids() == 1))[0][0]
+        self.assertTrue(np.allclose(low.noisevar[row], 1. / ivar))
+        self.assertTrue(np.allclose(low.data[row], np.sum(ml.dataivar[rows], axis=0) / ivar))
+        # correlated Q/U noise, from a partial-sky map
+        n_pix = ml.npix // 2
+        cov = np.zeros([n_pix, ml.inst.n_channels, 2, 2])
+        noisevar = ml.noisevar.reshape([2, n_pix, -1])
+        cov[..., 0, 0] = noisevar[0]
+        cov[..., 1, 1] = noisevar[1]
+        cov[..., 0, 1] = cov[..., 1, 0] = 0.3 * np.sqrt(noisevar[0] * noisevar[1])
+        config = {k: getattr(ml, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                              'var_prior_width', 'var_prior_type']}
+        mask = ml.get_patch_ids(2)[:n_pix] < 10
+        ml_cov = MapLike(dict(config, data=ml.data.reshape([2, n_pix, -1]), noisecov=cov, mask=mask),
+                         ml.sky, ml.inst)
+        low = ml_cov.degrade(2)
+        self.assertEqual(low.npix, 20)
+        self.assertTrue(np.isclose(ml_cov.degrade(8).marginal_spectral_likelihood(params),
+                                   ml_cov.marginal_spectral_likelihood(params), rtol=1E-12, atol=0))
+        rows = np.where(ml_cov.get_patch_ids(2)[:ml_cov.npix // 2] == 5)[0]
+        icov = np.sum(np.linalg.inv(ml_cov.noisecov[rows]), axis=0)
+        self.assertTrue(np.allclose(low.noisecov[5], np.linalg.inv(icov)))
+        return
+
+    def test_realizations(self):
+        ml = self.maplike
+        n_pix = ml.npix // 2
+        noisevar = ml.noisevar.reshape([2, n_pix, -1])
+        config = {k: getattr(ml, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                              'var_prior_width', 'var_prior_type']}
+        rng = np.random.RandomState(2)
+        sims = (ml.data.reshape([2, n_pix, -1]) +
+                np.sqrt(noisevar) * rng.randn(3, 2, n_pix, ml.inst.n_channels))
+        params = np.array(self.true_params) + 0.01
+        for extra in [{}, {'lean': True, 'memory_budget': 40 * ml._bytes_per_pixel()},
+                      {'mask': np.arange(n_pix) % 3 > 0}] :
+            ml_sims = MapLike(dict(config, data=sims, noisevar=noisevar, **extra), ml.sky, ml.inst)
+            self.assertEqual(ml_sims.n_sims, 3)
+            singles = [MapLike(dict(config, data=d, noisevar=noisevar, **extra), ml.sky, ml.inst)
+                       for d in sims]
+            for groups in [True, False] :
+                if not groups :
+                    ml_sims.noise_groups = None
+                    for m in singles :
+                        m.noise_groups = None
+                lkl = ml_sims.marginal_spectral_likelihood(params)
+                self.assertEqual(lkl.shape, (3,))
+                self.assertTrue(np.allclose(lkl, [m.marginal_spectral_likelihood(params) for m in singles],
+                                            rtol=1E-10, atol=0))
+                self.assertTrue(np.allclose(ml_sims.marginal_spectral_likelihood_grad(params),
+                                            [m.marginal_spectral_likelihood_grad(params) for m in singles],
+                                            rtol=1E-8, atol=0))
+                self.assertTrue(np.allclose(ml_sims.fisher_matrix(params),
+                                            [m.fisher_matrix(params) for m in singles],
+                                            rtol=1E-8, atol=0))
+            self.assertTrue(np.allclose(ml_sims.chi2(params), [m.chi2(params) for m in singles],
+                                        rtol=1E-8, atol=0))
+            self.assertTrue(np.allclose(ml_sims.get_amplitude_mean(params),
+                                        [m.get_amplitude_mean(params) for m in singles], rtol=1E-8))
+            one = ml_sims.realization(1)
+            self.assertTrue(np.isclose(one.marginal_spectral_likelihood(params),
+                                       singles[1].marginal_spectral_likelihood(params), rtol=1E-10, atol=0))
+        self.assertTrue(np.all(ml_sims.marginal_spectral_likelihood(params + np.array([0, 0, 0, 10.])) == -np.inf))
+        with self.assertRaises(ValueError):
+            ml_sims.marginal_spectral_likelihood_batch(params[None, :])
+        with self.assertRaises(ValueError):
+            ml.realization(0)
+        return
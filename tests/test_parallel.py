@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import pickle
+import numpy as np
+from multiprocessing import Pool
+from .setup_maplike import setup_maplike
+from bfore.parallel import SharedArray, share_array, release_array
+
+def _write_one(arr):
+    arr[0] = 1.
+    return np.sum(arr)
+
+class test_Parallel(TestCase):
+    def test_share_array(self):
+        x = np.random.randn(10, 3)
+        for backend in ['shm', 'memmap']:
+            xs = share_array(x, backend=backend)
+            self.assertTrue(isinstance(xs, SharedArray))
+            self.assertTrue(np.all(xs == x))
+            # views are pickled as references to the shared block
+            view = xs[2:5, 1]
+            s = pickle.dumps(view)
+            self.assertTrue(len(s) < view.nbytes + 100 or backend == 'shm')
+            view2 = pickle.loads(s)
+            self.assertTrue(np.all(view2 == x[2:5, 1]))
+            view2[0] = 100.
+            self.assertEqual(xs[2, 1], 100.)
+            # arrays derived from shared arrays are copied
+            y = pickle.loads(pickle.dumps(2 * xs))
+            self.assertTrue(np.all(y == 2 * xs))
+            self.assertFalse(np.shares_memory(y, xs))
+            release_array(xs)
+
+    def test_workers(self):
+        xs = share_array(np.zeros([4, 5]))
+        pool = Pool(2)
+        sums = pool.map(_write_one, [xs[i] for i in range(4)])
+        pool.close()
+        pool.join()
+        # workers wrote into the shared memory
+        self.assertTrue(np.all(xs[:, 0] == 1.))
+        self.assertTrue(np.all(np.array(sums) == 1.))
+        release_array(xs)
+
+    def test_maplike(self):
+        maplike, true_params = setup_maplike()
+        true_params = np.array(true_params)
+        like = maplike.marginal_spectral_likelihood(true_params)
+        maplike.share_memory()
+        self.assertTrue(isinstance(maplike.data, SharedArray))
+        ml2 = pickle.loads(pickle.dumps(maplike))
+        self.assertTrue(np.shares_memory(ml2.noiseivar, maplike.noiseivar) or
+                        np.all(ml2.noiseivar == maplike.noiseivar))
+        self.assertTrue(np.isclose(ml2.marginal_spectral_likelihood(true_params), like))
+        maplike.release_memory()
+        self.assertFalse(isinstance(maplike.data, SharedArray))
+        self.assertTrue(np.isclose(maplike.marginal_spectral_likelihood(true_params), like))
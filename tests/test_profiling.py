@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+from unittest import TestCase
+import os
+import json
+import tempfile
+import numpy as np
+from .setup_maplike import setup_maplike
+from bfore.profiling import Stats, timer
+from bfore.sampling import clean_pixels, run_minimize, run_emcee
+
+class test_Profiling(TestCase):
+    def setUp(self):
+        self.maplike, self.true_params = setup_maplike()
+        self.params = np.array(self.true_params)
+        return
+
+    def test_stats(self):
+        stats = Stats()
+        for i in range(3):
+            with stats.timer('a'):
+                pass
+        stats.add('b', 1., n=2)
+        other = Stats()
+        other.add('b', 2.)
+        stats.merge(other)
+        d = stats.as_dict()
+        self.assertEqual(d['a']['count'], 3)
+        self.assertEqual(d['b']['count'], 3)
+        self.assertEqual(d['b']['time'], 3.)
+        self.assertTrue('a' in stats.report())
+        # disabled timers are a shared no-op
+        self.assertIs(timer(None, 'a'), timer(None, 'b'))
+
+    def test_maplike(self):
+        self.assertIsNone(self.maplike.stats)
+        self.maplike.stats = Stats()
+        lkl = self.maplike.marginal_spectral_likelihood(self.params)
+        counts = self.maplike.stats.counts
+        for stage in ['f_matrix', 'covariance', 'solve', 'quadratic', 'prior']:
+            self.assertEqual(counts[stage], 1)
+        stats = self.maplike.stats
+        self.maplike.stats = None
+        self.assertEqual(self.maplike.marginal_spectral_likelihood(self.params), lkl)
+        self.maplike.stats = stats
+        # per-pixel path, batched likelihood
+        self.maplike.noise_groups = None
+        self.maplike.marginal_spectral_likelihood_batch(self.params[None, :])
+        self.assertEqual(counts['solve'], 2)
+
+    def test_samplers(self):
+        self.maplike.stats = Stats()
+        fname = os.path.join(tempfile.mkdtemp(), 'stats.json')
+        rdict = clean_pixels(self.maplike, run_minimize, stats_file=fname,
+                             options={'xtol': 1E-4, 'ftol': 1E-4})
+        stats = rdict['stats']
+        self.assertEqual(stats['n_evals'], rdict['ML_nev'])
+        self.assertTrue(stats['evals_per_sec'] > 0)
+        self.assertEqual(stats['stages']['likelihood']['count'], rdict['ML_nev'])
+        # points outside the top-hat priors skip the F matrix
+        self.assertTrue(stats['stages']['f_matrix']['count'] <= rdict['ML_nev'])
+        with open(fname) as f:
+            self.assertEqual(json.load(f)['n_evals'], rdict['ML_nev'])
+        rdict = run_emcee(self.maplike.marginal_spectral_likelihood, self.params,
+                          nwalkers=10, nsamps=10, nburn=0, stats=Stats())
+        self.assertEqual(rdict['stats']['n_evals'], 110)
+        self.assertEqual(rdict['stats']['stages']['likelihood']['count'], 110)
+        os.remove(fname)
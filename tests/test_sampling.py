@@ -4,7 +4,13 @@ import numpy as np
 import healpy as hp
 import matplotlib.pyplot as plt
 from .setup_maplike import setup_maplike
-from bfore.sampling import clean_pixels, run_emcee, run_minimize, run_fisher
+from bfore.sampling import (clean_pixels, clean_patches, run_emcee, run_minimize, run_fisher,
+                            run_multires, clean_realizations)
+from bfore import MapLike
+from multiprocessing import Pool
+import warnings
+import shutil
+import tempfile
 import corner
 
 class test_MapLike(TestCase):
@@ -61,6 +67,126 @@ class test_MapLike(TestCase):
         print(" Paramb bias: ",pbias)
         print("\n")
 
+    def test_fisher_analytic(self):
+        print('Fisher sampler, analytic derivatives')
+        pos0=np.array(self.true_params)+np.array([0.01,-0.01,0.2,0.005])
+        rdict=run_fisher(self.maplike.marginal_spectral_likelihood,pos0,
+                         grad=self.maplike.marginal_spectral_likelihood_grad,
+                         fisher=self.maplike.fisher_matrix)
+        rdict_num=run_fisher(self.maplike.marginal_spectral_likelihood,pos0)
+        self.assertTrue(np.allclose(rdict['fisher_v'],rdict_num['fisher_v'],rtol=1E-4))
+        # Gauss-Newton vs. numerical Hessian
+        self.assertTrue(np.allclose(rdict['fisher_m'],rdict_num['fisher_m'],rtol=0.1))
+        rdict=clean_pixels(self.maplike,run_minimize,analytic_derivatives=True,method='L-BFGS-B')
+        print(" Param truth: ",self.true_params)
+        print(" Param ML (L-BFGS-B): ",rdict['params_ML'])
+        print("\n")
+        # the gradient is only passed to gradient-based methods
+        with warnings.catch_warnings() :
+            warnings.simplefilter('error')
+            clean_pixels(self.maplike,run_minimize,analytic_derivatives=True,
+                         options={'maxiter':1})
+
+    def test_clean_patches(self):
+        print('Per-patch maximum likelihood')
+        nside_spec=2
+        rdict=clean_patches(self.maplike,run_minimize,nside_spec,
+                            options={'xtol':1E-4,'ftol':1E-4})
+        self.assertEqual(rdict['params_map'].shape,(4,hp.nside2npix(nside_spec)))
+        self.assertTrue(np.all(rdict['success_map']))
+        # same fits distributed over a pool of processes
+        pool=Pool(2)
+        rdict_pool=clean_patches(self.maplike,run_minimize,nside_spec,pool=pool,
+                                 options={'xtol':1E-4,'ftol':1E-4})
+        pool.close()
+        self.assertTrue(np.allclose(rdict['params_map'],rdict_pool['params_map']))
+        # fitting a single patch directly gives the same result
+        ipatch=5
+        rows=np.where(self.maplike.get_patch_ids(nside_spec)==ipatch)[0]
+        rdict_patch=clean_pixels(self.maplike.select_pixels(rows),run_minimize,
+                                 options={'xtol':1E-4,'ftol':1E-4})
+        self.assertTrue(np.allclose(rdict_patch['params_ML'],rdict['params_map'][:,ipatch]))
+        print(" Param truth: ",self.true_params)
+        print(" Param median over patches: ",np.median(rdict['params_map'],axis=1))
+        print("\n")
+
+    def test_clean_patches_views(self):
+        # with the rows of each patch already contiguous, the patches are views of the data
+        ml=self.maplike
+        n_pix=ml.npix//2
+        config={k:getattr(ml,k) for k in ['fixed_pars','var_pars','var_prior_mean',
+                                          'var_prior_width','var_prior_type']}
+        ml_q=MapLike(dict(config,data=ml.data[:n_pix],noisevar=ml.noisevar[:n_pix],nest=True),
+                     ml.sky,ml.inst)
+        for m,view in [(ml_q,True),(ml,False)]:
+            def sampler(func,pos0,dpos=None):
+                return {'params_ML':pos0,'view':np.shares_memory(func.__self__.dataivar,m.dataivar)}
+            rdict=clean_patches(m,sampler,2)
+            self.assertTrue(all(r['view']==view for r in rdict['patch_results'].values()))
+
+    def test_emcee_vectorized(self):
+        sampler_args = {
+            "nwalkers": 20,
+            "nsamps": 100,
+            "nburn": 20,
+            "vectorize": True
+        }
+        samples=clean_pixels(self.maplike,run_emcee,**sampler_args)['chains']
+        self.assertEqual(samples.shape,(20*80,4))
+        print("Param medians (vectorized): ",np.median(samples,axis=0))
+
+    def test_emcee_checkpoint(self):
+        func=self.maplike.marginal_spectral_likelihood
+        pos0=np.array(self.true_params)
+        tmpdir=tempfile.mkdtemp()
+        args={'nwalkers':10,'nburn':4,'thin':2,'chain_dtype':'float32','checkpoint_every':6}
+        np.random.seed(1)
+        full=run_emcee(func,pos0,nsamps=30,**args)
+        self.assertEqual(full['chains'].shape,(10*13,4))
+        self.assertEqual(full['chains'].dtype,np.float32)
+        # interrupted run, resumed from its last checkpoint
+        np.random.seed(1)
+        run_emcee(func,pos0,nsamps=17,checkpoint_dir=tmpdir,**args)
+        # resuming doesn't draw new initial positions
+        np.random.seed(2)
+        resumed=run_emcee(func,pos0,nsamps=30,checkpoint_dir=tmpdir,**args)
+        rand=np.random.rand()
+        np.random.seed(2)
+        self.assertEqual(np.random.rand(),rand)
+        self.assertEqual(resumed['n_steps'],30)
+        self.assertTrue(np.all(resumed['chains']==full['chains']))
+        # a new run with different settings starts afresh
+        with self.assertRaises(ValueError) :
+            run_emcee(func,pos0,nsamps=10,checkpoint_dir=tmpdir,**dict(args,nwalkers=12))
+        fresh=run_emcee(func,pos0,nsamps=10,checkpoint_dir=tmpdir,resume=False,
+                        **dict(args,nwalkers=12))
+        self.assertEqual(fresh['chains'].shape,(12*3,4))
+        # early stopping
+        rdict=run_emcee(func,pos0,nwalkers=10,nsamps=5000,nburn=0,autocorr_every=50,
+                        autocorr_factor=5,autocorr_tol=0.5)
+        self.assertTrue(rdict['converged'])
+        self.assertTrue(rdict['n_steps']<5000)
+        self.assertEqual(len(rdict['chains']),10*rdict['n_steps'])
+        shutil.rmtree(tmpdir)
+
+    def test_pool(self):
+        pool=Pool(2)
+        self.maplike.share_memory()
+        # Fisher matrix from a stencil evaluated in parallel
+        pos0=np.array(self.true_params)
+        rdict=clean_pixels(self.maplike,run_fisher,pool=pool)
+        rdict_an=run_fisher(self.maplike.marginal_spectral_likelihood,pos0,
+                            grad=self.maplike.marginal_spectral_likelihood_grad)
+        self.assertTrue(np.allclose(rdict['fisher_v'],rdict_an['fisher_v'],rtol=1E-3))
+        self.assertTrue(np.allclose(rdict['fisher_m'],rdict_an['fisher_m'],rtol=1E-3))
+        # emcee walkers distributed over the pool, with and without batching
+        for vectorize in [False,True] :
+            samples=clean_pixels(self.maplike,run_emcee,pool=pool,nwalkers=10,nsamps=20,
+                                 nburn=10,vectorize=vectorize)['chains']
+            self.assertEqual(samples.shape,(10*10,4))
+        pool.close()
+        self.maplike.release_memory()
+
     def test_emcee(self):
         # Calculate the p value and reduced chi squred for the true parameter values
         # in the 4 pixels above.
@@ -81,3 +207,65 @@ class test_MapLike(TestCase):
         fig = corner.corner(samples, labels=labels, truths=self.true_params)
         plt.show()
         print("\n")
+
+    def test_clean_patches_noisecov(self):
+        # correlated Q/U noise: the Q and U rows of each patch are fitted together
+        ml=self.maplike
+        n_pix=ml.npix//2
+        noisevar=ml.noisevar.reshape([2,n_pix,-1])
+        config={k:getattr(ml,k) for k in ['fixed_pars','var_pars','var_prior_mean',
+                                          'var_prior_width','var_prior_type']}
+        config['data']=ml.data.reshape([2,n_pix,-1])
+        cov=np.zeros([n_pix,ml.inst.n_channels,2,2])
+        cov[...,0,0]=noisevar[0]
+        cov[...,1,1]=noisevar[1]
+        cov[...,0,1]=cov[...,1,0]=0.3*np.sqrt(noisevar[0]*noisevar[1])
+        ml_cov=MapLike(dict(config,noisecov=cov),ml.sky,ml.inst)
+        nside_spec=1
+        options={'xtol':1E-4,'ftol':1E-4}
+        rdict=clean_patches(ml_cov,run_minimize,nside_spec,options=options)
+        self.assertTrue(np.all(rdict['success_map']))
+        ipatch=5
+        pix=np.where(ml_cov.get_patch_ids(nside_spec)[:n_pix]==ipatch)[0]
+        rdict_patch=clean_pixels(ml_cov.select_pixels(np.r_[pix,pix+n_pix]),run_minimize,
+                                 options=options)
+        self.assertTrue(np.allclose(rdict_patch['params_ML'],rdict['params_map'][:,ipatch]))
+        return
+
+    def test_multires(self):
+        options = {'xtol': 1E-6, 'ftol': 1E-8}
+        self.maplike.noise_groups = None
+        reference = clean_pixels(self.maplike, run_minimize, options=options)
+        # start away from the optimum
+        pos0 = self.maplike.var_prior_mean + np.array([0.3, -0.2, 2., 0.1])
+        direct = clean_pixels(self.maplike, run_minimize, pos0=pos0, options=options)
+        multi = run_multires(self.maplike, [2, 4], pos0=pos0, options=options,
+                             level_args={'options': options})
+        self.assertEqual([l['nside'] for l in multi['levels']], [2, 4])
+        sigma = np.sqrt(np.diag(np.linalg.inv(self.maplike.fisher_matrix(reference['params_ML']))))
+        self.assertTrue(np.all(np.fabs(multi['params_ML'] - reference['params_ML']) < 5 * sigma))
+        lkl = self.maplike.marginal_spectral_likelihood
+        self.assertTrue(lkl(multi['params_ML']) > lkl(reference['params_ML']) - 1.)
+        self.assertTrue(multi['ML_nev'] < direct['ML_nev'])
+        return
+
+    def test_realizations(self):
+        ml = self.maplike
+        n_pix = ml.npix // 2
+        noisevar = ml.noisevar.reshape([2, n_pix, -1])
+        config = {k: getattr(ml, k) for k in ['fixed_pars', 'var_pars', 'var_prior_mean',
+                                              'var_prior_width', 'var_prior_type']}
+        rng = np.random.RandomState(3)
+        sims = (ml.data.reshape([2, n_pix, -1]) +
+                np.sqrt(noisevar) * rng.randn(2, 2, n_pix, ml.inst.n_channels))
+        ml_sims = MapLike(dict(config, data=sims, noisevar=noisevar), ml.sky, ml.inst)
+        fisher = clean_realizations(ml_sims)
+        self.assertTrue(fisher['converged'])
+        self.assertEqual(fisher['params'].shape, (2, len(ml.var_pars)))
+        options = {'xtol': 1E-6, 'ftol': 1E-8}
+        res = clean_realizations(ml_sims, run_minimize, options=options)
+        self.assertEqual(len(res['realization_results']), 2)
+        # the Fisher estimates are close to the maximum of each realization
+        sigma = np.sqrt(np.diagonal(fisher['cov_fisher'], axis1=1, axis2=2))
+        self.assertTrue(np.all(np.fabs(res['params'] - fisher['params_fisher']) < 0.2 * sigma))
+        return
@@ -0,0 +1,62 @@
+from unittest import TestCase
+from bfore import InstrumentModel
+from bfore.components import Component
+from bfore.sedtable import SEDTable
+from bfore.cache import DiskCache
+import numpy as np
+import shutil
+import tempfile
+
+class test_SEDTable(TestCase):
+    def setUp(self):
+        bandpasses = [{'nu': np.linspace(0.8 * n, 1.2 * n, 41), 'bps': np.ones(40)}
+                      for n in [30., 90., 150., 220., 353.]]
+        self.instrumentmodel = InstrumentModel(bandpasses)
+        self.component = Component("dustmbb")
+        self.grids = {'beta_d': np.linspace(1.2, 2.0, 41),
+                      'T_d': np.linspace(15., 25., 41)}
+        self.fixed_pars = {'nu_ref_d': 353.}
+        return
+
+    def test_interpolation(self):
+        for method in ['linear', 'cubic']:
+            table = SEDTable(self.instrumentmodel, self.component, self.grids,
+                             self.fixed_pars, tol=1E-3, method=method)
+            self.assertTrue(table.max_error < 1E-3)
+            args = (353., 1.55, 19.3)
+            direct = self.instrumentmodel.convolve_sed(self.component, args=args)
+            self.assertTrue(np.allclose(table(args), direct, rtol=1E-3, atol=0))
+        # out of the grid
+        self.assertIsNone(table((353., 2.5, 19.3)))
+        return
+
+    def test_tolerance(self):
+        coarse = {'beta_d': np.linspace(1.2, 2.0, 3), 'T_d': np.linspace(5., 25., 3)}
+        self.assertRaises(ValueError, SEDTable, self.instrumentmodel, self.component,
+                          coarse, self.fixed_pars, tol=1E-6)
+        return
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try :
+            cache = DiskCache(directory)
+            table = SEDTable(self.instrumentmodel, self.component, self.grids,
+                             self.fixed_pars, cache=cache)
+            self.assertEqual(cache.info()['size'], 1)
+            cached = SEDTable(self.instrumentmodel, self.component, self.grids,
+                              self.fixed_pars, cache=cache)
+            self.assertEqual(cache.info()['hits'], 1)
+            self.assertEqual(cached.max_error, table.max_error)
+            args = (353., 1.55, 19.3)
+            self.assertTrue(np.allclose(cached(args), table(args), rtol=1E-12, atol=0))
+            # any change in the inputs gives a new entry
+            SEDTable(self.instrumentmodel, self.component, self.grids,
+                     {'nu_ref_d': 300.}, cache=cache)
+            bandpasses = [{'nu': np.linspace(0.8 * n, 1.2 * n, 41), 'bps': np.ones(40)}
+                          for n in [30., 90., 150., 220., 350.]]
+            SEDTable(InstrumentModel(bandpasses), self.component, self.grids,
+                     self.fixed_pars, cache=cache)
+            self.assertEqual(cache.info()['size'], 3)
+        finally :
+            shutil.rmtree(directory)
+        return
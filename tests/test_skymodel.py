@@ -31,3 +31,28 @@ class test_SkyModel(TestCase):
         f_matrix = self.skymodel.fnu(nus, params)
         self.assertEqual(f_matrix.shape, (3, 10))
         return
+
+    def test_compile(self):
+        params = {'nu_ref_d': 353., 'beta_d': 1.6, 'T_d': 20., 'nu_ref_s': 23., 'beta_s': -3.}
+        var_pars = ['beta_s', 'T_d', 'beta_d']
+        fixed_pars = {'nu_ref_d': 353., 'nu_ref_s': 23.}
+        nus = np.array(np.logspace(1, 3, 10))
+        plan = self.skymodel.compile(var_pars, fixed_pars, nus)
+        x = np.array([params[p] for p in var_pars])
+        f_matrix = self.skymodel.fnu(nus, params)
+        out = np.zeros((3, 10))
+        self.assertTrue(plan.fnu(x, out=out) is out)
+        self.assertTrue(np.allclose(out, f_matrix))
+        # batched parameters
+        batch = plan.fnu(np.array([x, x + 0.1]))
+        self.assertEqual(batch.shape, (2, 3, 10))
+        self.assertTrue(np.allclose(batch[0], f_matrix))
+        self.assertTrue(np.allclose(batch[1, 0], f_matrix[0]))
+        self.assertFalse(np.allclose(batch[1, 1:], f_matrix[1:]))
+        self.assertEqual(plan.component_args(x)[2], (23., -3.))
+        # single components, e.g. for the ones missing from a cache
+        for i, args in enumerate(plan.component_args(x)):
+            self.assertTrue(np.allclose(plan.component_fnu(i, args), f_matrix[i]))
+        with self.assertRaises(ValueError):
+            self.skymodel.compile(['beta_s'], fixed_pars, nus)
+        return
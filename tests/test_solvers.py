@@ -0,0 +1,64 @@
+from unittest import TestCase
+import warnings
+import numpy as np
+from bfore.solvers import BlockFactor
+
+def mat_scaled(mat):
+    # D^-1/2 A D^-1/2
+    d = 1. / np.sqrt(np.diagonal(mat, axis1=-2, axis2=-1))
+    return mat * d[:, :, None] * d[:, None, :]
+
+class test_BlockFactor(TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        self.npix = 100
+        return
+
+    def random_blocks(self, n):
+        m = np.random.randn(self.npix, n, n + 3)
+        return np.matmul(m, np.transpose(m, axes=[0, 2, 1]))
+
+    def test_solve(self):
+        # closed form (n<=3) and Cholesky (n>3) paths
+        for n in [1, 2, 3, 4, 6]:
+            mat = self.random_blocks(n)
+            y = np.random.randn(self.npix, n)
+            fac = BlockFactor(mat)
+            x = np.linalg.solve(mat, y[:, :, None])[:, :, 0]
+            self.assertTrue(np.allclose(fac.solve(y), x))
+            self.assertTrue(np.allclose(fac.quadratic(y), np.sum(y * x, axis=1)))
+            self.assertTrue(np.allclose(fac.logdet(), np.linalg.slogdet(mat)[1]))
+            self.assertTrue(np.allclose(fac.inv, np.linalg.inv(mat)))
+        return
+
+    def test_ill_conditioned(self):
+        mat = self.random_blocks(3)
+        mat[5] = np.array([[1., 1., 0.], [1., 1. + 1E-14, 0.], [0., 0., 1.]])
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            fac = BlockFactor(mat)
+            self.assertEqual(len(w), 0)
+            BlockFactor(mat, warn=True)
+            self.assertEqual(len(w), 1)
+        self.assertEqual(list(np.where(fac.ill_conditioned)[0]), [5])
+        mat[7] = -np.eye(3)
+        self.assertRaises(np.linalg.LinAlgError, BlockFactor, mat)
+        # condition numbers are computed after Jacobi scaling
+        for n in [3, 6]:
+            mat = self.random_blocks(n)
+            scale = np.exp(5 * np.random.randn(self.npix, n))
+            fac = BlockFactor(mat * scale[:, :, None] * scale[:, None, :])
+            self.assertTrue(np.allclose(fac.rcond, 1. / np.linalg.cond(mat_scaled(mat), 1)))
+        return
+
+    def test_draw(self):
+        # x = D z with D D^T = A^-1: transforming the identity gives D
+        for n in [1, 2, 3, 4, 6]:
+            mat = self.random_blocks(n)
+            fac = BlockFactor(mat)
+            d = fac.draw(np.broadcast_to(np.eye(n), (self.npix, n, n)))
+            self.assertTrue(np.allclose(np.matmul(d, np.transpose(d, axes=[0, 2, 1])),
+                                        np.linalg.inv(mat)))
+            z = np.random.randn(self.npix, n)
+            self.assertTrue(np.allclose(fac.draw(z), np.matmul(d, z[:, :, None])[:, :, 0]))
+        return